@@ -1,10 +1,15 @@
 # pyright: basic
 
+import io
 import os
 import subprocess
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_for_futures
 from contextlib import contextmanager
-from typing import TYPE_CHECKING, BinaryIO, Generator, cast
+from typing import TYPE_CHECKING, BinaryIO, Dict, Generator, List, NamedTuple, Optional, Tuple, cast
 
 from ranger.ext.img_display import (
   ImageDisplayError,
@@ -19,14 +24,113 @@ else:
 
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "../../scripts/"))
 import dotfiles.icat
+from dotfiles.terminal_utils import get_terminal_size
+from dotfiles.thumbnail_cache import ThumbnailCache
+
+
+# Scales down the images around the one under the cursor in the background, so
+# that when the cursor moves on to them (e.g. while holding `j` in a directory
+# full of photos) their thumbnails are already in the cache and only need to be
+# sent to the terminal. Whatever hasn't been started yet is cancelled once the
+# cursor moves away, the thumbnails that are being generated at that point are
+# finished though, since Pillow can't be interrupted, and they will most likely
+# be needed again anyway.
+#
+# The budget for CPU time is the number of workers, which also run with a lower
+# priority than ranger itself, so they don't slow down the UI. The budget for
+# memory is one decoded image per worker, and files larger than
+# `PREFETCH_MAX_FILE_SIZE` aren't prefetched at all, since they are the ones
+# which take a huge amount of memory (e.g. uncompressed TIFFs or giant PNGs).
+# Pillow releases the GIL while decoding and resizing, so this does run in
+# parallel with the main thread.
+class ThumbnailPrefetcher:
+  NICENESS = 10
+
+  def __init__(self, cache: ThumbnailCache, workers: int) -> None:
+    self.cache = cache
+    self.executor = ThreadPoolExecutor(
+      max_workers=workers,
+      thread_name_prefix="thumbnail-prefetch",
+      initializer=self._lower_priority,
+    )
+    self.pending: "Dict[Tuple[str, int, int], Future[Optional[str]]]" = {}
+
+  @staticmethod
+  def _lower_priority() -> None:
+    # On Linux setpriority(2) given the TID changes the priority of just this
+    # one thread, not of the whole process.
+    try:
+      os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), ThumbnailPrefetcher.NICENESS)
+    except (AttributeError, OSError):
+      pass
+
+  # The paths should be ordered from the most to the least likely to be needed.
+  def prefetch(self, paths: List[str], box_width: int, box_height: int) -> None:
+    keys = [(path, box_width, box_height) for path in paths]
+    for key, future in list(self.pending.items()):
+      if future.done() or (key not in keys and future.cancel()):
+        del self.pending[key]
+    for key in keys:
+      if key not in self.pending:
+        self.pending[key] = self.executor.submit(self.cache.get, *key)
+
+  # Called before an image is drawn, so that its thumbnail isn't generated
+  # twice at the same time. If the work hasn't been started yet, it is simply
+  # left to the caller.
+  def wait(self, path: str, box_width: int, box_height: int) -> None:
+    future = self.pending.pop((path, box_width, box_height), None)
+    if future is not None and not future.cancel():
+      wait_for_futures([future])
+
+  def shutdown(self) -> None:
+    for future in self.pending.values():
+      future.cancel()
+    self.pending.clear()
+    self.executor.shutdown(wait=False)
+
+
+class UploadedImage(NamedTuple):
+  image_id: int
+  # The output of `icat` with the Unicode placeholders, empty if the image was
+  # placed directly.
+  placeholders: bytes
 
 
 # Replacement for <https://github.com/ranger/ranger/blob/f28690ef42778eb7982e2b309a2cc8d99f682eb4/ranger/ext/img_display.py#L684>
+#
+# The images stay uploaded to the terminal after they are hidden, each under
+# its own ID, so that going back to a file that has been previewed recently
+# only has to display the image again (by re-creating the placement, or by
+# printing the same Unicode placeholders) instead of sending all of its pixels
+# once more. The uploaded images are identified by the path, the size and the
+# modification time of the file, and the rectangle it was drawn in. Only the
+# `MAX_UPLOADED_IMAGES` most recently displayed ones are kept, the data of the
+# rest is deleted from the terminal's memory.
 @register_image_displayer("kitty")
 class PatchedKittyImageDisplayer(KittyImageDisplayer):
+  MAX_UPLOADED_IMAGES = 32
+  PREFETCH_MAX_FILE_SIZE = 32 * 1024 * 1024
+
   def __init__(self) -> None:
     super().__init__()
-    self.image_id = os.getpid()
+    # The IDs are derived from the PID so that they don't collide with the
+    # images of other processes, pid_max is at most 2**22 on Linux.
+    self.image_id_base = os.getpid() << 8
+    self.free_image_ids = self._get_all_image_ids()
+    self.uploaded_images: "OrderedDict[Tuple[str, int, int, int, int, int, int], UploadedImage]"
+    self.uploaded_images = OrderedDict()
+    self.shown_image_id = 0
+
+    self.thumbnail_cache = ThumbnailCache.from_env()
+    self.prefetcher: Optional[ThumbnailPrefetcher] = None
+    self.last_pointer = 0
+    # The number of images on each side of the cursor to prefetch.
+    self.prefetch_count = self._get_env_int("DOTFILES_THUMBNAIL_PREFETCH", 2)
+    workers = self._get_env_int(
+      "DOTFILES_THUMBNAIL_PREFETCH_WORKERS", min(2, max(1, (os.cpu_count() or 1) // 2))
+    )
+    if self.thumbnail_cache is not None and self.prefetch_count > 0 and workers > 0:
+      self.prefetcher = ThumbnailPrefetcher(self.thumbnail_cache, workers)
 
     if os.environ.get("TMUX", ""):
       self.protocol_start = b"\x1bPtmux;" + self.protocol_start.replace(b"\x1b", b"\x1b\x1b")
@@ -37,20 +141,89 @@ class PatchedKittyImageDisplayer(KittyImageDisplayer):
     stdout = cast(BinaryIO, self.stdbout)
     stdout.flush()
 
-    self._delete_image(self.image_id)
+    icat_wrapper_needed = self._icat_wrapper_needed()
 
-    icat_wrapper_needed = bool(os.environ.get("VIM_TTY", "") or os.environ.get("TMUX", ""))
+    self._hide_image(icat_wrapper_needed)
 
     if icat_wrapper_needed and start_x == 0 and start_y != 0:
       start_x = -1
 
+    try:
+      stat = os.stat(path)
+    except OSError as e:
+      raise ImageDisplayError(str(e)) from e
+    key = (path, stat.st_size, stat.st_mtime_ns, start_x, start_y, width, height)
+    thumbnail_box = self._get_thumbnail_box(width, height)
+
+    stdout.write(dotfiles.icat.SGR_RESET)
+    stdout.flush()
+
+    try:
+      image = self.uploaded_images.get(key)
+      if image is not None:
+        self.uploaded_images.move_to_end(key)
+        self._place_uploaded_image(image, start_x, start_y)
+      else:
+        if self.prefetcher is not None and thumbnail_box is not None:
+          self.prefetcher.wait(path, *thumbnail_box)
+        image_id = self._allocate_image_id()
+        try:
+          placeholders = self._upload_image(
+            path, image_id, start_x, start_y, width, height, thumbnail_box
+          )
+        except BaseException:
+          self.free_image_ids.append(image_id)
+          raise
+        image = self.uploaded_images[key] = UploadedImage(image_id, placeholders)
+
+      if image.placeholders:
+        stdout.write(image.placeholders)
+      self.shown_image_id = image.image_id
+
+    finally:
+      stdout.write(dotfiles.icat.SGR_RESET)
+      stdout.flush()
+
+      # self.fm.ui.win.clearok(1)
+
+    if self.prefetcher is not None and thumbnail_box is not None:
+      self.prefetcher.prefetch(self._get_neighbor_images(path), *thumbnail_box)
+
+  @staticmethod
+  def _get_env_int(name: str, default: int) -> int:
+    try:
+      return int(os.environ.get(name, default))
+    except ValueError:
+      return default
+
+  @staticmethod
+  def _icat_wrapper_needed() -> bool:
+    return bool(os.environ.get("VIM_TTY", "") or os.environ.get("TMUX", ""))
+
+  def _upload_image(
+    self,
+    path: str,
+    image_id: int,
+    start_x: int,
+    start_y: int,
+    width: int,
+    height: int,
+    thumbnail_box: Optional[Tuple[int, int]],
+  ) -> bytes:
+    stdout = cast(BinaryIO, self.stdbout)
+    icat_wrapper_needed = self._icat_wrapper_needed()
+
+    if not icat_wrapper_needed and self.thumbnail_cache is not None and thumbnail_box is not None:
+      # `dotfiles.icat.draw` looks up the thumbnail by itself.
+      path = self.thumbnail_cache.get(path, *thumbnail_box) or path
+
     args = [
       "--stdin=no",
       "--transfer-mode=stream",
       "--passthrough=detect",
       f"--place={width}x{height}@{start_x}x{start_y}",
       "--align=left",
-      f"--image-id={self.image_id}",
+      f"--image-id={image_id}",
       "--no-trailing-newline",
     ]
 
@@ -60,26 +233,100 @@ class PatchedKittyImageDisplayer(KittyImageDisplayer):
     args.append("--")
     args.append(path)
 
-    stdout.write(dotfiles.icat.SGR_RESET)
+    if icat_wrapper_needed:
+      # The placeholders are captured to be printed again when the image is
+      # displayed the next time.
+      placeholders = io.BytesIO()
+      cols, rows = get_terminal_size(stdout.fileno())
+      with self._open_real_tty() as tty:
+        exit_code = dotfiles.icat.draw(args, placeholders, tty, cols, rows, mode="ranger")
+      if exit_code != 0:
+        raise ImageDisplayError(f"icat exited with code {exit_code}")
+      return placeholders.getvalue()
+
+    else:
+      result = subprocess.run(["kitten", "icat"] + args, check=False, stderr=subprocess.PIPE)
+      if result.returncode != 0 or len(result.stderr) > 0:
+        raise ImageDisplayError(f"icat exited with code {result.returncode}: {result.stderr}")
+      return b""
+
+  def _place_uploaded_image(self, image: UploadedImage, start_x: int, start_y: int) -> None:
+    if image.placeholders:
+      return  # The virtual placement of the image is never deleted
+    # Same as what `kitten icat --place` does, the cursor is restored afterwards.
+    stdout = cast(BinaryIO, self.stdbout)
+    stdout.write(dotfiles.icat.DECSC + b"\x1b[%d;%dH" % (start_y + 1, start_x + 1))
+    for cmd_str in self._format_cmd_str({"a": "p", "i": image.image_id, "q": 2, "C": 1}):
+      stdout.write(cmd_str)
+    stdout.write(dotfiles.icat.DECRC)
     stdout.flush()
 
-    try:
-      if icat_wrapper_needed:
-        exit_code = dotfiles.icat.run(args, stdout, mode="ranger")
-        stdout.flush()
-        if exit_code != 0:
-          raise ImageDisplayError(f"icat exited with code {exit_code}")
+  def _get_all_image_ids(self) -> List[int]:
+    return [self.image_id_base + i for i in range(self.MAX_UPLOADED_IMAGES)]
 
+  def _allocate_image_id(self) -> int:
+    if not self.free_image_ids:
+      if self.uploaded_images:
+        _, evicted = self.uploaded_images.popitem(last=False)
+        self._delete_images([evicted.image_id], free_data=True)
+        self.free_image_ids.append(evicted.image_id)
       else:
-        result = subprocess.run(["kitten", "icat"] + args, check=False, stderr=subprocess.PIPE)
-        if result.returncode != 0 or len(result.stderr) > 0:
-          raise ImageDisplayError(f"icat exited with code {result.returncode}: {result.stderr}")
+        # None of the IDs are in use, so any that have gone missing can be
+        # reclaimed.
+        self.free_image_ids = self._get_all_image_ids()
+    return self.free_image_ids.pop()
 
-    finally:
-      stdout.write(dotfiles.icat.SGR_RESET)
-      stdout.flush()
+  def _hide_image(self, icat_wrapper_needed: bool) -> None:
+    # With Unicode placeholders the image disappears together with the text,
+    # otherwise its placement must be deleted, but the data is kept.
+    if self.shown_image_id and not icat_wrapper_needed:
+      self._delete_images([self.shown_image_id], free_data=False)
+    self.shown_image_id = 0
 
-      # self.fm.ui.win.clearok(1)
+  # Computed the same way as in `dotfiles.icat.draw`, so that the thumbnails
+  # looked up in the wrapper mode hit the prefetched entries too.
+  def _get_thumbnail_box(self, width: int, height: int) -> Optional[Tuple[int, int]]:
+    if self.thumbnail_cache is None:
+      return None
+    stdout = cast(BinaryIO, self.stdbout)
+    try:
+      cols, rows = get_terminal_size(stdout.fileno())
+      with self._open_real_tty() as tty:
+        xpixels, ypixels = dotfiles.icat.get_window_pixels(tty, cols, rows)
+    except (OSError, ZeroDivisionError):
+      return None
+    options = [f"--place={width}x{height}"]
+    return dotfiles.icat.get_thumbnail_box(options, cols, rows, xpixels, ypixels)
+
+  # Returns the images closest to the file under the cursor, alternating between
+  # the next and the previous ones, starting in the direction in which the cursor
+  # has last moved.
+  def _get_neighbor_images(self, path: str) -> List[str]:
+    directory = self.fm.thisdir
+    files = directory.files if directory is not None else None
+    pointer = directory.pointer if directory is not None else 0
+    if not files or not (0 <= pointer < len(files)) or files[pointer].path != path:
+      return []  # Previews of something else, e.g. of a video generated by scope.sh
+
+    iterators = [iter(files[pointer + 1 :]), iter(reversed(files[:pointer]))]
+    if pointer < self.last_pointer:
+      iterators.reverse()
+    self.last_pointer = pointer
+    counts = [0, 0]
+    images: List[str] = []
+    # The number of files to look through is bounded, in case there are almost
+    # no images in a huge directory.
+    for _ in range(self.prefetch_count * 8):
+      for direction, iterator in enumerate(iterators):
+        if counts[direction] >= self.prefetch_count:
+          continue
+        file = next(iterator, None)
+        if file is None:
+          counts[direction] = self.prefetch_count
+        elif file.is_file and file.image and file.size <= self.PREFETCH_MAX_FILE_SIZE:
+          images.append(file.path)
+          counts[direction] += 1
+    return images
 
   @contextmanager
   def _open_real_tty(self) -> Generator[BinaryIO, None, None]:
@@ -90,18 +337,24 @@ class PatchedKittyImageDisplayer(KittyImageDisplayer):
     else:
       yield cast(BinaryIO, self.stdbout)
 
-  def _delete_image(self, id: int) -> None:
+  def _delete_images(self, ids: List[int], free_data: bool) -> None:
     with self._open_real_tty() as tty:
-      for cmd_str in self._format_cmd_str({"a": "d", "d": "I", "i": id}):
-        tty.write(cmd_str)
+      for id in ids:
+        for cmd_str in self._format_cmd_str({"a": "d", "d": "I" if free_data else "i", "i": id}):
+          tty.write(cmd_str)
       tty.flush()
 
   @override
   def clear(self, start_x: int, start_y: int, width: int, height: int) -> None:
-    self._delete_image(self.image_id)
+    self._hide_image(self._icat_wrapper_needed())
     self.fm.ui.win.redrawwin()
     self.fm.ui.win.refresh()
 
   @override
   def quit(self) -> None:
     self.clear(0, 0, 0, 0)
+    ids = [image.image_id for image in self.uploaded_images.values()]
+    self.uploaded_images.clear()
+    self._delete_images(ids, free_data=True)
+    if self.prefetcher is not None:
+      self.prefetcher.shutdown()
@@ -0,0 +1,68 @@
+# Helpers shared by the on-disk caches of these scripts: the `RenderCache` of
+# `fancy_man_pager.py`, the thumbnail cache in `thumbnail_cache.py` and the
+# text previews generated by `lf_preload.py`. All of them keep one file (or a
+# few files) per entry in a directory, write new entries into hidden temporary
+# files which are then renamed, and mark an entry as used by bumping the access
+# time of its files. Since `fancy_man_pager.py` supports Python 3.5, so must
+# this module.
+
+import os
+import time
+from typing import Iterable
+
+
+# Keeps the total size of the files in the `directory` within `max_size` by
+# deleting the least recently used entries (by the access time) first. Files
+# ending with one of the `suffixes` belong to the same entry as the others
+# with the same name without the suffix, and are deleted together with them.
+# Returns the number of evicted entries.
+def evict(directory: str, max_size: int, suffixes: "Iterable[str]" = ()) -> int:
+  suffixes = tuple(suffixes)
+  now = time.time()
+  entries = {}  # type: dict[str, tuple[float, int, list[str]]]
+  total_size = 0
+
+  evicted = 0
+  try:
+    dir_entries = list(os.scandir(directory))
+  except OSError:
+    return evicted
+
+  for file in dir_entries:
+    try:
+      stat = file.stat()
+    except OSError:
+      continue
+
+    if file.name.startswith("."):
+      # Leave the temporary files of other processes alone, unless they were
+      # abandoned by a process that has crashed a long time ago.
+      if now - stat.st_mtime > 24 * 60 * 60:
+        try:
+          os.unlink(file.path)
+        except OSError:
+          pass
+      continue
+
+    name = file.name
+    for suffix in suffixes:
+      if name.endswith(suffix):
+        name = name[: -len(suffix)]
+        break
+    last_used, size, paths = entries.get(name, (0.0, 0, []))
+    paths.append(file.path)
+    entries[name] = (max(last_used, stat.st_atime), size + stat.st_size, paths)
+    total_size += stat.st_size
+
+  for _, size, paths in sorted(entries.values()):
+    if total_size <= max_size:
+      break
+    for path in paths:
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+    total_size -= size
+    evicted += 1
+
+  return evicted
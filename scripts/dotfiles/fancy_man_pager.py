@@ -11,8 +11,8 @@
 # jump through all of its references and unrelated matches within the text of
 # the manpage, which is *extremely* helpful for looking up generic words like
 # `read` in bash(1). The term has to be specified in full though, so looking up
-# `read` will not yield e.g. `readarray` and looking up `version` will not yield
-# the description for `--version`. Also, less(1) does not offer any
+# `read` will not yield e.g. `readarray` (though `version` will yield the
+# description for `--version`, see `TagIndex`). Also, less(1) does not offer any
 # Tab-completion for `:t` because of its minimalistic design, so you have to
 # know what you're looking for beforehand. If a certain term appears multiple
 # times in the manpage, the `t` and `T` keys can be used to jump to its next or
@@ -48,14 +48,16 @@
 # need to "slurp up" the whole input up to the EOF, keep it in memory and feed
 # that into the pager. However, since groff(1) takes some noticeable time to
 # render long manpages, my script doesn't wait to read the entire document into
-# memory, instead it reads input line-by-line and immediately starts feeding the
-# processed lines to the input of less(1) until the buffer of the OS pipe gets
-# completely filled, at which point we know that less(1) has displayed a single
-# page and will pause reading from its end of the pipe for now. From that point
-# we start buffering the processed lines into memory, until less(1) needs to
-# read more. This makes the `man` command feel as snappy with my tagger script
-# as without it, and makes the pager pop up immediately, as it normally does,
-# while the script is generating tags asynchronously in the background.
+# memory, instead it reads input in blocks of lines as soon as they come in and
+# immediately starts feeding the processed lines to the input of less(1) until
+# the buffer of the OS pipe gets completely filled, at which point we know that
+# less(1) has displayed a single page and will pause reading from its end of the
+# pipe for now. From that point we start buffering the processed lines into
+# memory (or a temporary file, if there are too many of them), until less(1) needs
+# to read more (see `PagerWriter`). This makes the `man` command feel as snappy
+# with my tagger script as without it, and makes the pager pop up immediately,
+# as it normally does, while the script is generating tags asynchronously in the
+# background.
 #
 # Additionally, my script also performs some basic colorization of manpages in a
 # very rudimentary way: it just looks at words in bold font, and highlights them
@@ -86,42 +88,106 @@ import os
 import re
 import sys
 from contextlib import ExitStack
-from typing import IO, TYPE_CHECKING, Iterable, Optional
+from typing import IO, TYPE_CHECKING, Iterable, Iterator, Optional
+
+if TYPE_CHECKING:
+  import subprocess  # noqa: F401 (only used in type comments)
 
 
 def main() -> None:
   with ExitStack() as stack:
     program_name = os.path.basename(sys.argv[0])
+    usage = (
+      "usage:\n  {0} [--format=ansi|json] <file>\n  man ... | {0} [--format=ansi|json]\n"
+      "  {0} [--format=ansi|json] <section> <page>\n  {0} --warm [<section>...]"
+    ).format(program_name)
+
+    args = sys.argv[1:]
+    if args and args[0] == "--warm":
+      warm_render_cache(args[1:], program_name)
+      sys.exit(0)
+
+    output_format = "ansi"
+    if args and args[0].startswith("--format="):
+      output_format = args.pop(0)[len("--format=") :]
+      if output_format not in ("ansi", "json"):
+        sys.exit(usage)
+
+    render_cache = None  # type: Optional[RenderCache]
+    cached_output = None  # type: Optional[IO[bytes]]
+    man = None  # type: Optional[subprocess.Popen[bytes]]
 
-    if len(sys.argv) == 3:
-      section, page = sys.argv[1:]
+    if len(args) == 2:
+      section, page = args
 
       import subprocess
 
-      os.environ["MAN_KEEP_FORMATTING"] = "1"
-      man = stack.enter_context(
-        subprocess.Popen(
-          ["man", "--", section, page],
-          stdin=subprocess.DEVNULL,
-          stdout=subprocess.PIPE,
-          stderr=subprocess.DEVNULL,
+      # The cache stores only the colorized text, which is of no use for `--format=json`.
+      if output_format == "ansi":
+        render_cache = RenderCache.for_manpage(section, page)
+      if render_cache:
+        cached_output = render_cache.load()
+
+      if cached_output:
+        input_file = stack.enter_context(cached_output)
+      else:
+        os.environ["MAN_KEEP_FORMATTING"] = "1"
+        man = stack.enter_context(
+          subprocess.Popen(
+            ["man", "--", section, page],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+          )
         )
-      )
 
-      assert man.stdout
-      input_file = man.stdout
+        assert man.stdout
+        input_file = man.stdout
 
-    elif len(sys.argv) == 2:
-      input_file = stack.enter_context(open(sys.argv[1], "rb"))
+    elif len(args) == 1:
+      input_file = stack.enter_context(open(args[0], "rb"))
 
-    elif len(sys.argv) == 1 and not sys.stdin.isatty():
+    elif len(args) == 0 and not sys.stdin.isatty():
       input_file = sys.stdin.buffer
 
     else:
-      sys.exit("usage:\n  {0} <file>\n  man ... | {0}\n  {0} <section> <page>".format(program_name))
+      sys.exit(usage)
+
+    if output_format == "json":
+      # The structured output is meant to be read by programs, not by humans,
+      # so the pager is not involved.
+      export_as_json(input_file, sys.stdout.buffer)
+      sys.exit(0)
+
+    if render_cache and not cached_output:
+      # The rendered manpage is not in the cache yet, so it will be written
+      # there as a side effect of displaying it this time.
+      stack.callback(render_cache.abort)
+      output_copy = render_cache.begin()
+    else:
+      output_copy = None
+
+    def store_into_cache(tags_path: str) -> None:
+      # Don't cache incomplete output (if the pager has been closed before the
+      # whole manpage has been read) or the error messages of man(1).
+      if render_cache and output_copy and man and man.wait() == 0:
+        render_cache.commit(tags_path)
 
     if not sys.stdout.isatty():
-      just_colorize_input(input_file, sys.stdout.buffer)
+      if cached_output:
+        feed_input_into_pager(sys.stdout.buffer, read_in_chunks(cached_output))
+      elif output_copy:
+        # The tags are needed for the cache entry, even though nobody is going
+        # to look at them right now.
+        import tempfile
+
+        tags_file = stack.enter_context(tempfile.NamedTemporaryFile(prefix="man-tags."))
+        if generate_tags_and_feed_into_less(
+          sys.stdout.buffer, input_file, tags_file.name, program_name, output_copy
+        ):
+          store_into_cache(tags_file.name)
+      else:
+        just_colorize_input(input_file, sys.stdout.buffer)
       sys.exit(0)
 
     import signal
@@ -144,9 +210,13 @@ def main() -> None:
           command.append("-f")  # Don't wrap long lines, this breaks in the presence of ANSI codes
 
       if pager_name == "less":
-        if not created_tags_file:
-          created_tags_file = stack.enter_context(tempfile.NamedTemporaryFile(prefix="man-tags."))
-        command.append("-T" + created_tags_file.name)
+        if cached_output and render_cache:
+          # The tags file of a cache entry can be given to less(1) directly.
+          command.append("-T" + render_cache.tags_path)
+        else:
+          if not created_tags_file:
+            created_tags_file = stack.enter_context(tempfile.NamedTemporaryFile(prefix="man-tags."))
+          command.append("-T" + created_tags_file.name)
 
       return (
         stack.enter_context(subprocess.Popen(command, stdin=subprocess.PIPE)),
@@ -260,12 +330,26 @@ def main() -> None:
     stack.enter_context(set_signal_handler(signal.SIGINT, signal.SIG_IGN))
     stack.enter_context(set_signal_handler(signal.SIGQUIT, signal.SIG_IGN))
 
-    if tags_file:
-      # Pass the file descriptor of `tags_file`, not the `NamedTemporaryFile`
-      # object itself, as closing the former will just close the opened file
-      # descriptor, while doing the same to the latter will also delete the
-      # underlying file.
-      generate_tags_and_feed_into_less(pager.stdin, input_file, tags_file.file, program_name)
+    if cached_output:
+      if pager.stdin:
+        feed_input_into_pager(pager.stdin, read_in_chunks(cached_output))
+    elif tags_file or output_copy:
+      # A tags file returned by `start_pager` is already being read by less(1).
+      publish_progressively = tags_file is not None
+      if not tags_file:
+        tags_file = stack.enter_context(tempfile.NamedTemporaryFile(prefix="man-tags."))
+      # The tags file is replaced with a new one every time the tags are
+      # published, and the `NamedTemporaryFile` object will delete whatever
+      # file ends up at its path when the program exits.
+      if generate_tags_and_feed_into_less(
+        pager.stdin,
+        input_file,
+        tags_file.name,
+        program_name,
+        output_copy,
+        publish_progressively=publish_progressively,
+      ):
+        store_into_cache(tags_file.name)
     elif pager.stdin:
       just_colorize_input(input_file, pager.stdin)
 
@@ -286,81 +370,487 @@ def main() -> None:
 
 
 def just_colorize_input(input_pipe: IO[bytes], output_pipe: IO[bytes]) -> None:
-  # I love how the `map()` function allows transforming the stream of lines
+  # I love how the `map()` function allows transforming the stream of blocks
   # coming from the `input_file` in such a Pythonic manner!
-  feed_input_into_pager(output_pipe, map(colorize_line, map(perform_overstriking, input_pipe)))
+  feed_input_into_pager(
+    output_pipe, map(colorize_block, map(perform_overstriking_in_block, read_blocks(input_pipe)))
+  )
 
 
+# The `--format=json` mode, meant for integrations with text editors, which
+# would otherwise have to parse the ANSI sequences out of the colorized text to
+# apply the same highlighting. The output is a stream of JSON objects, one per
+# line (JSON Lines), written out as soon as every block of input is processed:
+#
+#     {"type": "line", "lnum": 1, "text": "...", "spans": [[0, 4, "bold"], ...]}
+#     {"type": "tag", "lnum": 1, "names": ["--color=WHEN", "--color", "color"]}
+#
+# The `spans` of a line are the ranges of the `text` (in bytes of its UTF-8
+# encoding, as most editors count columns) which have a certain style, which is
+# either `bold`, `italic`, `underline`, or one of the classes of text that the
+# colorizer has recognized, as named in `JSON_COLOR_CLASSES`. Spans of different
+# styles may overlap. Every tag is reported after the line it points to, with
+# all names it can be found by (see `TagIndex`).
+def export_as_json(input_file: IO[bytes], output_file: IO[bytes]) -> None:
+  def generate_json_lines() -> Iterator[bytes]:
+    import json
+
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    styles = {}  # type: dict[str, int]
+    linenr = 1
+    for block in read_blocks(input_file):
+      block = perform_overstriking_in_block(block)
+      tags, _ = extract_tags(block, linenr)
+      records = []  # type: list[str]
+      lines = colorize_block(block).split(b"\n")
+      if not lines[-1]:
+        lines.pop()
+      for line in lines:
+        text, spans = convert_ansi_to_spans(line, styles)
+        records.append(
+          encoder.encode({"type": "line", "lnum": linenr, "text": text, "spans": spans})
+        )
+        linenr += 1
+      for tag, tag_linenr in tags:
+        names = [name.decode(errors="replace") for name in get_tag_names(tag)]
+        records.append(
+          encoder.encode({"type": "tag", "lnum": tag_linenr, "names": list(dict.fromkeys(names))})
+        )
+      records.append("")
+      yield "\n".join(records).encode()
+
+  feed_input_into_pager(output_file, generate_json_lines())
+
+
+# Processing the input line-by-line means calling a bunch of functions and
+# running a bunch of regexes for every single line, and the overhead of those
+# calls adds up on long manpages. Instead, the input is processed in blocks of
+# whole lines, as large as what has already been written into the pipe by
+# groff(1) (so that we don't wait on it to render more text before showing
+# anything), and the regular expressions are written so that they never match
+# across line boundaries, which makes the results identical to processing the
+# lines one at a time.
+def read_blocks(input_file: IO[bytes], block_size: int = 64 * 1024) -> Iterator[bytes]:
+  # `read1()` returns whatever is available in the buffer or can be read with a
+  # single read(2) call, instead of waiting until `block_size` bytes are read.
+  read1 = getattr(input_file, "read1", input_file.read)
+  unfinished_line = b""
+  while True:
+    chunk = read1(block_size)
+    if not chunk:
+      break
+    end = chunk.rfind(b"\n") + 1
+    if end == 0:
+      unfinished_line += chunk
+      continue
+    yield unfinished_line + chunk[:end] if unfinished_line else chunk[:end]
+    unfinished_line = chunk[end:]
+  if unfinished_line:
+    yield unfinished_line
+
+
+# Returns `True` if the whole input has been processed, or `False` if the pager
+# has exited before that, in which case the generated tags are incomplete.
+# With `publish_progressively`, the tags are published (see `TagIndex.publish`)
+# while the input is still being processed, so that `:t` in less(1) can already
+# find the tags at the beginning of a manpage that takes a while to render. A
+# new snapshot of the tags file is written whenever the number of tags doubles,
+# which makes the total amount of written data at most twice the size of the
+# final tags file, or, on pages that render slowly, at most every
+# `PUBLISH_INTERVAL` seconds, since the tags written in the meantime might be
+# what the user is looking for. Otherwise, the tags file is written just once
+# after reaching the end of the input.
 def generate_tags_and_feed_into_less(
-  pager_stdin: Optional[IO[bytes]], input_file: IO[bytes], tags_file: IO[bytes], program_name: str
-) -> None:
-  buffered_bytes = bytearray()
-  buffered_bytes_counter = 0
-
-  # Matches lines which begin with text in the bold font, optionally preceded by some whitespace.
-  bold_text_re = re.compile(rb"^\s*\x1b\[1m([^\x1b]+)")
-  # Some manpages don't format the names of command-line flags in the bold font,
-  # e.g.: less(1). Try to also generate tags for lines which begin with a dash
-  # or a plus. This heuristic was taken from
-  # <https://github.com/neovim/neovim/blob/v0.11.5/runtime/lua/man.lua#L799>.
-  flag_re = re.compile(rb"^\s+([-+][^\x1b\s,=]+)")
+  pager_stdin: Optional[IO[bytes]],
+  input_file: IO[bytes],
+  tags_path: str,
+  program_name: str,
+  output_copy: Optional[IO[bytes]] = None,
+  publish_progressively: bool = False,
+) -> bool:
+  PUBLISH_INTERVAL = 0.5
 
-  whitespace_re = re.compile(rb"\s")
+  completed = False
 
   import time
 
-  try:
-    if pager_stdin:
-      os.set_blocking(pager_stdin.fileno(), False)
-
-    start_time = time.perf_counter()
-
-    # The 2nd argument of `enumerate()` specifies the starting value for the counter. Handy!
-    for linenr, line in enumerate(input_file, 1):
-      line = perform_overstriking(line)
-
-      match = bold_text_re.match(line) or flag_re.match(line)
-      if match:
-        tag = match.group(1).strip()
-        if tag:
-          tag = whitespace_re.sub(b"_", tag)
-          tags_file.write(tag)
-          tags_file.write(b" - %d\n" % linenr)
-
-      if pager_stdin:
-        line = colorize_line(line)
-        buffered_bytes.extend(line)
-
-        # Making write(2) syscalls too often will slow down this whole loop.
-        # Instead, a simple heuristic is employed: make one write attempt
-        # roughly per every 4 KiB read from the input pipe.
-        buffered_bytes_counter += len(line)
-        if buffered_bytes_counter > 4096:
-          buffered_bytes_counter = 0
-          try:
-            written = pager_stdin.write(buffered_bytes)
-          except BlockingIOError as err:
-            written = err.characters_written
-          except BrokenPipeError:
-            break  # no need to continue generating tags if the pager has exited
-          del buffered_bytes[:written]
-
-    tags_file.flush()
-
-    end_time = time.perf_counter()
-    if os.environ.get("DOTFILES_MANPAGER_TIME"):
-      elapsed_ms = (end_time - start_time) * 1000
-      buffered_bytes.extend("{}: done in {:.03f} ms\n".format(program_name, elapsed_ms).encode())
+  perf_counter = time.perf_counter
+  # The time spent in every stage of processing is accumulated separately, so
+  # that `$DOTFILES_MANPAGER_TIME` can show where exactly the time goes.
+  stage_names = ("input", "overstriking", "tags", "colorizing", "output")
+  stage_times = [0.0] * len(stage_names)
+
+  pager_writer = PagerWriter(pager_stdin) if pager_stdin else None
+
+  start_time = perf_counter()
+
+  linenr = 1
+  tag_index = TagIndex()
+  published_count = 0
+  published_time = start_time
+  publications = 0
+  published_bytes = 0
+
+  blocks = read_blocks(input_file)
+  while True:
+    time0 = perf_counter()
+    block = next(blocks, None)
+    time1 = perf_counter()
+    stage_times[0] += time1 - time0
+    if block is None:
+      break
+
+    block = perform_overstriking_in_block(block)
+    time2 = perf_counter()
+    stage_times[1] += time2 - time1
+
+    tags, linenr = extract_tags(block, linenr)
+    for tag, tag_linenr in tags:
+      tag_index.add(tag, tag_linenr)
+    time3 = perf_counter()
+    stage_times[2] += time3 - time2
+
+    if pager_writer or output_copy:
+      block = colorize_block(block)
+    time4 = perf_counter()
+    stage_times[3] += time4 - time3
+
+    if output_copy:
+      output_copy.write(block)
+    if pager_writer:
+      if pager_writer.broken:
+        break  # no need to continue generating tags if the pager has exited
+      pager_writer.write(block)
+    time5 = perf_counter()
+    stage_times[4] += time5 - time4
+
+    # The tags are published after the block has been sent to the pager, so as
+    # not to delay its appearance on the screen.
+    if publish_progressively:
+      count = len(tag_index.entries)
+      if count > published_count and (
+        count >= published_count * 2 or time5 - published_time >= PUBLISH_INTERVAL
+      ):
+        published_bytes += tag_index.publish(tags_path)
+        publications += 1
+        published_count = count
+        published_time = time5
+        stage_times[2] += perf_counter() - time5
+
+  if block is None:
+    completed = True
+
+  time0 = perf_counter()
+  published_bytes += tag_index.publish(tags_path)
+  publications += 1
+  stage_times[2] += perf_counter() - time0
+
+  end_time = perf_counter()
+  if pager_writer and os.environ.get("DOTFILES_MANPAGER_TIME"):
+    pager_writer.write(
+      "{}: done in {:.03f} ms ({}), tags file written {} times ({} bytes), "
+      "{} bytes spilled to disk\n".format(
+        program_name,
+        (end_time - start_time) * 1000,
+        ", ".join(
+          "{}: {:.03f} ms".format(name, elapsed * 1000)
+          for name, elapsed in zip(stage_names, stage_times)
+        ),
+        publications,
+        published_bytes,
+        pager_writer.spilled_bytes,
+      ).encode()
+    )
+
+  if pager_writer:
+    pager_writer.close()
+
+  return completed
+
+
+# Returns the tags for the lines within the block (see the comment at the top
+# of this file for the heuristics used to find them), as pairs of the tagged
+# text and its line number, and the number of the line following the block.
+def extract_tags(block: bytes, linenr: int) -> "tuple[list[tuple[bytes, int]], int]":
+  tag_re = regex(
+    # Matches lines which begin with text in the bold font, optionally preceded by some whitespace.
+    rb"^[^\S\n]*\x1b\[1m([^\x1b\n]+)"
+    # Some manpages don't format the names of command-line flags in the bold
+    # font, e.g.: less(1). Try to also generate tags for lines which begin with
+    # a dash or a plus. This heuristic was taken from
+    # <https://github.com/neovim/neovim/blob/v0.11.5/runtime/lua/man.lua#L799>.
+    rb"|^[^\S\n]+([-+][^\x1b\s,=]+)",
+    re.MULTILINE,
+  )
 
-  finally:
-    if pager_stdin:
-      os.set_blocking(pager_stdin.fileno(), True)
+  tags = []  # type: list[tuple[bytes, int]]
+  pos = 0
+  for match in tag_re.finditer(block):
+    linenr += block.count(b"\n", pos, match.start())
+    pos = match.start()
+    tag = match.group(match.lastindex or 0).strip()
+    if tag:
+      tags.append((tag, linenr))
+  linenr += block.count(b"\n", pos)
+  return tags, linenr
+
+
+# Collects the tags of the whole manpage, so that they can be written out as a
+# sorted tags file. Besides the tagged text itself, every tag gets a few aliases
+# under which it can also be found, since `:t` in less(1) requires typing the
+# full name of a tag:
+#
+# 1. Names of flags without the leading dashes, so that `:t version` finds
+#    `--version`.
+# 2. Flags with their arguments cut off, so that `--color=WHEN` and
+#    `--color[=WHEN]` can be found by `--color` and `color`. Several flags in a
+#    single tag (`-o, --output`) are split up as well.
+# 3. Sub-words of names in the UPPER_CASE, which are usually environment
+#    variables, so that `:t TIME` finds `DOTFILES_MANPAGER_TIME`.
+#
+# Duplicates are removed, and the entries are sorted by the tag names, as
+# indicated by the `!_TAG_FILE_SORTED` header, which lets ctags(1) consumers
+# look up tags with a binary search instead of a linear scan.
+WHITESPACE_TO_UNDERSCORES = bytes.maketrans(b" \t\n\r\x0b\x0c", b"______")
+
+
+# Returns the names under which a tag can be found: the tagged text itself and
+# its aliases (see `TagIndex`). Might contain duplicates.
+def get_tag_names(tag: bytes) -> "list[bytes]":
+  names = []  # type: list[bytes]
+  if not tag.startswith(b"!"):
+    names.append(tag.translate(WHITESPACE_TO_UNDERSCORES))
+
+  if tag[:1] in (b"-", b"+"):
+    words = regex(rb"[\s,]+").split(tag) if tag != tag.translate(None, b" \t,") else [tag]
+    for word in words:
+      if word[:1] in (b"-", b"+"):
+        option = word.partition(b"=")[0].partition(b"[")[0]
+        name = option.lstrip(b"-+")
+        names.append(option)
+        if name:
+          names.append(name)
+
+  elif b"_" in tag:
+    for word in tag.split():
+      if regex(rb"[A-Z][A-Z0-9]*(?:_[A-Z0-9]+)+\Z").match(word):
+        names.extend(subword for subword in word.split(b"_") if subword[:1].isalpha())
+
+  return names
+
+
+class TagIndex:
+  # The header lines (or "pseudo-tags") must sort before all tags, so tags
+  # starting with `!` are not added at all (less(1) ignores such lines anyway).
+  HEADER = b"!_TAG_FILE_SORTED\t1\t/0=unsorted, 1=sorted, 2=foldcase/\n"
+
+  def __init__(self) -> None:
+    self.entries = set()  # type: set[tuple[bytes, int]]
+
+  def add(self, tag: bytes, linenr: int) -> None:
+    for name in get_tag_names(tag):
+      self.entries.add((name, linenr))
+
+  def write(self, file: IO[bytes]) -> None:
+    file.write(self.HEADER)
+    file.write(b"".join([b"%s - %d\n" % entry for entry in sorted(self.entries)]))
+
+  # Atomically replaces the file at `path` with the current set of tags and
+  # returns the number of written bytes. less(1) re-opens the tags file on every
+  # lookup, so it will always see either the previous or the new version of the
+  # file, and never a partially written one.
+  def publish(self, path: str) -> int:
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+      with open(temp_path, "wb") as file:
+        self.write(file)
+        size = file.tell()
+      os.replace(temp_path, path)
+    except BaseException:
+      try:
+        os.unlink(temp_path)
+      except OSError:
+        pass
+      raise
+    return size
+
+
+# Reading and processing the input and feeding the results into the pager are
+# two separate jobs, which are done in parallel: the main thread parses and
+# colorizes the output of groff(1) and generates the tags, while this writer
+# thread sends everything that the main thread has produced so far to the pager
+# as soon as its end of the pipe becomes writable. When less(1) stops reading
+# (because it has filled the screen), the writer thread blocks in write(2), and
+# the processed text accumulates in memory until less(1) asks for more. Blocking
+# syscalls release the GIL, so the writer thread doesn't slow down the main one,
+# and, unlike making non-blocking writes every once in a while from the main
+# thread, this ensures that less(1) never waits for an iteration of the
+# processing loop to finish to receive more text.
+#
+# Signal handlers in Python are always executed on the main thread, and the
+# dispositions of SIGINT and SIGQUIT are per-process anyway, so the extra thread
+# does not affect how our process reacts to `CTRL+C` and `CTRL+\`.
+#
+# The amount of text kept in memory is bounded by `$DOTFILES_MANPAGER_MEMORY_LIMIT`
+# (in bytes), since huge generated documents or logs piped through the pager
+# would otherwise end up entirely in memory while less(1) is waiting for the
+# user to scroll down. Beyond that limit, the text is appended to a temporary
+# file instead (which is deleted right after being created, so it doesn't
+# outlive the process even if it crashes), and the writer thread reads it back
+# in chunks as the pager drains the pipe. Once some text has been spilled to the
+# file, everything that comes after it must go there as well to preserve the
+# order, until the writer thread catches up, at which point the file is
+# truncated and the text is buffered in memory again.
+class PagerWriter:
+  DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+  # The largest chunk that is read from the spill file or joined from the
+  # pending blocks to be written into the pipe at once.
+  CHUNK_SIZE = 1024 * 1024
+
+  def __init__(self, pager_stdin: IO[bytes]) -> None:
+    import threading
+
+    try:
+      self.memory_limit = int(
+        os.environ.get("DOTFILES_MANPAGER_MEMORY_LIMIT", self.DEFAULT_MEMORY_LIMIT)
+      )
+    except ValueError:
+      self.memory_limit = self.DEFAULT_MEMORY_LIMIT
+
+    self.pager_stdin = pager_stdin
+    self.pending = []  # type: list[bytes]
+    # Includes the data that is being written by the writer thread right now.
+    self.pending_size = 0
+    self.spill_file = None  # type: Optional[IO[bytes]]
+    # The region of the spill file which hasn't been written into the pipe yet.
+    self.spill_start = 0
+    self.spill_end = 0
+    self.spilled_bytes = 0
+    self.finished = False
+    self.broken = False
+    # An I/O error other than the pager exiting, which stopped the writer thread
+    # and is raised again by `close()`.
+    self.error = None  # type: Optional[OSError]
+    self.condition = threading.Condition()
+    # A daemon thread won't prevent the interpreter from exiting if the main
+    # thread crashes with an exception.
+    self.thread = threading.Thread(target=self.run, name="pager-writer", daemon=True)
+    self.thread.start()
+
+  def write(self, data: bytes) -> None:
+    with self.condition:
+      if self.broken:
+        return
+      spilled = False
+      if self.spill_start != self.spill_end or self.pending_size + len(data) > self.memory_limit:
+        spilled = self.spill(data)
+      if not spilled:
+        self.pending.append(data)
+        self.pending_size += len(data)
+      self.condition.notify()
+
+  # Must be called with the lock held. Returns `False` if the temporary file
+  # could not be created or written, in which case the limit is lifted and the
+  # data is kept in memory, but that is only possible while the file is empty.
+  def spill(self, data: bytes) -> bool:
+    try:
+      if not self.spill_file:
+        import tempfile
+
+        self.spill_file = tempfile.TemporaryFile(prefix="man-pager.")
+      fd = self.spill_file.fileno()
+      view = memoryview(data)
+      offset = self.spill_end
+      while view:
+        written = os.pwrite(fd, view, offset)
+        offset += written
+        view = view[written:]
+    except OSError:
+      if self.spill_start != self.spill_end:
+        raise
+      self.memory_limit = sys.maxsize
+      return False
+    self.spill_end = offset
+    self.spilled_bytes += len(data)
+    return True
+
+  # Waits until everything has been written, and closes the pipe.
+  def close(self) -> None:
+    with self.condition:
+      self.finished = True
+      self.condition.notify()
+    self.thread.join()
 
-    # We are done with the tags file, don't leave its file descriptor lingering around.
-    tags_file.close()
+    try:
+      self.pager_stdin.close()
+    except BrokenPipeError:
+      pass  # the stream will become closed even if we get EPIPE
 
-  if pager_stdin:
-    feed_input_into_pager(pager_stdin, [buffered_bytes])
+    if self.spill_file:
+      self.spill_file.close()
+
+    if self.error:
+      raise self.error
+
+  def run(self) -> None:
+    try:
+      self.write_everything()
+    except OSError as e:
+      # Either the pager has exited or the text can't be delivered to it anyway,
+      # so the main thread should stop producing it.
+      with self.condition:
+        self.broken = True
+        del self.pending[:]
+        if not isinstance(e, BrokenPipeError):
+          self.error = e
+
+  def write_everything(self) -> None:
+    # The buffered file object is bypassed, it is going to be empty anyway.
+    fd = self.pager_stdin.fileno()
+
+    while True:
+      with self.condition:
+        while not self.pending and self.spill_start == self.spill_end and not self.finished:
+          self.condition.wait()
+
+        if self.pending:
+          # The text in memory always precedes the text in the spill file.
+          count, size = 0, 0
+          while count < len(self.pending) and size < self.CHUNK_SIZE:
+            size += len(self.pending[count])
+            count += 1
+          data = memoryview(b"".join(self.pending[:count]))
+          del self.pending[:count]
+          spill_fd, spill_offset = -1, -1
+        elif self.spill_start != self.spill_end:
+          assert self.spill_file
+          data = memoryview(b"")  # read below
+          spill_fd = self.spill_file.fileno()
+          spill_offset = self.spill_start
+          size = min(self.spill_end - self.spill_start, self.CHUNK_SIZE)
+        else:
+          return
+
+      # Reading outside of the lock is fine: the main thread only ever appends
+      # to the file after `spill_end`.
+      if spill_offset >= 0:
+        data = memoryview(os.pread(spill_fd, size, spill_offset))
+        size = len(data)
+
+      while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+      with self.condition:
+        if spill_offset >= 0:
+          self.spill_start += size
+          if self.spill_start == self.spill_end:
+            # The writer has caught up, the disk space can be reclaimed.
+            assert self.spill_file
+            self.spill_start = self.spill_end = 0
+            os.ftruncate(self.spill_file.fileno(), 0)
+        else:
+          self.pending_size -= size
 
 
 def feed_input_into_pager(pager_stdin: IO[bytes], stream: Iterable["bytes | bytearray"]) -> None:
@@ -376,6 +866,332 @@ def feed_input_into_pager(pager_stdin: IO[bytes], stream: Iterable["bytes | byte
     pass  # the stream will become closed even if we get EPIPE
 
 
+def read_in_chunks(file: IO[bytes], chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+  return iter(functools.partial(file.read, chunk_size), b"")
+
+
+# Rendering a long manpage such as zshall(1) with groff(1), and then running it
+# through all of the post-processing done by this script takes a noticeable
+# amount of time, which is spent again every time the same manpage is opened
+# (and `fzf-man` from `zsh/functions.zsh` opens lots of them for its previews).
+# Therefore, the results of rendering a manpage requested with the
+# `<section> <page>` form of invocation are saved in an on-disk cache: every
+# entry consists of the colorized output and the tags file generated for it.
+#
+# The key of an entry consists of everything that can affect the output of
+# man(1) and this script: the section and the name of the page, the width of the
+# text (which man(1) takes from `$MANWIDTH` or the terminal), the path and the
+# modification time of the source code of the manpage as resolved by `man -w`,
+# the modification time of this script itself (which acts as its version number)
+# and some environment variables. Entries are stored under a name made up of the
+# section, page and width, and the full key is written at the top of the tags
+# file as a pseudo-tag, which less(1) will skip, and compared on lookups. This
+# avoids importing `hashlib`, which takes a surprising ~20 ms.
+#
+# The total size of the cache directory is bounded by evicting the least
+# recently used entries (an entry is "used" when its tags file gets touched upon
+# a cache hit). The limit can be set in bytes with `$DOTFILES_MANPAGER_CACHE_SIZE`,
+# setting it to 0 disables the cache completely.
+class RenderCache:
+  DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+  # The suffixes of the files of an entry, the colorized output and the tags.
+  SUFFIXES = (".txt", ".tags")
+
+  # Environment variables which have an effect on the output of man(1) or groff(1).
+  KEY_ENV_VARS = (
+    "LANG",
+    "LC_ALL",
+    "LC_CTYPE",
+    "LC_MESSAGES",
+    "MANOPT",
+    "MANPATH",
+    "MANROFFOPT",
+    "GROFF_NO_SGR",
+  )
+
+  def __init__(self, directory: str, name: str, key: str, max_size: int) -> None:
+    self.directory = directory
+    self.name = name
+    self.output_path = os.path.join(directory, name + ".txt")
+    self.tags_path = os.path.join(directory, name + ".tags")
+    self.key_line = b"!_TAG_CACHE_KEY\t" + key.encode(errors="surrogateescape") + b"\n"
+    self.max_size = max_size
+    self.temp_output = None  # type: Optional[IO[bytes]]
+    self.temp_output_path = ""
+
+  @staticmethod
+  def get_directory() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME", "") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "fancy-man-pager")
+
+  @classmethod
+  def get_max_size(cls) -> int:
+    try:
+      return int(os.environ.get("DOTFILES_MANPAGER_CACHE_SIZE", cls.DEFAULT_MAX_SIZE))
+    except ValueError:
+      return cls.DEFAULT_MAX_SIZE
+
+  @staticmethod
+  def get_width() -> str:
+    # This is the same order in which man-db determines the line length.
+    width = os.environ.get("MANWIDTH", "")
+    if not width.isdigit():
+      from dotfiles.terminal_utils import get_terminal_size
+
+      width = str(get_terminal_size(sys.stdout.fileno())[0] or 80)
+    return width
+
+  @classmethod
+  def for_manpage(cls, section: str, page: str) -> "Optional[RenderCache]":
+    max_size = cls.get_max_size()
+    if max_size <= 0:
+      return None
+
+    import subprocess
+
+    try:
+      where = subprocess.run(
+        ["man", "-w", "--", section, page],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True,
+      )
+      source_path = where.stdout.splitlines()[0]
+      source_mtime = os.stat(source_path).st_mtime_ns
+      script_mtime = os.stat(__file__).st_mtime_ns
+    except (OSError, IndexError, subprocess.CalledProcessError):
+      return None  # Let man(1) itself report that the page doesn't exist
+
+    width = cls.get_width()
+    key = repr((
+      section,
+      page,
+      width,
+      source_path,
+      source_mtime,
+      script_mtime,
+      [os.environ.get(name) for name in cls.KEY_ENV_VARS],
+    ))
+    name = "{}.{}.{}".format(page, section, width).replace(os.sep, "%")
+    return cls(cls.get_directory(), name, key, max_size)
+
+  def is_fresh(self) -> bool:
+    try:
+      with open(self.tags_path, "rb") as tags_file:
+        return tags_file.readline() == self.key_line
+    except OSError:
+      return False
+
+  def load(self) -> Optional[IO[bytes]]:
+    if not self.is_fresh():
+      return None
+    try:
+      output = open(self.output_path, "rb")
+    except OSError:
+      return None
+
+    try:
+      os.utime(self.tags_path)  # Mark the entry as recently used
+    except OSError:
+      pass
+
+    return output
+
+  def _temp_path(self, suffix: str) -> str:
+    # Temporary files are hidden, that's how they are told apart from real entries.
+    return os.path.join(self.directory, ".{}.{}{}.tmp".format(self.name, os.getpid(), suffix))
+
+  def begin(self) -> Optional[IO[bytes]]:
+    try:
+      os.makedirs(self.directory, mode=0o700, exist_ok=True)
+      self.temp_output_path = self._temp_path(".txt")
+      self.temp_output = open(self.temp_output_path, "wb")
+    except OSError:
+      return None
+    return self.temp_output
+
+  def abort(self) -> None:
+    if self.temp_output:
+      self.temp_output.close()
+      self.temp_output = None
+      try:
+        os.unlink(self.temp_output_path)
+      except OSError:
+        pass
+
+  def commit(self, tags_path: str, with_eviction: bool = True) -> None:
+    if not self.temp_output:
+      return
+
+    temp_tags_path = self._temp_path(".tags")
+    try:
+      self.temp_output.close()
+      with open(tags_path, "rb") as src, open(temp_tags_path, "wb") as dest:
+        dest.write(self.key_line)
+        dest.write(src.read())
+      # The tags file is replaced last because it contains the key, so the
+      # entry becomes valid only when both of its files are in place.
+      os.replace(self.temp_output_path, self.output_path)
+      os.replace(temp_tags_path, self.tags_path)
+      self.temp_output = None
+    except OSError:
+      try:
+        os.unlink(temp_tags_path)
+      except OSError:
+        pass
+      self.abort()
+      return
+
+    if with_eviction:
+      from dotfiles.cache_utils import evict
+
+      evict(self.directory, self.max_size, self.SUFFIXES)
+
+
+# `--warm` pre-renders whole sections of the manual into the `RenderCache`, so
+# that afterwards every `man` and every preview of `fzf-man` is a cache hit
+# (it's meant to be run after installing or upgrading packages). The pages are
+# enumerated with apropos(1) and named in the same way as `fzf-man` does it, so
+# that the cache keys match. A requested section also includes the sections
+# with a suffix, e.g. `3` includes `3ssl` and `3p`, and no sections mean all of
+# them. Most of the time goes into groff(1) and the post-processing of its
+# output, so the pages are rendered in a pool of processes, one per CPU core.
+# Entries that are already fresh are skipped. Note that the width of the text is
+# a part of the cache key: `fzf-man` renders its previews with `$MANWIDTH` set
+# to the width of the preview window, so `MANWIDTH=<columns> fancy-man-pager
+# --warm` is needed to warm the cache for those. Warming up large sections may
+# also require raising `$DOTFILES_MANPAGER_CACHE_SIZE`, otherwise the pages
+# rendered first will be evicted by the later ones.
+def warm_render_cache(sections: "list[str]", program_name: str) -> None:
+  import multiprocessing
+  import signal
+  import subprocess
+  import time
+
+  from dotfiles.cache_utils import evict
+
+  max_size = RenderCache.get_max_size()
+  if max_size <= 0:
+    sys.exit("{}: the cache is disabled by $DOTFILES_MANPAGER_CACHE_SIZE".format(program_name))
+
+  try:
+    apropos = subprocess.run(
+      ["apropos", "."],
+      stdin=subprocess.DEVNULL,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.DEVNULL,
+      check=True,
+    )
+  except (OSError, subprocess.CalledProcessError) as err:
+    sys.exit("{}: failed to list the manpages: {}".format(program_name, err))
+
+  manpages = set()  # type: set[tuple[str, str]]
+  for match in regex(rb"^\s*(\S+)\s*\((\w+)\)", re.MULTILINE).finditer(apropos.stdout):
+    page, section = os.fsdecode(match.group(1)), os.fsdecode(match.group(2))
+    if not sections or any(section.startswith(requested) for requested in sections):
+      manpages.add((section, page))
+
+  # Determined once here, so that the workers don't have to query the terminal
+  # and man(1) renders the pages exactly at the width recorded in the keys.
+  os.environ["MANWIDTH"] = RenderCache.get_width()
+  os.environ["MAN_KEEP_FORMATTING"] = "1"
+
+  show_progress = sys.stderr.isatty()
+  counts = {"rendered": 0, "fresh": 0, "failed": 0}
+  start_time = time.perf_counter()
+
+  def report(done: int, end: str) -> None:
+    elapsed = time.perf_counter() - start_time
+    message = "{}: {}/{} pages, {:.1f} pages/s ({} rendered, {} fresh, {} failed)".format(
+      program_name,
+      done,
+      len(manpages),
+      done / elapsed if elapsed > 0 else 0.0,
+      counts["rendered"],
+      counts["fresh"],
+      counts["failed"],
+    )
+    # On a terminal the progress is shown by overwriting a single line.
+    sys.stderr.write("\r" + message + "\x1b[K" + end if show_progress else message + end)
+    sys.stderr.flush()
+
+  done = 0
+  pool = multiprocessing.Pool(initializer=init_warm_worker)
+  try:
+    for result in pool.imap_unordered(warm_manpage, sorted(manpages)):
+      counts[result] += 1
+      done += 1
+      if show_progress:
+        report(done, "")
+    pool.close()
+  except KeyboardInterrupt:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pool.terminate()
+    if show_progress:
+      sys.stderr.write("\n")
+    sys.exit(0x80 + signal.SIGINT)
+  finally:
+    pool.join()
+
+  report(done, "\n")
+
+  # Eviction is done once at the end instead of after every rendered page.
+  evicted = evict(RenderCache.get_directory(), max_size, RenderCache.SUFFIXES)
+  if evicted:
+    sys.stderr.write(
+      "{}: {} entries did not fit into the cache, raise $DOTFILES_MANPAGER_CACHE_SIZE "
+      "(currently {} bytes)\n".format(program_name, evicted, max_size)
+    )
+
+
+# `CTRL+C` is handled only by the main process, which terminates the workers,
+# instead of every worker printing its own traceback. Upon termination, a
+# worker exits through `SystemExit`, which removes the temporary files of the
+# entry it was rendering.
+def init_warm_worker() -> None:
+  import signal
+
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, lambda signal_nr, frame: sys.exit(0x80 + signal_nr))
+
+
+# Runs in the worker processes of `warm_render_cache`.
+def warm_manpage(manpage: "tuple[str, str]") -> str:
+  section, page = manpage
+  render_cache = RenderCache.for_manpage(section, page)
+  if not render_cache:
+    return "failed"
+  if render_cache.is_fresh():
+    return "fresh"
+
+  import subprocess
+  import tempfile
+
+  output_copy = render_cache.begin()
+  if not output_copy:
+    return "failed"
+
+  try:
+    man = subprocess.Popen(
+      ["man", "--", section, page],
+      stdin=subprocess.DEVNULL,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.DEVNULL,
+    )
+    with man, tempfile.NamedTemporaryFile(prefix="man-tags.") as tags_file:
+      assert man.stdout
+      generate_tags_and_feed_into_less(None, man.stdout, tags_file.name, "", output_copy)
+      if man.wait() == 0:
+        render_cache.commit(tags_file.name, with_eviction=False)
+        return "rendered"
+  except OSError:
+    pass
+  finally:
+    render_cache.abort()
+  return "failed"
+
+
 # `re.compile()` has its own cache, but wrapping it in `lru_cache()` somehow leads to a speedup.
 regex = functools.lru_cache(maxsize=None)(re.compile) if not TYPE_CHECKING else re.compile
 
@@ -400,9 +1216,9 @@ RESET_COLOR = b"\x1b[39m"
 # its output for display in a terminal:
 # <https://cgit.git.savannah.gnu.org/cgit/groff.git/tree/src/devices/grotty/tty.cpp?h=1.23.0>
 # (you can check all ANSI control sequences that it uses).
-def colorize_line(line: bytes) -> bytes:
-  has_escape_codes = 0x1B in line
-
+#
+# It works on blocks consisting of whole lines, see `read_blocks()`.
+def colorize_block(block: bytes) -> bytes:
   # Highlight Unicode box-drawing characters used for drawing tables in a bright
   # gray color, to make them slightly dimmer than regular white-colored text.
   # Fortunately, all of them are neatly packed in a single area of the Unicode
@@ -410,20 +1226,22 @@ def colorize_line(line: bytes) -> bytes:
   # bytes, without needing to decode the whole line (assuming, of course, that
   # it is encoded with UTF-8).
   # <https://en.wikipedia.org/wiki/Box-drawing_characters#Box_Drawing>
-  if 0xE2 in line and (b"\xe2\x94" in line or b"\xe2\x95" in line):
+  if 0xE2 in block and (b"\xe2\x94" in block or b"\xe2\x95" in block):
     # Try to find uninterrupted runs of these characters
-    line = regex(rb"((?:\xe2[\x94-\x95][\x80-\xbf])+)").sub(ANSI_GRAY + rb"\1" + RESET_COLOR, line)
+    block = regex(rb"((?:\xe2[\x94-\x95][\x80-\xbf])+)").sub(
+      ANSI_GRAY + rb"\1" + RESET_COLOR, block
+    )
 
   # Since the whole point of my colorization algorithm is that it relies on
   # parsing the ANSI control sequences, which must start with the ESC character,
   # we can avoid wasting time on evaluation of the regular expressions used to
-  # find them if the line doesn't contain any ESC characters in the first place.
-  if not has_escape_codes:
-    return line
+  # find them if the text doesn't contain any ESC characters in the first place.
+  if 0x1B not in block:
+    return block
 
   # Remove redundant control sequences which cancel each other out:
-  line = line.replace(ANSI_END_BOLD + ANSI_BEGIN_BOLD, b"")
-  line = line.replace(ANSI_END_UNDERLINE + ANSI_BEGIN_UNDERLINE, b"")
+  block = block.replace(ANSI_END_BOLD + ANSI_BEGIN_BOLD, b"")
+  block = block.replace(ANSI_END_UNDERLINE + ANSI_BEGIN_UNDERLINE, b"")
 
   # Sometimes grotty(1) and my `process_backspaces()` function will output
   # control sequences in an unintuitive manner: if, say, a piece of underlined
@@ -436,24 +1254,59 @@ def colorize_line(line: bytes) -> bytes:
   # breaks my simplistic parser - this can be easily observed in manpages such
   # as printf(3). To fix this, I just untangle such combinations of sequences.
   # TODO: This bug still manifests itself in roff(7)
-  line = line.replace(ANSI_BEGIN_BOLD + ANSI_END_UNDERLINE, ANSI_END_UNDERLINE + ANSI_BEGIN_BOLD)
-  line = line.replace(ANSI_BEGIN_UNDERLINE + ANSI_END_BOLD, ANSI_END_BOLD + ANSI_BEGIN_UNDERLINE)
-
-  # Colorize references to other manpages
-  line = regex(rb"(\x1b\[[134]m)([^\x1b\s]+)(\x1b\[2[234]m)\(([0-9]+[a-zA-Z]*)\)").sub(
-    rb"\1" + ANSI_CYAN + rb"\2" + RESET_COLOR + rb"\3" + ANSI_YELLOW + rb"(\4)" + RESET_COLOR, line
-  )
-
-  # Make all italic and underlined text green
-  line = regex(rb"(\x1b\[[34]m)([^\x1b]+)").sub(rb"\1" + ANSI_GREEN + rb"\2" + RESET_COLOR, line)
-
-  line = regex(rb"\x1b\[1m([^\x1b]+)").sub(bold_text_highlighter, line)
+  block = block.replace(ANSI_BEGIN_BOLD + ANSI_END_UNDERLINE, ANSI_END_UNDERLINE + ANSI_BEGIN_BOLD)
+  block = block.replace(ANSI_BEGIN_UNDERLINE + ANSI_END_BOLD, ANSI_END_BOLD + ANSI_BEGIN_UNDERLINE)
+
+  # All of the formatted pieces of text are found and colorized in a single
+  # pass of this regex. The order of the alternatives matters, references to
+  # manpages must take precedence over the other two. A run of formatted text
+  # can extend to the end of the line, in which case it includes the line
+  # terminator, but it never goes past it. The common prefix `ESC [` has been
+  # factored out of the alternatives because the regex engine can then search
+  # for it as a literal string, which is several times faster.
+  return regex(
+    rb"\x1b\[(?:"
+    # Colorize references to other manpages
+    rb"([134]m)([^\x1b\s]+)(\x1b\[2[234]m)\(([0-9]+[a-zA-Z]*)\)"
+    # Make all italic and underlined text green
+    rb"|([34]m)([^\x1b\n]+\n?|\n)"
+    # Bold text is colored based on what it looks like
+    rb"|1m([^\x1b\n]+\n?|\n)"
+    rb")"
+  ).sub(formatted_text_colorizer, block)
+
+
+# Manpages repeat the same terms and option names over and over again, so the
+# results of colorizing every distinct piece of formatted text are memoized.
+colorized_text_memo = {}  # type: dict[bytes, bytes]
+
+
+def formatted_text_colorizer(match: "re.Match[bytes]") -> bytes:
+  text = match.group(0)  # type: bytes
+  colorized = colorized_text_memo.get(text)
+  if colorized is not None:
+    return colorized
+
+  if match.group(1):
+    colorized = b"".join((
+      b"\x1b[" + match.group(1),
+      ANSI_CYAN + match.group(2) + RESET_COLOR,
+      match.group(3),
+      ANSI_YELLOW + b"(" + match.group(4) + b")" + RESET_COLOR,
+    ))
+  elif match.group(5):
+    colorized = b"\x1b[" + match.group(5) + ANSI_GREEN + match.group(6) + RESET_COLOR
+  else:
+    colorized = bold_text_highlighter(match.group(7))
 
-  return line
+  # Don't let the memo grow without bounds when huge documents are processed.
+  if len(colorized_text_memo) >= 0x4000:
+    colorized_text_memo.clear()
+  colorized_text_memo[text] = colorized
+  return colorized
 
 
-def bold_text_highlighter(match: "re.Match[bytes]") -> bytes:
-  text_bytes = match.group(1)  # type: bytes
+def bold_text_highlighter(text_bytes: bytes) -> bytes:
   color = ANSI_BLUE  # by default, all bold text is colored blue
   flag_re = regex(rb"^[-+][^\s]")
   if flag_re.match(text_bytes.strip()):
@@ -476,6 +1329,98 @@ def bold_text_highlighter(match: "re.Match[bytes]") -> bytes:
   return ANSI_BEGIN_BOLD + color + text_bytes + RESET_COLOR
 
 
+JSON_COLOR_CLASSES = {
+  ANSI_RED: "flag",
+  ANSI_GREEN: "emphasis",
+  ANSI_YELLOW: "subheading",
+  ANSI_BLUE: "term",
+  ANSI_MAGENTA: "heading",
+  ANSI_CYAN: "reference",
+  ANSI_GRAY: "table",
+}
+JSON_COLOR_STYLES = frozenset(JSON_COLOR_CLASSES.values())
+
+# The on and off switches of the attributes that can be set by SGR sequences
+# in the output of `colorize_block()`, the colors are handled separately.
+JSON_SGR_ATTRIBUTES = {
+  b"\x1b[1m": ("bold", True),
+  b"\x1b[22m": ("bold", False),
+  b"\x1b[3m": ("italic", True),
+  b"\x1b[23m": ("italic", False),
+  b"\x1b[4m": ("underline", True),
+  b"\x1b[24m": ("underline", False),
+}
+
+
+# Splits a line of colorized text into the plain text and the spans of styles
+# applied to it. `styles` maps the currently active styles to the columns where
+# they have started, it is updated in place since the styles carry over to the
+# following lines, like they do in a terminal.
+def convert_ansi_to_spans(
+  line: bytes, styles: "dict[str, int]"
+) -> "tuple[str, list[tuple[int, int, str]]]":
+  if not styles and 0x1B not in line:
+    return line.decode(errors="replace"), []  # Plain text, nothing to do
+
+  spans = []  # type: list[tuple[int, int, str]]
+  text_parts = []  # type: list[str]
+  col = 0
+  for style in styles:
+    styles[style] = 0
+
+  def end_style(style: str) -> None:
+    start = styles.pop(style)
+    if start < col:
+      spans.append((start, col, style))
+
+  for i, part in enumerate(regex(rb"(\x1b\[[0-9;]*m)").split(line)):
+    if i % 2 == 0:
+      if part:
+        text = part.decode(errors="replace")
+        text_parts.append(text)
+        col += len(text.encode())
+      continue
+
+    attribute = JSON_SGR_ATTRIBUTES.get(part)
+    if attribute is not None:
+      style, enable = attribute
+      if enable and style not in styles:
+        styles[style] = col
+      elif not enable and style in styles:
+        end_style(style)
+      continue
+
+    color_class = JSON_COLOR_CLASSES.get(part)
+    if color_class is None and part not in (RESET_COLOR, b"\x1b[0m"):
+      continue  # Something that doesn't come from the colorizer
+
+    for style in JSON_COLOR_STYLES.intersection(styles):
+      end_style(style)
+    if part == b"\x1b[0m":
+      for style in list(styles):
+        end_style(style)
+
+    if color_class is not None:
+      start = col
+      if color_class == "subheading":
+        # The section number in a reference to a manpage, e.g. `(1)` in
+        # `ls(1)`, is colored differently, but belongs to the same reference.
+        for j in range(len(spans) - 1, -1, -1):
+          if spans[j][1] != col:
+            break
+          if spans[j][2] == "reference":
+            color_class = "reference"
+            start = spans.pop(j)[0]
+            break
+      styles[color_class] = start
+
+  for style, start in styles.items():
+    if start < col:
+      spans.append((start, col, style))
+  spans.sort()
+  return "".join(text_parts), spans
+
+
 # Mandoc's man(1) and old versions of groff(1) use a legacy method of text
 # formatting called "overstriking", which exploits the characteristics of old
 # paper-based teletype terminals (for which the first roff system was originally
@@ -521,11 +1466,159 @@ def bold_text_highlighter(match: "re.Match[bytes]") -> bytes:
 # How less(1) handles overstriking:
 # <https://github.com/gwsw/less/blob/v688/line.c#L1266-L1330>
 #
-# TODO: this function does not handle combining characters
+# Combining characters are drawn in the same cell as the character preceding
+# them, so a backspace after them moves the cursor back over the whole cluster,
+# and overstriking e.g. a decomposed `é` looks like `e\u0301 BS e\u0301`.
+# However, some formatters treat every codepoint as a separate cell and
+# overstrike the combining characters on their own, like `e BS e \u0301 BS
+# \u0301`, so a combining character followed by a backspace and another
+# combining character is not attached to the preceding character. These are the
+# blocks of combining diacritical marks, which are the ones that can
+# realistically appear in manpages.
+COMBINING_CHARS = "\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f"
+ATTACHED_COMBINING_CHAR_REGEX = "[" + COMBINING_CHARS + "](?!\b[" + COMBINING_CHARS + "])"
+CHAR_CLUSTER_REGEX = "\b|[^\b](?:" + ATTACHED_COMBINING_CHAR_REGEX + ")*"
+# A character (with its combining marks) that can take part in the common forms
+# of overstriking. Underscores are excluded because they are ambiguous (see
+# below), and so are the control characters that can't be overstruck anyway.
+OVERSTRUCK_CHAR_REGEX = "[^\x00-\x08\n_](?:" + ATTACHED_COMBINING_CHAR_REGEX + ")*"
+# Makes sure that a backreference to the character above has matched the whole
+# cluster and not just its prefix.
+NO_COMBINING_CHARS_REGEX = "(?!" + ATTACHED_COMBINING_CHAR_REGEX + ")"
+OVERSTRIKING_RUNS_REGEX = (
+  # Every run is matched starting from its first backspace, and the character
+  # before it is checked with a lookbehind. This lets the regex engine skip over
+  # the plain text by quickly searching for backspaces, which is much faster
+  # than attempting to match a run at every single position.
+  # `{c}` stands for `OVERSTRUCK_CHAR_REGEX` and `{n}` for `NO_COMBINING_CHARS_REGEX`.
+  "\b(?:(?<=_\b)(?:"
+  # A run of bold underlined characters: `_ BS X BS X`
+  "(({c})\b\\2{n}(?:_\b({c})\b\\3{n})*)"
+  # A run of underlined characters: `_ BS X`, not followed by another `BS X`,
+  # which would make it bold as well.
+  "|({c}(?!\b)(?:_\b{c}(?!\b))*)"
+  # An underscore overstruck with itself (once, or twice when it is both bold
+  # and underlined), which can be either bold or underlined.
+  "|_(?:\b_)*)"
+  # A run of bold characters: `X BS X`
+  "|((?<=([^\x00-\x08\n_])\b)\\6{n}(?:({c})\b\\7{n})*))"
+).format(c=OVERSTRUCK_CHAR_REGEX, n=NO_COMBINING_CHARS_REGEX)
+OVERSTRIKING_REMOVAL_REGEX = "\b" + OVERSTRUCK_CHAR_REGEX
+
+ATTR_BOLD = 1
+ATTR_UNDERLINE = 2
+# The sequences for switching between every two combinations of attributes,
+# indexed as `ATTR_TRANSITIONS[old_attrs][new_attrs]`. When both attributes
+# change at once, the sequence for bold comes first.
+ATTR_TRANSITIONS = [
+  [
+    (("\x1b[1m" if new & ATTR_BOLD else "\x1b[22m") if (old ^ new) & ATTR_BOLD else "")
+    + (("\x1b[4m" if new & ATTR_UNDERLINE else "\x1b[24m") if (old ^ new) & ATTR_UNDERLINE else "")
+    for new in range(4)
+  ]
+  for old in range(4)
+]
+
+
+def perform_overstriking_in_block(block: bytes) -> bytes:
+  if 0x08 not in block:
+    return block
+  # The whole block is first given to the fast path, which can handle the
+  # overwhelming majority of pages in one go. If it bails out, only the lines
+  # containing something unusual need to go through the slow path.
+  text = block.decode(errors="surrogateescape")
+  result = perform_simple_overstriking(text)
+  if result is not None:
+    return result.encode(errors="surrogateescape")
+  # Line terminators are excluded from overstriking, otherwise a newline
+  # following a backspace would have replaced the character before it.
+  return b"\n".join([
+    perform_overstriking(line) if 0x08 in line else line for line in block.split(b"\n")
+  ])
+
+
 def perform_overstriking(line: bytes) -> bytes:
   if 0x08 not in line:
     return line  # Don't bother if the text does not contain backspaces.
 
+  # `process(some_bytes.decode("surrogateescape")).encode("surrogateescape")`
+  # allows passing invalid bytes that could not be decoded through unchanged.
+  # More information here:
+  # <https://docs.python.org/3/howto/unicode.html#files-in-an-unknown-encoding>
+  text = line.decode(errors="surrogateescape")
+  result = perform_simple_overstriking(text)
+  if result is None:
+    result = perform_arbitrary_overstriking(text)
+  return result.encode(errors="surrogateescape")
+
+
+# The fast path for overstriking, which understands only the forms actually
+# produced by grotty(1) and mandoc: `X BS X` for bold text, `_ BS X` for
+# underlined text, `_ BS X BS X` for both, and `_ BS _`. Instead of walking the
+# text one character at a time, it finds whole runs of bold or underlined
+# characters with a regex, so the Python code below runs once per word and not
+# once per character. The result is identical to what the slow path would have
+# produced, and if the text contains any other usage of backspaces, None is
+# returned, leaving it to the slow path.
+def perform_simple_overstriking(text: str) -> Optional[str]:
+  output = []  # type: list[str]
+  attrs = 0  # The attributes of the last character written to the output
+  pos = 0
+
+  def append_plain_text(plain: str) -> bool:
+    nonlocal attrs
+    if "\b" in plain:
+      return False
+    if attrs & ATTR_BOLD and plain.startswith(" "):
+      # Spaces after bold text are combined into the same run of bold text, see
+      # the corresponding comment in the slow path.
+      spaces_count = len(plain) - len(plain.lstrip(" "))
+      output.append(ATTR_TRANSITIONS[attrs][ATTR_BOLD])
+      output.append(plain[:spaces_count])
+      attrs = ATTR_BOLD
+      plain = plain[spaces_count:]
+    if plain:
+      output.append(ATTR_TRANSITIONS[attrs][0])
+      output.append(plain)
+      attrs = 0
+    return True
+
+  for match in regex(OVERSTRIKING_RUNS_REGEX).finditer(text):
+    # The match begins at the first backspace, one character into the run.
+    start = match.start() - 1
+    if start < pos:
+      return None  # Overstriking the last character of the previous run again
+    if start > pos and not append_plain_text(text[pos:start]):
+      return None
+    pos = match.end()
+
+    run_type = match.lastindex
+    if run_type == 1:
+      new_attrs = ATTR_BOLD | ATTR_UNDERLINE
+    elif run_type == 4:
+      new_attrs = ATTR_UNDERLINE
+    elif run_type == 5:
+      new_attrs = ATTR_BOLD
+    else:
+      # An underscore overstruck with itself copies the attributes of the
+      # previous character, or becomes bold if there are none.
+      new_attrs = attrs if attrs != 0 else ATTR_BOLD
+
+    output.append(ATTR_TRANSITIONS[attrs][new_attrs])
+    output.append(text[start:pos])
+    attrs = new_attrs
+
+  if pos < len(text) and not append_plain_text(text[pos:]):
+    return None
+  output.append(ATTR_TRANSITIONS[attrs][0])
+  # Neither the plain text nor the inserted sequences contain backspaces, so the
+  # overstriking can be removed from all runs at once. What remains after
+  # removing the underscores is `X BS X`.
+  result = "".join(output).replace("_\b", "")
+  return regex(OVERSTRIKING_REMOVAL_REGEX).sub("", result)
+
+
+def perform_arbitrary_overstriking(line: str) -> str:
   # These two variables are arrays of logical values which represent the bold
   # and underlined states of every cell in the current line. And what better way
   # to represent what is effectively a list of booleans than a bitset!
@@ -540,11 +1633,9 @@ def perform_overstriking(line: bytes) -> bytes:
   colnr = 0
   max_col = 0
 
-  # `process(some_bytes.decode("surrogateescape")).encode("surrogateescape")`
-  # allows passing invalid bytes that could not be decoded through unchanged.
-  # More information here:
-  # <https://docs.python.org/3/howto/unicode.html#files-in-an-unknown-encoding>
-  for char in line.decode(errors="surrogateescape"):
+  # Characters are processed together with the combining marks following them,
+  # since those occupy the same cell.
+  for char in regex(CHAR_CLUSTER_REGEX).findall(line):
     if char == "\b":
       colnr -= 1
 
@@ -632,7 +1723,7 @@ def perform_overstriking(line: bytes) -> bytes:
       output.insert(shift + colnr, "\x1b[4m" if is_underlined & column_mask else "\x1b[24m")
       shift += 1
 
-  return "".join(output).encode(errors="surrogateescape")
+  return "".join(output)
 
 
 if __name__ == "__main__":
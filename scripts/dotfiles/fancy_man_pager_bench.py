@@ -0,0 +1,264 @@
+# A benchmark for the hot path of `fancy_man_pager.py`, which runs for every
+# single invocation of man(1), so its regressions are felt immediately. Each
+# stage of processing (overstriking, tag extraction, colorization, highlighting
+# of bold text, and the whole pipeline) is timed separately on a corpus of
+# grotty(1) output, and the throughput is reported in lines and megabytes per
+# second (for `bold_text_highlighter` the "lines" are the runs of bold text it
+# is called on).
+#
+# The corpus can be captured from real manpages like this:
+#
+#     MAN_KEEP_FORMATTING=1 MANWIDTH=80 man 1 zshall > zshall.sgr
+#     GROFF_NO_SGR=1 MAN_KEEP_FORMATTING=1 MANWIDTH=80 man 1 bash > bash.overstrike
+#
+# and passed to this script as arguments. Without arguments a fixed corpus is
+# generated, which mimics the output of grotty(1) in the SGR mode, in the legacy
+# overstriking mode (`GROFF_NO_SGR=1`), pages with lots of tables drawn with
+# box-drawing characters, and a huge page (several times larger than zshall(1)).
+# The overstriking stage is timed only on the corpora which contain overstriking.
+# Results can be saved with `--save-baseline` and compared to a saved baseline
+# with `--baseline`, in which case the exit code is 1 if any stage has become
+# slower by more than `--threshold` percent.
+
+import argparse
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+from dotfiles import fancy_man_pager
+
+ANSI_BOLD = "\x1b[1m"
+ANSI_UNDERLINE = "\x1b[4m"
+ANSI_END_BOLD = "\x1b[22m"
+ANSI_END_UNDERLINE = "\x1b[24m"
+
+WORDS = (
+  "the a of to is in that it for as with be on by this are or which file command shell "
+  "variable value expansion option argument string name list function parameter builtin "
+  "returns status output input directory pattern history completion default"
+).split()
+
+
+def generate_page(rng: random.Random, lines_count: int, tables: bool = False) -> bytes:
+  def bold(text: str) -> str:
+    return ANSI_BOLD + text + ANSI_END_BOLD
+
+  def underline(text: str) -> str:
+    return ANSI_UNDERLINE + text + ANSI_END_UNDERLINE
+
+  def paragraph_line() -> str:
+    words: List[str] = []
+    for _ in range(rng.randint(6, 12)):
+      word = rng.choice(WORDS)
+      kind = rng.random()
+      if kind < 0.06:
+        word = bold("--" + word)
+      elif kind < 0.12:
+        word = underline(word)
+      elif kind < 0.15:
+        word = bold(word) + "({})".format(rng.randint(1, 8))
+      elif kind < 0.17:
+        word = bold(word.upper())
+      words.append(word)
+    return "       " + " ".join(words)
+
+  lines: List[str] = []
+  while len(lines) < lines_count:
+    lines.append(bold(" ".join(rng.choice(WORDS) for _ in range(2)).upper()))
+    for _ in range(rng.randint(2, 6)):
+      lines.append("   " + bold(rng.choice(WORDS).title() + " " + rng.choice(WORDS).title()))
+      lines.append("")
+      for _ in range(rng.randint(3, 10)):
+        flag = rng.choice(WORDS)
+        lines.append(
+          "       {}, {}={}".format(bold("-" + flag[0]), bold("--" + flag), underline("ARG"))
+        )
+        lines.extend(paragraph_line() for _ in range(rng.randint(1, 6)))
+        lines.append("")
+
+      if tables:
+        widths = [rng.randint(6, 16) for _ in range(rng.randint(2, 4))]
+        lines.append("       ┌" + "┬".join("─" * w for w in widths) + "┐")
+        for row in range(rng.randint(2, 8)):
+          if row == 1:
+            lines.append("       ├" + "┼".join("─" * w for w in widths) + "┤")
+          cells = [rng.choice(WORDS)[: w - 2].ljust(w - 2) for w in widths]
+          if row == 0:
+            cells = [bold(cell) for cell in cells]
+          lines.append("       │ " + " │ ".join(cells) + " │")
+        lines.append("       └" + "┴".join("─" * w for w in widths) + "┘")
+        lines.append("")
+
+  return "\n".join(lines[:lines_count]).encode() + b"\n"
+
+
+# Converts the SGR sequences for bold and underlined text into overstriking,
+# like grotty(1) does when `GROFF_NO_SGR=1` is set.
+def convert_to_overstriking(page: bytes) -> bytes:
+  result: List[str] = []
+  is_bold = is_underlined = False
+  for i, chunk in enumerate(re.split(r"\x1b\[(\d+)m", page.decode())):
+    if i % 2 == 1:
+      is_bold = chunk == "1" or (is_bold and chunk not in ("22", "0"))
+      is_underlined = chunk == "4" or (is_underlined and chunk not in ("24", "0"))
+      continue
+    for char in chunk:
+      if char != "\n" and (is_bold or is_underlined):
+        if is_underlined:
+          result.append("_\b")
+        result.append(char + "\b" + char if is_bold else char)
+      else:
+        result.append(char)
+  return "".join(result).encode()
+
+
+def generate_corpus() -> Dict[str, bytes]:
+  rng = random.Random(1)
+  regular = generate_page(rng, 8000)
+  return {
+    "sgr": regular,
+    "overstrike": convert_to_overstriking(regular),
+    "tables": generate_page(rng, 8000, tables=True),
+    "huge": generate_page(rng, 80000),
+  }
+
+
+def run_benchmark(data: bytes, repeat: int) -> Dict[str, Tuple[float, int, int]]:
+  pager = fancy_man_pager
+  blocks = list(pager.read_blocks(io.BytesIO(data)))
+  overstruck_blocks = [pager.perform_overstriking_in_block(block) for block in blocks]
+  bold_runs: List[bytes] = [
+    run for block in overstruck_blocks for run in re.findall(rb"\x1b\[1m([^\x1b\n]+)", block)
+  ]
+  lines_count = data.count(b"\n")
+
+  def stage_overstriking() -> None:
+    for block in blocks:
+      pager.perform_overstriking_in_block(block)
+
+  def stage_tags() -> None:
+    linenr = 1
+    tag_index = pager.TagIndex()
+    for block in overstruck_blocks:
+      tags, linenr = pager.extract_tags(block, linenr)
+      for tag, tag_linenr in tags:
+        tag_index.add(tag, tag_linenr)
+    tag_index.write(io.BytesIO())
+
+  def stage_colorizing() -> None:
+    for block in overstruck_blocks:
+      pager.colorize_block(block)
+
+  def stage_bold_text_highlighter() -> None:
+    for run in bold_runs:
+      pager.bold_text_highlighter(run)
+
+  def stage_pipeline() -> None:
+    pager.generate_tags_and_feed_into_less(
+      None, io.BytesIO(data), tags_path, "bench", output_copy=io.BytesIO()
+    )
+
+  stages: List[Tuple[str, Callable[[], None], int, int]] = []
+  # Without backspaces the overstriking stage does nothing but a quick search,
+  # so its throughput would be meaningless and too noisy to compare.
+  if b"\b" in data:
+    stages.append(("overstriking", stage_overstriking, lines_count, len(data)))
+  stages += [
+    ("tags", stage_tags, lines_count, len(data)),
+    ("colorizing", stage_colorizing, lines_count, len(data)),
+    (
+      "bold_text_highlighter",
+      stage_bold_text_highlighter,
+      len(bold_runs),
+      sum(map(len, bold_runs)),
+    ),
+    ("pipeline", stage_pipeline, lines_count, len(data)),
+  ]
+
+  results: Dict[str, Tuple[float, int, int]] = {}
+  with tempfile.TemporaryDirectory() as temp_dir:
+    tags_path = os.path.join(temp_dir, "tags")
+    for name, func, items_count, bytes_count in stages:
+      best_time = float("inf")
+      for _ in range(repeat):
+        # The memo would make every run except the first one unrealistically fast.
+        pager.colorized_text_memo.clear()
+        start_time = time.perf_counter()
+        func()
+        best_time = min(best_time, time.perf_counter() - start_time)
+      results[name] = (best_time, items_count, bytes_count)
+  return results
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser()
+  parser.add_argument("corpus", nargs="*", help="files with captured output of man(1)")
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--baseline", help="compare the results with a saved baseline")
+  parser.add_argument("--save-baseline", help="save the results as a baseline")
+  parser.add_argument("--threshold", type=float, default=15.0)
+  args = parser.parse_args()
+
+  if args.corpus:
+    corpus: Dict[str, bytes] = {}
+    for path in args.corpus:
+      with open(path, "rb") as f:
+        corpus[os.path.basename(path)] = f.read()
+  else:
+    corpus = generate_corpus()
+
+  baseline: Dict[str, float] = {}
+  if args.baseline:
+    with open(args.baseline, "r") as f:
+      baseline = json.load(f)
+
+  print(
+    "{:<12} {:<22} {:>8} {:>12} {:>9} {:>9}".format(
+      "corpus", "stage", "MB", "lines/s", "MB/s", "baseline"
+    )
+  )
+
+  results: Dict[str, float] = {}
+  regressions = 0
+  for corpus_name, data in corpus.items():
+    for stage_name, (elapsed, items_count, bytes_count) in run_benchmark(data, args.repeat).items():
+      key = "{}/{}".format(corpus_name, stage_name)
+      mb_per_sec = bytes_count / elapsed / 1e6
+      results[key] = mb_per_sec
+
+      comparison = ""
+      if key in baseline:
+        change = (mb_per_sec / baseline[key] - 1) * 100
+        comparison = "{:+.1f}%".format(change)
+        if change < -args.threshold:
+          comparison += " !"
+          regressions += 1
+
+      print(
+        "{:<12} {:<22} {:>8.2f} {:>12.0f} {:>9.2f} {:>9}".format(
+          corpus_name,
+          stage_name,
+          bytes_count / 1e6,
+          items_count / elapsed,
+          mb_per_sec,
+          comparison,
+        )
+      )
+
+  if args.save_baseline:
+    with open(args.save_baseline, "w") as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+  if regressions:
+    print("{} stage(s) have regressed by more than {}%".format(regressions, args.threshold))
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
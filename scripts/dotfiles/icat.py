@@ -59,16 +59,23 @@
 # can be profiled by running this script with `python -X importtime =icat`.
 
 import ctypes
+import math
 import os
 import re
-import subprocess
 import sys
-from contextlib import ExitStack
-from fcntl import ioctl
+from contextlib import ExitStack, contextmanager
+from fcntl import LOCK_EX, LOCK_UN, flock, ioctl
+from io import BufferedIOBase
 from termios import TIOCGWINSZ
-from typing import BinaryIO, List, Optional
+from typing import TYPE_CHECKING, BinaryIO, Dict, Generator, List, Optional, Tuple, Union
 
 from .terminal_utils import ctermid, get_terminal_size, open_noctty
+from .thumbnail_cache import ThumbnailCache
+
+if TYPE_CHECKING:
+  from .lf_preload import PreloadQueue
+
+Buffer = Union[bytes, memoryview]
 
 
 class winsize(ctypes.Structure):  # noqa: N801
@@ -101,61 +108,398 @@ DECSC = ESC + b"7"  # save cursor
 DECRC = ESC + b"8"  # restore cursor
 
 # <https://stackoverflow.com/questions/14693701/how-can-i-remove-the-ansi-escape-sequences-from-a-string-in-python>
-CSI_REGEX = re.compile(rb"^\x1b\[[\x30-\x3f]*[\x20-\x2f]*[\x40-\x7e]")
+# These are used with `pattern.match(output, pos)`, which anchors the match at
+# `pos`, unlike `^`, which would only match at the beginning of the buffer.
+CSI_REGEX = re.compile(rb"\x1b\[[\x30-\x3f]*[\x20-\x2f]*[\x40-\x7e]")
+# Matches a CSI sequence which might be incomplete because its final byte is
+# still in the pipe.
+CSI_PREFIX_REGEX = re.compile(rb"\x1b\[[\x30-\x3f]*[\x20-\x2f]*")
+
+
+def get_vim_tty_path() -> str:
+  # Vim is supposed to provide this variable, see `../nvim/init.vim`
+  return os.environ.get("VIM_TTY", "") or ctermid()
 
 
 def run(argv: List[str], stdout: BinaryIO, mode: Optional[str] = None) -> int:
   cols, rows = get_terminal_size(stdout.fileno())
+  with open(get_vim_tty_path(), "wb", opener=open_noctty) as vim_tty:
+    return draw(argv[1:], stdout, vim_tty, cols, rows, mode)
 
-  # Vim is supposed to provide this variable, see `../nvim/init.vim`
-  vim_tty = os.environ.get("VIM_TTY", "") or ctermid()
-  with open(vim_tty, "wb", opener=open_noctty) as vim_tty:
-    vim = winsize()
-    ioctl(vim_tty, TIOCGWINSZ, vim)
-    xpixels = vim.ws_xpixel * cols // vim.ws_col
-    ypixels = vim.ws_ypixel * rows // vim.ws_row
-
-    cmd = ["kitten", "icat", f"--use-window-size={cols},{rows},{xpixels},{ypixels}"]
-    if mode == "lf-preview":
-      # This is needed to fit the image into a ${cols} by ${rows} rectangle
-      # because fitting is only activated when the `--place` flag is given:
-      # <https://github.com/kovidgoyal/kitty/blob/v0.44.0/kittens/icat/native.go#L99-L102>
-      cmd.append(f"--place={cols}x{rows}@0x0")
-    cmd.extend(argv[1:])
 
-    try:
-      proc = subprocess.run(cmd, check=True, stdout=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-      if e.returncode < 0:  # Exited due to a signal
-        print(e)
-        # This is just a convention used by most shells, such an exit code is
-        # not special and doesn't actually give any information to the operating
-        # system. More info here: <https://www.cons.org/cracauer/sigint.html>.
-        return 0x80 + -e.returncode
-      else:
-        return e.returncode
-    except OSError as e:
-      print(e)
-      return 0x7F
+# Displays an image in a `cols` by `rows` window inside Vim.
+def draw(
+  args: List[str], stdout: BinaryIO, vim_tty: BinaryIO, cols: int, rows: int, mode: Optional[str]
+) -> int:
+  xpixels, ypixels = get_window_pixels(vim_tty, cols, rows)
+
+  cmd = ["kitten", "icat", f"--use-window-size={cols},{rows},{xpixels},{ypixels}"]
+  if mode == "lf-preview":
+    # This is needed to fit the image into a ${cols} by ${rows} rectangle
+    # because fitting is only activated when the `--place` flag is given:
+    # <https://github.com/kovidgoyal/kitty/blob/v0.44.0/kittens/icat/native.go#L99-L102>
+    cmd.append(f"--place={cols}x{rows}@0x0")
+  cmd.extend(args)
+
+  # Decoding and scaling down a large image is the slowest part of displaying
+  # it, so a copy of the size at which it is displayed is kept in the cache,
+  # which is also a PNG that can be handled by `transmit_png`.
+  if len(cmd) >= 2 and cmd[-2] == "--":
+    cmd[-1] = get_thumbnail(cmd[-1], cmd[2:-2], cols, rows, xpixels, ypixels) or cmd[-1]
+
+  if transmit_png(cmd[2:], stdout, vim_tty, mode):
+    return 0
+
+  # Imported only when needed, since the image can be displayed without it.
+  import subprocess
+
+  try:
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+  except OSError as e:
+    print(e)
+    return 0x7F
+
+  with proc:
+    assert isinstance(proc.stdout, BufferedIOBase)
+    split_output(proc.stdout, stdout, vim_tty, mode)
+
+  if proc.returncode < 0:  # Exited due to a signal
+    print(subprocess.CalledProcessError(proc.returncode, cmd))
+    # This is just a convention used by most shells, such an exit code is
+    # not special and doesn't actually give any information to the operating
+    # system. More info here: <https://www.cons.org/cracauer/sigint.html>.
+    return 0x80 + -proc.returncode
+  return proc.returncode
+
+
+# Returns the size in pixels of a `cols` by `rows` window inside Vim.
+def get_window_pixels(vim_tty: BinaryIO, cols: int, rows: int) -> Tuple[int, int]:
+  vim = winsize()
+  ioctl(vim_tty, TIOCGWINSZ, vim)
+  return vim.ws_xpixel * cols // vim.ws_col, vim.ws_ypixel * rows // vim.ws_row
+
+
+def get_thumbnail(
+  path: str, options: List[str], cols: int, rows: int, xpixels: int, ypixels: int
+) -> Optional[str]:
+  cache = ThumbnailCache.from_env()
+  box = get_thumbnail_box(options, cols, rows, xpixels, ypixels)
+  if cache is None or box is None:
+    return None
+  return cache.get(path, *box)
+
+
+# Computes the size of the box in pixels which `kitten icat` would fit the
+# image into given these options. Also used by the ranger image displayer for
+# prefetching, so that its thumbnails get exactly the same cache entries.
+def get_thumbnail_box(
+  options: List[str], cols: int, rows: int, xpixels: int, ypixels: int
+) -> Optional[Tuple[int, int]]:
+  if cols <= 0 or rows <= 0:
+    return None
+
+  # Without `--place` the image is fitted only to the width of the window.
+  box_width, box_height = xpixels, 0
+  for option in options:
+    if option.startswith("--place="):
+      try:
+        place_cols, place_rows = map(int, option[len("--place=") :].partition("@")[0].split("x"))
+      except ValueError:
+        return None
+      box_width, box_height = place_cols * xpixels // cols, place_rows * ypixels // rows
+
+  return box_width, box_height
+
+
+# The placeholder character and the combining characters that encode the row
+# and the column numbers (and the most significant byte of the image ID) of the
+# cells with the placeholders. The table of the diacritics consists of all the
+# combining characters of class 230 (Above) from Unicode 6.0.0 which don't have
+# a decomposition mapping and aren't a part of any other character's canonical
+# decomposition, in the order of their codepoints (see the link to the table in
+# the section on Unicode placeholders of the protocol's documentation).
+PLACEHOLDER = "\U0010eeee".encode()
+PLACEHOLDER_DIACRITICS_RANGES = (
+  "0305 030D 030E 0310 0312 033D-033F 0346 034A-034C 0350-0352 0357 035B 0363-036F 0483-0487 "
+  "0592-0595 0597-0599 059C-05A1 05A8 05A9 05AB 05AC 05AF 05C4 0610-0617 0657-065B 065D 065E "
+  "06D6-06DC 06DF-06E2 06E4 06E7 06E8 06EB 06EC 0730 0732 0733 0735 0736 073A 073D 073F-0741 "
+  "0743 0745 0747 0749 074A 07EB-07F1 07F3 0816-0819 081B-0823 0825-0827 0829-082D 0951 0953 "
+  "0954 0F82 0F83 0F86 0F87 135D-135F 17DD 193A 1A17 1A75-1A7C 1B6B 1B6D-1B73 1CD0-1CD2 1CDA "
+  "1CDB 1CE0 1DC0 1DC1 1DC3-1DC9 1DCB 1DCC 1DD1-1DE6 1DFE 20D0 20D1 20D4-20D7 20DB 20DC 20E1 "
+  "20E7 20E9 20F0 2CEF-2CF1 2DE0-2DFF A66F A67C A67D A6F0 A6F1 A8E0-A8F1 AAB0 AAB2 AAB3 AAB7 "
+  "AAB8 AABE AABF AAC1 FE20-FE26 10A0F 10A38 1D185-1D189 1D1AA-1D1AD 1D242-1D244"
+)
+
+
+def get_placeholder_diacritics() -> List[bytes]:
+  diacritics: List[bytes] = []
+  for item in PLACEHOLDER_DIACRITICS_RANGES.split():
+    first, _, last = item.partition("-")
+    for codepoint in range(int(first, 16), int(last or first, 16) + 1):
+      diacritics.append(chr(codepoint).encode())
+  return diacritics
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# The signature and the whole IHDR chunk, with its length, type, data and CRC.
+PNG_HEADER_SIZE = len(PNG_SIGNATURE) + 4 + 4 + 13 + 4
+# The size of a chunk of the base64-encoded image data sent in a single command.
+GRAPHICS_CHUNK_SIZE = 4096
+
+
+# Starting `kitten icat` and parsing its output can be skipped altogether for
+# PNG images (e.g. thumbnails that are already cached by `lf-preview`), since
+# Kitty can decode those by itself: the image file is sent with `f=100` as-is,
+# in chunks of base64 (or just its path with `--transfer-mode=file`), Kitty is
+# told to create a virtual placement of the image with the given size in cells,
+# and the grid of Unicode placeholders is printed by this script. The protocol:
+# <https://sw.kovidgoyal.net/kitty/graphics-protocol/#the-transmission-medium>
+# <https://sw.kovidgoyal.net/kitty/graphics-protocol/#png-data>
+# <https://sw.kovidgoyal.net/kitty/graphics-protocol/#unicode-placeholders>
+#
+# This handles only the subset of the options of `kitten icat` that is used by
+# `lf-preview` and returns `False` for anything else (other formats, animated
+# PNGs, images that are much larger than the area they will be displayed in and
+# need to be scaled down before sending, the `memory` transfer mode, other kinds
+# of alignment or cursor positioning), in which case the real thing is called.
+# Like `kitten icat`, the image is scaled down to fit into the `--place`
+# rectangle (or the width of the window) preserving the aspect ratio, but is
+# never scaled up.
+def transmit_png(args: List[str], stdout: BinaryIO, vim_tty: BinaryIO, mode: Optional[str]) -> bool:
+  options: Dict[str, str] = {}
+  paths: List[str] = []
+  for i, arg in enumerate(args):
+    if arg == "--":
+      paths.extend(args[i + 1 :])
+      break
+    name, has_value, value = arg.partition("=")
+    if not arg.startswith("-"):
+      paths.append(arg)
+    elif name in ("--unicode-placeholder", "--no-trailing-newline") and not has_value:
+      options[name] = ""
+    elif name in (
+      "--use-window-size",
+      "--stdin",
+      "--transfer-mode",
+      "--passthrough",
+      "--place",
+      "--align",
+      "--image-id",
+    ):
+      options[name] = value
+    else:
+      return False
 
-    output = proc.stdout
+  if (
+    len(paths) != 1
+    or "--unicode-placeholder" not in options
+    or options.get("--stdin", "no") != "no"
+    or options.get("--transfer-mode", "stream") not in ("stream", "detect", "file")
+    or options.get("--align", "center") != "left"
+    # The cursor movements for placing the image at a given position are
+    # stripped in LF anyway.
+    or ("--place" in options and mode != "lf-preview")
+  ):
+    return False
 
-    # The mother of all hacks: the loop that parses the ANSI escape sequences
-    # outputted by `kitten icat`. It only needs to be able to process these:
-    # <https://github.com/kovidgoyal/kitty/blob/v0.44.0/kittens/icat/transmit.go#L250-L279>.
+  # PNG files consist of chunks, and the header with the dimensions of the
+  # image always comes first, followed by the chunk indicating an animated
+  # image if there is one, all of them preceding the image data itself:
+  # <https://www.w3.org/TR/png-3/#5DataRep>. The signature and the header are
+  # checked before reading the rest, so that large files in other formats
+  # aren't read in full only to be handed over to `kitten icat`.
+  path = paths[0]
+  try:
+    with open(path, "rb") as file:
+      data = file.read(PNG_HEADER_SIZE)
+      if not data.startswith(PNG_SIGNATURE) or data[12:16] != b"IHDR":
+        return False
+      data += file.read()
+  except OSError:
+    return False  # Let `kitten icat` report the error
+
+  width = int.from_bytes(data[16:20], "big")
+  height = int.from_bytes(data[20:24], "big")
+  pos = len(PNG_SIGNATURE)
+  while pos + 8 <= len(data) and data[pos + 4 : pos + 8] != b"IDAT":
+    if data[pos + 4 : pos + 8] == b"acTL":
+      return False
+    pos += 12 + int.from_bytes(data[pos : pos + 4], "big")
+
+  try:
+    win_cols, win_rows, win_xpixels, win_ypixels = map(int, options["--use-window-size"].split(","))
+    cell_width, cell_height = win_xpixels / win_cols, win_ypixels / win_rows
+    if "--place" in options:
+      box_cols, box_rows = map(int, options["--place"].partition("@")[0].split("x"))
+    else:
+      box_cols, box_rows = win_cols, 0
+    image_id = int(options["--image-id"]) if "--image-id" in options else 0
+  except (KeyError, ValueError, ZeroDivisionError):
+    return False
+
+  if width <= 0 or height <= 0 or cell_width <= 0 or cell_height <= 0 or box_cols <= 0:
+    return False
+  scale = min(1.0, box_cols * cell_width / width)
+  if box_rows > 0:
+    scale = min(scale, box_rows * cell_height / height)
+  if scale < 0.5:
+    return False  # Sending the image in full size would be a waste
+
+  diacritics = get_placeholder_diacritics()
+  image_cols = max(1, min(box_cols, math.ceil(width * scale / cell_width)))
+  image_rows = max(1, math.ceil(height * scale / cell_height))
+  if box_rows > 0:
+    image_rows = min(image_rows, box_rows)
+  if image_rows > len(diacritics) or image_cols > len(diacritics):
+    return False
+
+  if not 0 < image_id < 1 << 32:
+    # The ID must not be zero, and fitting into 24 bits lets the whole ID be
+    # encoded in the color.
+    image_id = int.from_bytes(os.urandom(3), "big") or 1
+
+  passthrough = options.get("--passthrough", "detect")
+  if passthrough == "detect":
+    passthrough = "tmux" if os.environ.get("TMUX", "") else "none"
+
+  def graphics_command(control: bytes, payload: Buffer) -> List[Buffer]:
+    prefix, suffix = APC + b"G" + control + b";", ST
+    if passthrough == "tmux":
+      # The base64-encoded payload never contains ESC characters.
+      prefix = b"\x1bPtmux;" + prefix.replace(ESC, ESC + ESC)
+      suffix = suffix.replace(ESC, ESC + ESC) + ST
+    return [prefix, payload, suffix]
+
+  from binascii import b2a_base64
+
+  control = b"a=T,f=100,U=1,q=2,i=%d,c=%d,r=%d" % (image_id, image_cols, image_rows)
+  vim_tty_parts: List[Buffer] = []
+  if options.get("--transfer-mode") == "file":
+    path_base64 = b2a_base64(os.fsencode(os.path.abspath(path)), newline=False)
+    vim_tty_parts.extend(graphics_command(control + b",t=f", path_base64))
+  else:
+    encoded = memoryview(b2a_base64(data, newline=False))
+    for start in range(0, len(encoded), GRAPHICS_CHUNK_SIZE):
+      end = start + GRAPHICS_CHUNK_SIZE
+      # Only the first command may contain the keys other than `m`.
+      chunk_control = (control + b",t=d," if start == 0 else b"") + b"m=%d" % (end < len(encoded))
+      vim_tty_parts.extend(graphics_command(chunk_control, encoded[start:end]))
+
+  # The lower 24 bits of the ID are encoded in the foreground color, and the
+  # most significant byte in the third diacritic. The SGR sequences are
+  # repeated on every line for less(1), and don't use colon separators for LF.
+  color = b"\x1b[38;2;%d;%d;%dm" % (image_id >> 16 & 0xFF, image_id >> 8 & 0xFF, image_id & 0xFF)
+  id_diacritic = diacritics[image_id >> 24] if image_id >> 24 else b""
+  newline = b"\n" if mode == "less" else b"\r\n"
+  lines: List[bytes] = []
+  for row in range(image_rows):
+    row_prefix = PLACEHOLDER + diacritics[row]
+    cells = (row_prefix + diacritics[col] + id_diacritic for col in range(image_cols))
+    lines.append(color + b"".join(cells) + b"\x1b[39m")
+  text = newline.join(lines)
+  if "--no-trailing-newline" not in options:
+    text += newline
+
+  stdout.flush()
+  vim_tty.flush()
+  write_all(vim_tty, vim_tty_parts)
+  write_all(stdout, [text])
+  return True
+
+
+# The mother of all hacks: the loop that parses the ANSI escape sequences
+# outputted by `kitten icat`. It only needs to be able to process these:
+# <https://github.com/kovidgoyal/kitty/blob/v0.44.0/kittens/icat/transmit.go#L250-L279>.
+#
+# The output is split as it is being read from the pipe, instead of waiting for
+# `icat` to exit, so that Kitty starts receiving the image while the rest of it
+# is still being encoded, and only the data that hasn't been written anywhere
+# yet is kept in memory. Any sequence that is cut off at the end of the buffer
+# is left there until the next read, except for the graphics commands, which
+# can be huge and are forwarded in pieces.
+#
+# The pieces of every chunk that go to each destination are collected (as
+# memoryviews of the chunk where possible) and written out with a single
+# writev(2) call per destination once the chunk has been parsed, instead of
+# making a write(2) call for every sequence. The graphics commands are written
+# first, so that the image is uploaded before the placeholders referencing it
+# appear on the screen. Other than that, the relative order of the two streams
+# doesn't matter.
+def split_output(
+  pipe: BufferedIOBase, stdout: BinaryIO, vim_tty: BinaryIO, mode: Optional[str]
+) -> None:
+  output = b""
+  i = 0
+  eof = False
+  in_graphics_command = False
+  last_sgr = b""
+  stdout_parts: List[Buffer] = []
+  vim_tty_parts: List[Buffer] = []
+
+  # Nothing else is going to be written through the buffered file objects.
+  stdout.flush()
+  vim_tty.flush()
+
+  while not eof:
+    chunk = pipe.read1(64 * 1024)
+    eof = not chunk
+    # Only the unfinished sequence at the end of the previous chunk is copied.
+    output = output[i:] + chunk
+    view = memoryview(output)
     i = 0
-    last_sgr = b""
+
     while i < len(output):
+      # The image data will be sent either as `ESC "_G" ... ST` or `ESC "Ptmux;"
+      # ESC ESC "_G" ... ESC ST ST`.
+      # <https://github.com/kovidgoyal/kitty/blob/v0.44.0/kittens/icat/transmit.go#L39-L43>
+      # <https://github.com/kovidgoyal/kitty/blob/v0.44.0/tools/tui/graphics/command.go#L210-L251>
+      # When wrapped in sequences for passthrough in tmux, a doubled ESC
+      # character counts as a plain ESC, and an unescaped ESC followed by
+      # backslash terminates the sequence.
+      # <https://github.com/tmux/tmux/wiki/FAQ#what-is-the-passthrough-escape-sequence-and-how-do-i-use-it>
+      # <https://github.com/tmux/tmux/blob/3.6/input.c#L689-L698>
+      if in_graphics_command:
+        end = i
+        while True:
+          esc = output.find(ESC, end)
+          if esc < 0 or (esc + 1 >= len(output) and not eof):
+            # The terminator hasn't arrived yet (or the ESC at the end of the
+            # buffer might be the beginning of it).
+            end = len(output) if esc < 0 or eof else esc
+            break
+          end = esc + 2
+          if output.startswith(ST, esc):
+            in_graphics_command = False
+            break
+        if end > i:
+          vim_tty_parts.append(view[i:end])
+        i = end
+        if in_graphics_command:
+          break
+        continue
+
+      if output.startswith(ESC, i) and i + 1 >= len(output) and not eof:
+        break  # Can't tell which sequence this is yet
+
+      if output.startswith((APC, DCS), i):
+        in_graphics_command = True
+        continue
+
       if output.startswith(CSI, i):
-        match = CSI_REGEX.match(output[i:])
+        match = CSI_REGEX.match(output, i)
+        if not match and not eof:
+          prefix = CSI_PREFIX_REGEX.match(output, i)
+          if prefix and prefix.end() == len(output):
+            break  # The final byte of the sequence is still in the pipe
+
         if match:
           csi = match.group(0)
+          i = match.end()
 
           # The preview window in LF supports only a very limited number of ANSI
           # sequences: <https://github.com/gokcehan/lf/blob/r39/termseq.go#L40-L84>
           # <https://github.com/gokcehan/lf/blob/r39/termseq_test.go>
           if mode == "lf-preview" and not csi.endswith(SGR):
-            i += match.end()
             continue
 
           if csi.endswith(SGR):
@@ -165,9 +509,7 @@ def run(argv: List[str], stdout: BinaryIO, mode: Optional[str] = None) -> int:
               csi = csi.replace(b":", b";")
             last_sgr = csi
 
-          stdout.write(csi)
-          stdout.flush()
-          i += match.end()
+          stdout_parts.append(csi)
           continue
 
       # These sequences are inserted because of the `--place` flag that we had
@@ -176,45 +518,255 @@ def run(argv: List[str], stdout: BinaryIO, mode: Optional[str] = None) -> int:
         i += 2
         continue
 
-      # The image data will be sent either as `ESC "_G" ... ST` or `ESC "Ptmux;"
-      # ESC ESC "_G" ... ESC ST ST`.
-      # <https://github.com/kovidgoyal/kitty/blob/v0.44.0/kittens/icat/transmit.go#L39-L43>
-      # <https://github.com/kovidgoyal/kitty/blob/v0.44.0/tools/tui/graphics/command.go#L210-L251>
-      # When wrapped in sequences for passthrough in tmux, a doubled ESC
-      # character counts as a plain ESC, and an unescaped ESC followed by
-      # backslash terminates the sequence.
-      # <https://github.com/tmux/tmux/wiki/FAQ#what-is-the-passthrough-escape-sequence-and-how-do-i-use-it>
-      # <https://github.com/tmux/tmux/blob/3.6/input.c#L689-L698>
-      if output.startswith((APC, DCS), i):
-        end = i + 2
-        while end < len(output):
-          esc = output.find(ESC, end)
-          end = esc + 2
-          if output[esc:end] == ST:
-            break
-        vim_tty.write(output[i:end])
-        vim_tty.flush()
-        i = end
-        continue
-
       # Jump to the next escape sequence
       esc = output.find(ESC, i + 1)
       if esc < 0:
         esc = len(output)
-      chunk = output[i:esc]
       if mode == "less":
         # For efficiency sake, less assumes that every line starts out
         # non-colored, but `icat` prints the SGR sequence to set the foreground
         # color only once - therefore it needs to be repeated on every line.
-        chunk = chunk.replace(b"\r", b"").replace(b"\n", b"\n" + last_sgr)
-      stdout.write(chunk)
-      stdout.flush()
+        stdout_parts.append(output[i:esc].replace(b"\r", b"").replace(b"\n", b"\n" + last_sgr))
+      else:
+        stdout_parts.append(view[i:esc])
       i = esc
 
-    return 0
+    write_all(vim_tty, vim_tty_parts)
+    write_all(stdout, stdout_parts)
+    del vim_tty_parts[:], stdout_parts[:]
+
+
+# The maximum number of buffers that can be passed to writev(2) at once.
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "writev") else 0
+
+
+def write_all(file: BinaryIO, parts: List[Buffer]) -> None:
+  if not parts:
+    return  # Don't waste a syscall, most chunks contain data for only one destination
+
+  try:
+    fd = file.fileno()
+  except OSError:  # An in-memory buffer, such as `io.BytesIO`
+    file.write(b"".join(parts))
+    return
+
+  if not IOV_MAX:
+    data = memoryview(b"".join(parts))
+    while data:
+      data = data[os.write(fd, data) :]
+    return
+
+  first = 0
+  while first < len(parts):
+    written = os.writev(fd, parts[first : first + IOV_MAX])
+    # Skip over the buffers that have been written completely, and cut off the
+    # written part of the one that has been written partially.
+    while first < len(parts) and written >= len(parts[first]):
+      written -= len(parts[first])
+      first += 1
+    if written:
+      parts[first] = memoryview(parts[first])[written:]
+
+
+# Spawning a Python interpreter and importing everything anew for every preview
+# takes longer than actually drawing most of the images, and the lag becomes
+# noticeable when scrolling quickly through a directory full of pictures. So,
+# `icat --serve <socket>` starts a daemon, one per lf instance (`lf-preview`
+# puts the socket into its per-`$id` cache directory), which holds the TTY of
+# Vim open and draws the images on request. The protocol is deliberately dumb,
+# so that the requests can be sent straight from a shell script with socat(1):
+# a request is a list of NUL-terminated fields, sent in a single connection,
+# followed by shutting down the writing side of the socket (which is what
+# socat does once it reaches the EOF of its stdin):
+#
+#     draw <mode> <cols> <rows> <icat args>...
+#     clear <image id>
+#     preload <cols> <rows> <previewer> <file> <text path> <image path>
+#
+# The response to a draw request is the output that `icat` would have written
+# to its stdout (the Unicode placeholders), after which the connection is
+# closed, so an empty response means that the image was not drawn. Requests are
+# executed one at a time, and only the latest one is kept in the queue: when
+# the cursor is moved over several files in quick succession, the requests for
+# the files which have been skipped are dropped (their connections are closed
+# without a response) before any work is wasted on them. All writes to the TTY
+# go through the daemon, so that a clear request doesn't end up interleaved
+# with the escape codes of an image that is still being transmitted. Preload
+# requests don't get a response and are put into a separate queue with its own
+# workers, see `lf_preload.py`, so they never delay the drawing.
+SERVE_IDLE_TIMEOUT = 30 * 60
+SERVE_REQUEST_TIMEOUT = 5
+
+
+def serve(socket_path: str) -> int:
+  import signal
+  import socket
+  import threading
+
+  # Starting up and removing the socket on the way out happen under a lock, so
+  # that two daemons started at the same moment can't both decide that there is
+  # no daemon yet, with the second one replacing the socket of the first.
+  lock_fd = os.open(socket_path + ".lock", os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o600)
+
+  @contextmanager
+  def socket_lock() -> Generator[None, None, None]:
+    flock(lock_fd, LOCK_EX)
+    try:
+      yield
+    finally:
+      flock(lock_fd, LOCK_UN)
+
+  # The socket is removed only if it is still ours: after a daemon has been
+  # killed, the next one replaces its leftover socket with a new one.
+  def remove_socket(bound_stat: os.stat_result) -> None:
+    with socket_lock():
+      try:
+        stat = os.stat(socket_path)
+      except FileNotFoundError:
+        return
+      if (stat.st_dev, stat.st_ino) == (bound_stat.st_dev, bound_stat.st_ino):
+        os.unlink(socket_path)
+
+  latest_request: Optional[Tuple[socket.socket, List[str]]] = None
+  request_available = threading.Condition()
+  preload_queue: "Optional[PreloadQueue]" = None
+
+  def execute_requests(vim_tty: BinaryIO) -> None:
+    nonlocal latest_request
+    while True:
+      with request_available:
+        while latest_request is None:
+          request_available.wait()
+        conn, fields = latest_request
+        latest_request = None
+
+      try:
+        with conn, conn.makefile("wb") as stdout:
+          execute_request(fields, stdout, vim_tty)
+      except (BrokenPipeError, ConnectionResetError):
+        pass  # The client has given up on waiting for us.
+      except (ValueError, IndexError) as e:
+        print(f"icat: invalid request {fields!r}: {e}", file=sys.stderr)
+      except Exception as e:
+        # A file that can't be read or decoded shouldn't take the daemon down,
+        # only losing the TTY of Vim should.
+        print(f"icat: request {fields!r} has failed: {e!r}", file=sys.stderr)
+        if not is_writable(vim_tty):
+          return
+
+  def exit_on_signal(signum: int, frame: object) -> None:
+    sys.exit(0x80 + signum)
+
+  # Let the socket be removed on the way out when killed or when the terminal
+  # is closed.
+  signal.signal(signal.SIGTERM, exit_on_signal)
+  signal.signal(signal.SIGHUP, exit_on_signal)
+
+  with ExitStack() as stack:
+    stack.callback(os.close, lock_fd)
+    vim_tty = open(get_vim_tty_path(), "wb", opener=open_noctty)
+
+    def close_vim_tty() -> None:
+      try:
+        vim_tty.close()
+      except OSError:
+        pass  # The buffer can't be flushed if the terminal has hung up.
+
+    stack.callback(close_vim_tty)
+    server = stack.enter_context(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+
+    with socket_lock():
+      # Another instance of the daemon might have been started in parallel by
+      # an earlier preview, in which case let it be.
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+          probe.connect(socket_path)
+          return 0
+        except OSError:
+          pass
+
+      try:
+        os.unlink(socket_path)  # A leftover from a daemon that has been killed
+      except FileNotFoundError:
+        pass
+      server.bind(socket_path)
+      stack.callback(remove_socket, os.stat(socket_path))
+      server.listen()
+
+    server.settimeout(SERVE_IDLE_TIMEOUT)
+
+    executor = threading.Thread(target=execute_requests, args=(vim_tty,), daemon=True)
+    executor.start()
+
+    while executor.is_alive():
+      try:
+        conn, _ = server.accept()
+      except socket.timeout:
+        # lf doesn't tell us when it exits, so the daemon just quits after
+        # being unused for a while, it will be restarted on the next preview.
+        break
+
+      try:
+        conn.settimeout(SERVE_REQUEST_TIMEOUT)
+        request = bytearray()
+        while chunk := conn.recv(4096):
+          request += chunk
+        conn.settimeout(None)
+      except OSError:
+        conn.close()
+        continue
+
+      fields = os.fsdecode(bytes(request)).split("\0")[:-1]
+      if fields[:1] == ["preload"]:
+        conn.close()
+        if preload_queue is None:
+          from .lf_preload import PreloadQueue
+
+          preload_queue = PreloadQueue(vim_tty, min(2, max(1, (os.cpu_count() or 1) // 2)))
+        try:
+          preload_queue.add(fields)
+        except ValueError as e:
+          print(f"icat: invalid request {fields!r}: {e}", file=sys.stderr)
+        continue
+
+      with request_available:
+        if latest_request is not None:
+          latest_request[0].close()  # Superseded before it was even started
+        latest_request = (conn, fields)
+        request_available.notify()
+
+  # The executor thread dies only if the TTY of Vim has been closed.
+  return 0
+
+
+# A zero-length write fails with EIO once the terminal has hung up.
+def is_writable(file: BinaryIO) -> bool:
+  try:
+    os.write(file.fileno(), b"")
+    return True
+  except OSError:
+    return False
+
+
+def execute_request(fields: List[str], stdout: BinaryIO, vim_tty: BinaryIO) -> None:
+  if fields[0] == "draw":
+    mode, cols, rows, args = fields[1], int(fields[2]), int(fields[3]), fields[4:]
+    draw(args, stdout, vim_tty, cols, rows, mode)
+  elif fields[0] == "clear":
+    # `kitten icat --clear` doesn't work with images rendered with Unicode
+    # placeholders, see also `lf-cleaner`.
+    command = APC + b"Ga=d,d=I,i=%d" % int(fields[1]) + ST
+    if os.environ.get("TMUX", ""):
+      command = b"\x1bPtmux;" + command.replace(ESC, ESC + ESC) + ST
+    vim_tty.write(command)
+    vim_tty.flush()
+  else:
+    raise ValueError("unknown request type")
 
 
 def main() -> None:
+  if len(sys.argv) == 3 and sys.argv[1] == "--serve":
+    sys.exit(serve(sys.argv[2]))
   sys.exit(run(sys.argv, sys.stdout.buffer, os.environ.get("DOTFILES_ICAT_MODE")))
 
 
@@ -0,0 +1,275 @@
+# A benchmark and a regression test for the output processing of `icat.py` (the
+# `split_output` loop, which parses everything `kitten icat` prints and sends it
+# to the TTY of Vim and to stdout), which runs without a terminal and without
+# `kitten`, by replaying the output of `kitten icat` into in-memory sinks. Every
+# corpus is run in each of the modes (`less`, `lf-preview` and `ranger`), and
+# the throughput in megabytes per second, the number of write calls made to
+# each of the destinations (at most one per chunk read from the pipe is
+# expected, see `write_all`) and the peak memory usage measured with tracemalloc
+# are reported.
+#
+# The corpus can be recorded from the real thing like this (`--use-window-size`
+# is required when the output is not a terminal):
+#
+#     kitten icat --use-window-size=80,40,800,800 --stdin=no --transfer-mode=stream \
+#       --unicode-placeholder image.png > placeholders.icat
+#     TMUX=1 kitten icat --use-window-size=80,40,800,800 --stdin=no \
+#       --transfer-mode=stream --passthrough=tmux --place=80x40@0x0 image.png > tmux.icat
+#
+# and passed to this script as arguments. Without arguments a fixed corpus is
+# generated, which mimics what `kitten icat` prints: the image transmitted
+# directly, wrapped in the DCS sequences for passthrough in tmux, displayed with
+# Unicode placeholders (with the colons in the SGR sequences that set their
+# color), and placed at a position with `--place` (with the cursor saved and
+# restored by DECSC and DECRC around it).
+#
+# The output of every run is also checked to be the same when it comes out of
+# the pipe in tiny pieces, which shakes out the bugs in handling the sequences
+# that are cut off at the end of a chunk, and is verified byte for byte against
+# the golden files (compressed with xz). The ones for the generated corpus are
+# stored in `icat_bench_golden/` and are checked by default, and after an
+# intended change of the output they are regenerated with `--save-golden`. For
+# other corpora a directory is given to `--golden` and `--save-golden`.
+# Results can be saved with `--save-baseline` and compared to a saved baseline
+# with `--baseline`. The exit code is 1 if any run has become slower by more
+# than `--threshold` percent or if any output doesn't match.
+
+import argparse
+import io
+import json
+import lzma
+import os
+import sys
+import time
+import tracemalloc
+from binascii import b2a_base64
+from typing import Dict, List, Tuple, cast
+
+from dotfiles import icat
+
+MODES = ("less", "lf-preview", "ranger")
+PIPE_CHUNK_SIZE = 64 * 1024
+TINY_CHUNK_SIZE = 1021
+DEFAULT_GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "icat_bench_golden")
+
+
+# Collects or just counts what `split_output` writes.
+class Sink(io.BytesIO):
+  def __init__(self, keep: bool) -> None:
+    super().__init__()
+    self.keep = keep
+    self.writes_count = 0
+    self.bytes_count = 0
+
+  def write(self, data: icat.Buffer) -> int:  # pyright: ignore[reportIncompatibleMethodOverride]
+    self.writes_count += 1
+    self.bytes_count += len(data)
+    return super().write(data) if self.keep else len(data)
+
+
+# Hands out the data in pieces of at most `chunk_size` bytes, like a pipe does.
+class ChunkedReader:
+  def __init__(self, data: bytes, chunk_size: int) -> None:
+    self.data = data
+    self.chunk_size = chunk_size
+    self.pos = 0
+
+  def read1(self, size: int = -1) -> bytes:
+    if size < 0:
+      size = len(self.data)
+    end = self.pos + min(size, self.chunk_size)
+    chunk = self.data[self.pos : end]
+    self.pos = end
+    return chunk
+
+
+def generate_output(
+  image_size: int, tmux: bool = False, placeholders: bool = False, place: bool = False
+) -> bytes:
+  cols, rows, image_id = 80, 40, 0x2A0107
+
+  def graphics_command(control: bytes, payload: bytes) -> bytes:
+    command = icat.APC + b"G" + control + b";" + payload + icat.ST
+    if tmux:
+      command = b"\x1bPtmux;" + command.replace(icat.ESC, icat.ESC + icat.ESC) + icat.ST
+    return command
+
+  # The contents of the image don't matter, the parser only looks for the
+  # ESC characters, which never occur in base64.
+  encoded = b2a_base64(bytes(range(256)) * (image_size // 256), newline=False)
+  control = b"a=T,f=100,i=%d,q=2" % image_id
+  if placeholders:
+    control += b",U=1,c=%d,r=%d" % (cols, rows)
+  parts: List[bytes] = []
+  if place:
+    parts.append(icat.DECSC + b"\x1b[1;1H")
+  for start in range(0, len(encoded), 4096):
+    more = b"m=%d" % (start + 4096 < len(encoded))
+    chunk_control = control + b"," + more if start == 0 else more
+    parts.append(graphics_command(chunk_control, encoded[start : start + 4096]))
+  if place:
+    parts.append(icat.DECRC)
+
+  if placeholders:
+    diacritics = icat.get_placeholder_diacritics()
+    color = b"\x1b[38:2:%d:%d:%dm" % (image_id >> 16 & 0xFF, image_id >> 8 & 0xFF, image_id & 0xFF)
+    for row in range(rows):
+      cells = b"".join(icat.PLACEHOLDER + diacritics[row] + diacritics[col] for col in range(cols))
+      parts.append(color + cells + b"\x1b[39m\n")
+  else:
+    parts.append(b"\n")
+  return b"".join(parts)
+
+
+def generate_corpus() -> Dict[str, bytes]:
+  return {
+    "stream": generate_output(6 * 1024 * 1024),
+    "tmux": generate_output(6 * 1024 * 1024, tmux=True, placeholders=True),
+    "placeholders": generate_output(6 * 1024 * 1024, placeholders=True),
+    "place": generate_output(1024 * 1024, place=True),
+  }
+
+
+def split(data: bytes, mode: str, chunk_size: int, keep: bool) -> Tuple[Sink, Sink]:
+  stdout, vim_tty = Sink(keep), Sink(keep)
+  icat.split_output(cast(io.BufferedIOBase, ChunkedReader(data, chunk_size)), stdout, vim_tty, mode)
+  return stdout, vim_tty
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser()
+  parser.add_argument("corpus", nargs="*", help="files with recorded output of `kitten icat`")
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument(
+    "--golden",
+    help="verify the output against golden files in a directory "
+    "(the bundled ones for the generated corpus by default)",
+  )
+  parser.add_argument(
+    "--save-golden",
+    nargs="?",
+    const="",
+    metavar="DIR",
+    help="save the output as golden files into a directory "
+    "(the bundled ones for the generated corpus by default)",
+  )
+  parser.add_argument("--baseline", help="compare the results with a saved baseline")
+  parser.add_argument("--save-baseline", help="save the results as a baseline")
+  parser.add_argument("--threshold", type=float, default=15.0)
+  args = parser.parse_args()
+
+  if args.corpus:
+    corpus: Dict[str, bytes] = {}
+    for path in args.corpus:
+      with open(path, "rb") as f:
+        corpus[os.path.basename(path)] = f.read()
+  else:
+    corpus = generate_corpus()
+
+  golden_dir = args.golden
+  if args.save_golden == "":
+    if args.corpus:
+      parser.error("--save-golden requires a directory for a recorded corpus")
+    args.save_golden = DEFAULT_GOLDEN_DIR
+  if args.save_golden is not None:
+    golden_dir = None  # nothing to verify against while regenerating them
+  elif golden_dir is None and not args.corpus:
+    golden_dir = DEFAULT_GOLDEN_DIR
+
+  baseline: Dict[str, float] = {}
+  if args.baseline:
+    with open(args.baseline, "r") as f:
+      baseline = json.load(f)
+
+  if args.save_golden:
+    os.makedirs(args.save_golden, exist_ok=True)
+
+  print(
+    "{:<14} {:<11} {:>7} {:>9} {:>10} {:>13} {:>10} {:>9}".format(
+      "corpus", "mode", "MB", "MB/s", "stdout KiB", "writes", "peak KiB", "baseline"
+    )
+  )
+
+  results: Dict[str, float] = {}
+  failures = 0
+  for corpus_name, data in corpus.items():
+    for mode in MODES:
+      key = f"{corpus_name}/{mode}"
+
+      stdout, vim_tty = split(data, mode, PIPE_CHUNK_SIZE, keep=True)
+      outputs = {"stdout": stdout.getvalue(), "tty": vim_tty.getvalue()}
+      tiny_stdout, tiny_vim_tty = split(data, mode, TINY_CHUNK_SIZE, keep=True)
+      if tiny_stdout.getvalue() != outputs["stdout"] or tiny_vim_tty.getvalue() != outputs["tty"]:
+        print(f"{key}: the output depends on how the input is chunked")
+        failures += 1
+
+      for stream_name, output in outputs.items():
+        golden_name = f"{corpus_name}.{mode}.{stream_name}.xz"
+        if args.save_golden:
+          with open(os.path.join(args.save_golden, golden_name), "wb") as f:
+            f.write(lzma.compress(output))
+        if golden_dir:
+          try:
+            with open(os.path.join(golden_dir, golden_name), "rb") as f:
+              expected = lzma.decompress(f.read())
+          except FileNotFoundError:
+            print(f"{key}: no golden file for the {stream_name}")
+            failures += 1
+            continue
+          if output != expected:
+            mismatch = next(
+              (i for i, (a, b) in enumerate(zip(output, expected)) if a != b),
+              min(len(output), len(expected)),
+            )
+            print(f"{key}: the {stream_name} differs from the golden file at byte {mismatch}")
+            failures += 1
+
+      best_time = float("inf")
+      for _ in range(args.repeat):
+        start_time = time.perf_counter()
+        stdout, vim_tty = split(data, mode, PIPE_CHUNK_SIZE, keep=False)
+        best_time = min(best_time, time.perf_counter() - start_time)
+
+      # Measured in a separate run, since tracing slows everything down a lot.
+      # The sinks don't keep the data, so that only the memory used by the
+      # parser itself is counted.
+      tracemalloc.start()
+      split(data, mode, PIPE_CHUNK_SIZE, keep=False)
+      _, peak_memory = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+
+      mb_per_sec = len(data) / best_time / 1e6
+      results[key] = mb_per_sec
+
+      comparison = ""
+      if key in baseline:
+        change = (mb_per_sec / baseline[key] - 1) * 100
+        comparison = "{:+.1f}%".format(change)
+        if change < -args.threshold:
+          comparison += " !"
+          failures += 1
+
+      print(
+        "{:<14} {:<11} {:>7.2f} {:>9.1f} {:>10} {:>13} {:>10.0f} {:>9}".format(
+          corpus_name,
+          mode,
+          len(data) / 1e6,
+          mb_per_sec,
+          "{:.1f}".format(stdout.bytes_count / 1024),
+          "{}/{}".format(vim_tty.writes_count, stdout.writes_count),
+          peak_memory / 1024,
+          comparison,
+        )
+      )
+
+  if args.save_baseline:
+    with open(args.save_baseline, "w") as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+  if failures:
+    print("{} check(s) have failed".format(failures))
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,184 @@
+# The preload mode of `lf-preview` (lf runs the previewer with `preload` as the
+# sixth argument for the files around the cursor when the `preload` option is
+# set). Instead of generating the previews right there, which would block lf's
+# preloader for as long as `scope.sh` takes, `lf-preview` hands the file over
+# to the `icat --serve` daemon with a request like this (see `icat.py` for the
+# protocol itself):
+#
+#     preload <cols> <rows> <previewer> <file> <text path> <image path>
+#
+# and exits immediately. The daemon puts it into a `PreloadQueue`, where a few
+# worker threads run the previewer in the background, exactly like the preview
+# mode of `lf-preview` would, and put the results where the preview mode will
+# look for them: the text into `<text path>` (in the cache directory of this lf
+# instance), and the thumbnail generated by `scope.sh` into `<image path>` (in
+# the shared thumbnail cache, see `thumbnail_cache.py`, empty if the images
+# can't be displayed). The images which will be displayed are also scaled down
+# to the size of the preview pane right away, so that `icat` finds them in the
+# thumbnail cache too.
+#
+# The queue is bounded: when the cursor keeps moving, the files which have been
+# requested the longest time ago are the ones furthest away from it, so they
+# are dropped once `PRELOAD_QUEUE_SIZE` newer requests have arrived, and if
+# such a file is still being processed, its previewer is killed. For the same
+# reason the newest requests are executed first, otherwise the workers would
+# never catch up with a cursor that moves faster than the previewer runs.
+# Duplicate requests and files whose previews are already cached are skipped.
+
+import os
+import signal
+import subprocess
+import sys
+import threading
+from collections import deque
+from typing import BinaryIO, Deque, List, Optional
+
+from .cache_utils import evict
+from .icat import get_thumbnail, get_window_pixels
+from .thumbnail_cache import ThumbnailCache
+
+PRELOAD_QUEUE_SIZE = 32
+PRELOAD_TEXT_CACHE_SIZE = 32 * 1024 * 1024
+
+
+class PreloadJob:
+  def __init__(self, serial: int, fields: List[str]) -> None:
+    if len(fields) != 7:
+      raise ValueError("expected 6 arguments")
+    self.serial = serial
+    self.cols, self.rows = int(fields[1]), int(fields[2])
+    self.previewer, self.path, self.text_path, self.image_path = fields[3:]
+    self.process: "Optional[subprocess.Popen[bytes]]" = None
+    self.cancelled = False
+
+
+class PreloadQueue:
+  def __init__(self, vim_tty: BinaryIO, workers: int) -> None:
+    self.vim_tty = vim_tty
+    self.queued: Deque[PreloadJob] = deque()
+    self.running: List[PreloadJob] = []
+    self.last_serial = 0
+    self.condition = threading.Condition()
+    for _ in range(workers):
+      threading.Thread(target=self.work, daemon=True).start()
+
+  def add(self, fields: List[str]) -> None:
+    with self.condition:
+      job = PreloadJob(self.last_serial + 1, fields)
+      if any(other.text_path == job.text_path for other in (*self.queued, *self.running)):
+        return
+      self.last_serial = job.serial
+      self.queued.append(job)
+      if len(self.queued) > PRELOAD_QUEUE_SIZE:
+        self.queued.popleft()
+      for other in self.running:
+        if self.last_serial - other.serial >= PRELOAD_QUEUE_SIZE:
+          self.cancel(other)
+      self.condition.notify()
+
+  # Must be called with the lock held, so that the process is not started in
+  # the meantime.
+  def cancel(self, job: PreloadJob) -> None:
+    job.cancelled = True
+    if job.process is not None:
+      try:
+        # Together with whatever `scope.sh` has spawned.
+        os.killpg(job.process.pid, signal.SIGKILL)
+      except OSError:
+        pass
+
+  def work(self) -> None:
+    while True:
+      with self.condition:
+        while not self.queued:
+          self.condition.wait()
+        job = self.queued.pop()
+        self.running.append(job)
+      try:
+        self.run(job)
+      except OSError:
+        pass
+      except Exception as e:
+        # Anything else is a bug, which must not take the worker down with it.
+        print(f"icat: preloading {job.path!r} has failed: {e!r}", file=sys.stderr)
+      finally:
+        with self.condition:
+          self.running.remove(job)
+
+  def run(self, job: PreloadJob) -> None:
+    import tempfile
+
+    if os.path.exists(job.text_path) or (job.image_path and os.path.exists(job.image_path)):
+      return  # Has been previewed in the meantime
+
+    temp_paths: List[str] = []
+
+    def make_temp_file(path: str) -> str:
+      directory, name = os.path.split(path)
+      os.makedirs(directory, mode=0o700, exist_ok=True)
+      fd, temp_path = tempfile.mkstemp(prefix="." + name + ".", dir=directory)
+      os.close(fd)
+      temp_paths.append(temp_path)
+      return temp_path
+
+    try:
+      temp_text = make_temp_file(job.text_path)
+      temp_image = make_temp_file(job.image_path) if job.image_path else ""
+      # Same arguments as in `lf-preview`, with the stderr thrown away since
+      # the preview mode will show the errors anyway.
+      args = [job.previewer, job.path, str(job.cols), str(job.rows), temp_image]
+      args.append("True" if job.image_path else "False")
+      with open(temp_text, "wb") as stdout, self.condition:
+        if job.cancelled:
+          return
+        process = subprocess.Popen(
+          args,
+          stdin=subprocess.DEVNULL,
+          stdout=stdout,
+          stderr=subprocess.DEVNULL,
+          start_new_session=True,
+        )
+        job.process = process
+      # The process is left a zombie until `cancel()` can no longer see it,
+      # otherwise its PID could be reused by the time it is killed. `waitid` is
+      # missing on macOS before Python 3.13, where that can't be helped, and
+      # the process is reaped right away.
+      if hasattr(os, "waitid"):
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+      else:
+        process.wait()
+      with self.condition:
+        job.process = None
+      code = process.wait()
+      if job.cancelled:
+        return
+
+      # See `lf-preview` for the meanings of the exit codes.
+      image_to_display: Optional[str] = None
+      if code in (0, 3, 4, 5):
+        os.replace(temp_text, job.text_path)
+        evict(os.path.dirname(job.text_path), PRELOAD_TEXT_CACHE_SIZE)
+      elif code == 6 and job.image_path and os.path.getsize(temp_image) > 0:
+        os.replace(temp_image, job.image_path)
+        thumbnail_cache = ThumbnailCache.from_env()
+        if thumbnail_cache is not None:
+          evict(os.path.dirname(job.image_path), thumbnail_cache.max_size)
+        image_to_display = job.image_path
+      elif code == 7 and job.image_path:
+        image_to_display = job.path
+
+      if image_to_display is not None:
+        # The same lookup as the one done by `icat` in the `lf-preview` mode.
+        try:
+          xpixels, ypixels = get_window_pixels(self.vim_tty, job.cols, job.rows)
+        except ZeroDivisionError:
+          return
+        options = [f"--place={job.cols}x{job.rows}@0x0"]
+        get_thumbnail(image_to_display, options, job.cols, job.rows, xpixels, ypixels)
+
+    finally:
+      for temp_path in temp_paths:
+        try:
+          os.unlink(temp_path)
+        except OSError:
+          pass
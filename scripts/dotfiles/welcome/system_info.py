@@ -5,102 +5,397 @@
 
 import itertools
 import os
-import platform
 import socket
 import sys
+import threading
+import time
 from datetime import datetime, timedelta
 from getpass import getuser
-
-import psutil
+from typing import Any, Callable, Generic, TypeVar
 
 from .colors import BLUE, BOLD, DIM, RED, WHITE, YELLOW, colored, colorize_percent
 from .humanize import humanize_bytes, humanize_timedelta
+from .static_info_cache import StaticInfoCache
+
+# On Linux everything is read directly from `/proc` and `/sys` by `procfs.py`,
+# since just importing `psutil` takes longer than that. Setting the variable
+# `DOTFILES_WELCOME_BACKEND=psutil` forces the use of `psutil` anyway, which is
+# handy for comparing the two.
+if sys.platform.startswith("linux") and os.environ.get("DOTFILES_WELCOME_BACKEND") != "psutil":
+  from . import procfs as backend
+else:
+  import psutil as backend
+
+
+# The files which the cached static info depends on, see `static_info_cache.py`.
+STATIC_INFO_DEPENDENCIES = ["/etc/os-release", "/usr/lib/os-release"]
+
+# How long to wait for the slow probes, in seconds. `zshrc` waits for this
+# script to finish at the start of every shell, so a probe that hangs (say,
+# `disk_usage` on a stale NFS or FUSE mount) must not hold up the whole banner.
+PROBE_TIMEOUT = 0.5
+
+T = TypeVar("T")
+
+
+class TimedOut(object):
+  pass
+
+
+class Probe(Generic[T]):
+  """
+  Runs a function in a background thread, so that all probes run at the same
+  time, and lets the result be waited for until the deadline. The threads are
+  daemonic (which is why `ThreadPoolExecutor` is not used, it joins its threads
+  at exit), so a probe that never returns doesn't prevent the script from
+  exiting either. `concurrent.futures` is not used at all, in fact, since it
+  imports `logging`, which takes longer than most of the probes.
+  """
+
+  # The probes started by `start()`, by their keys.
+  started = {}  # type: dict[str, Probe[Any]]
+
+  @classmethod
+  def start(cls, key: str, deadline: float, func: "Callable[..., T]", *args: object) -> "Probe[T]":
+    """
+    Same as creating a probe, except that if the last probe started with the
+    same key is still running, it is returned again (with the new deadline)
+    instead. In the `--watch` mode a probe that hangs would otherwise leave one
+    more blocked thread behind on every refresh.
+    """
+    probe = cls.started.get(key)
+    if probe is not None and not probe.done.is_set():
+      probe.deadline = deadline
+    else:
+      probe = cls.started[key] = cls(deadline, func, *args)
+    return probe
+
+  def __init__(self, deadline: float, func: "Callable[..., T]", *args: object) -> None:
+    self.deadline = deadline
+    self.done = threading.Event()
+    self.value = None  # type: T | None
+    self.error = None  # type: BaseException | None
+    thread = threading.Thread(target=self._run, args=(func,) + args)
+    thread.daemon = True
+    thread.start()
+
+  def _run(self, func: "Callable[..., T]", *args: object) -> None:
+    try:
+      self.value = func(*args)
+    except BaseException as e:
+      self.error = e
+    finally:
+      self.done.set()
+
+  def result(self) -> "T | TimedOut":
+    """
+    Returns the result of the function, or an instance of `TimedOut` if it
+    hasn't finished before the deadline. Exceptions are propagated.
+    """
+    if not self.done.wait(max(0.0, self.deadline - time.monotonic())):
+      return TimedOut()
+    if self.error is not None:
+      raise self.error
+    return self.value  # type: ignore
+
+
+class CpuUsage(object):
+  """
+  Measures the CPU usage between consecutive samples, which is only meaningful
+  in the `--watch` mode. `psutil.cpu_percent()` does the same thing, except
+  that it remembers the last sample separately for every thread, and every
+  probe is run in a new thread, so it can't be used here. The CPU times are
+  counted in clock ticks (1/100 of a second on Linux), so a window of a few
+  milliseconds, like the startup of the script, gives either 0% or 100%.
+  Until at least `MIN_SAMPLE_TIME` seconds of CPU time (summed over all CPUs)
+  have passed since the previous sample, the previous value is returned again,
+  which is `None` before the first one.
+  """
+
+  MIN_SAMPLE_TIME = 1.0
+
+  def __init__(self) -> None:
+    self.last_times = backend.cpu_times()
+    self.last_percent = None  # type: float | None
+
+  @staticmethod
+  def _get_totals(times: Any) -> "tuple[float, float]":
+    """
+    Returns the total and the busy time of all CPUs, computed the same way as
+    in `psutil.cpu_percent()`.
+    """
+    # On Linux the guest time is already counted in the user and nice times.
+    total = sum(times) - getattr(times, "guest", 0) - getattr(times, "guest_nice", 0)
+    # And the iowait time is idle time, even though it is not counted as such.
+    busy = total - times.idle - getattr(times, "iowait", 0)
+    return total, busy
+
+  def sample(self, times: Any) -> "float | None":
+    """
+    Takes the current `cpu_times()` as the next sample.
+    """
+    last_total, last_busy = self._get_totals(self.last_times)
+    total, busy = self._get_totals(times)
+    if total - last_total < self.MIN_SAMPLE_TIME:
+      return self.last_percent
+    self.last_times = times
+    percent = round((busy - last_busy) / (total - last_total) * 100, 1)
+    self.last_percent = min(max(percent, 0.0), 100.0)
+    return self.last_percent
+
+
+class SystemInfo(object):
+  """
+  The raw values collected by `collect_system_info()`: sizes are in bytes,
+  percentages are from 0 to 100, times are in seconds. A value is `None` if it
+  is not available on this system, and an instance of `TimedOut` if its probe
+  hasn't finished in time. Turning these into text is up to the renderers, such
+  as `render_system_info()` or the ones in `exporters.py`.
+  """
+
+  def __init__(self) -> None:
+    self.time = time.time()
+    self.username = ""
+    self.hostname = ""
+    # The ID of the logo and the name of the OS.
+    self.distro_info = None  # type: tuple[str, str] | TimedOut | None
+    self.kernel = ""
+    self.boot_time = None  # type: float | TimedOut | None
+    # The names of the logged in users, each with the terminals of its sessions.
+    self.users = []  # type: list[tuple[str, list[str]]] | TimedOut
+    self.shell = None  # type: str | None
+    # Measured only in the `--watch` mode, see `CpuUsage`.
+    self.cpu_percent = None  # type: float | TimedOut | None
+    # The time spent by all CPUs in each mode since the boot, as a counter.
+    self.cpu_times = None  # type: dict[str, float] | TimedOut | None
+    # The used and the total size, and the usage percentage.
+    self.memory = None  # type: tuple[int, int, float] | TimedOut | None
+    self.disks = []  # type: list[tuple[str, tuple[int, int, float] | TimedOut]] | TimedOut
+    # The charge percentage, the estimated time left (see `psutil.sensors_battery()`
+    # for the special values) and whether the power cable is connected.
+    self.battery = None  # type: tuple[float, int, bool] | TimedOut | None
+    # The address family (IPv4 or IPv6), the interface and the address.
+    self.local_addresses = []  # type: list[tuple[str, str, str]] | TimedOut
+
+
+def get_system_info(
+  cache: "StaticInfoCache | None" = None, cpu_usage: "CpuUsage | None" = None
+) -> "tuple[str, list[tuple[str, str]]]":
+  """
+  Returns logo_id and info_lines. The information that doesn't change until a
+  reboot or an upgrade is taken from the `cache` if it's there. The CPU usage
+  is measured only if `cpu_usage` is given, since the previous call with it.
+  """
+  return render_system_info(collect_system_info(cache, cpu_usage))
 
 
-def get_system_info() -> "tuple[str, list[tuple[str, str]]]":
+def collect_system_info(
+  cache: "StaticInfoCache | None" = None, cpu_usage: "CpuUsage | None" = None
+) -> SystemInfo:
   """
-  Returns logo_id and info_lines.
+  Runs all of the probes and returns what they have found, see `SystemInfo`.
+  The arguments are the same as for `get_system_info()`.
+  """
+
+  if cache is None:
+    cache = StaticInfoCache.disabled()
+
+  info = SystemInfo()
+
+  # All of the probes are started right away, and then their results are
+  # collected, so the total latency is that of the slowest probe, and a probe
+  # that has timed out is left as a placeholder.
+  deadline = time.monotonic() + PROBE_TIMEOUT
+  distro_info = cache.get("distro_info")  # type: tuple[str, str] | None
+  distro_info_probe = None
+  if distro_info is None:
+    distro_info_probe = Probe.start("distro_info", deadline, _get_distro_info)
+  boot_time_probe = Probe.start("boot_time", deadline, _get_boot_time)
+  users_probe = Probe.start("users", deadline, _get_users)
+  cpu_usage_probe = Probe.start("cpu_usage", deadline, _get_cpu_usage, cpu_usage)
+  memory_probe = Probe.start("memory", deadline, _get_memory)
+  disks_probe = Probe.start("disks", deadline, _get_disks, deadline)
+  battery_probe = Probe.start("battery", deadline, _get_battery)
+  local_addresses_probe = Probe.start("local_addresses", deadline, _get_local_addresses)
+
+  info.username = getuser()
+  info.hostname = _get_hostname()
+
+  if distro_info_probe is not None:
+    probed_distro_info = distro_info_probe.result()
+    if not isinstance(probed_distro_info, TimedOut):
+      distro_info = probed_distro_info
+      cache.set("distro_info", distro_info)
+  info.distro_info = TimedOut() if distro_info is None else distro_info
+
+  kernel = cache.get("kernel")  # type: str | None
+  if kernel is None:
+    kernel = _get_kernel()
+    cache.set("kernel", kernel)
+  info.kernel = kernel
+
+  info.boot_time = boot_time_probe.result()
+  info.users = users_probe.result()
+  info.shell = _get_shell()
+
+  cpu_usage_info = cpu_usage_probe.result()
+  if cpu_usage_info is None or isinstance(cpu_usage_info, TimedOut):
+    info.cpu_percent = info.cpu_times = cpu_usage_info
+  else:
+    info.cpu_percent, info.cpu_times = cpu_usage_info
+
+  info.memory = memory_probe.result()
+
+  disks = disks_probe.result()
+  if isinstance(disks, TimedOut):
+    info.disks = disks
+  else:
+    info.disks = [(mountpoint, usage_probe.result()) for mountpoint, usage_probe in disks]
+
+  info.battery = battery_probe.result()
+  info.local_addresses = local_addresses_probe.result()
+
+  return info
+
+
+def render_system_info(info: SystemInfo) -> "tuple[str, list[tuple[str, str]]]":
+  """
+  Turns the collected info into the logo_id and the info_lines displayed by
+  `welcome`, with the values humanized and colored.
   """
 
   info_lines = []  # type: list[tuple[str, str]]
 
-  def info(header: str, line: str) -> None:
+  def add_line(header: str, line: str) -> None:
     header = colored(header + ":", fg=YELLOW, attrs=BOLD)
     info_lines.append((header, line))
 
-  username = getuser()
-  hostname = _get_hostname()
+  timed_out_line = colored("timed out", fg=WHITE, attrs=DIM)
 
   info_lines.append((
-    colored(username, fg=BLUE, attrs=BOLD) + "@" + colored(hostname, fg=RED, attrs=BOLD),
+    colored(info.username, fg=BLUE, attrs=BOLD) + "@" + colored(info.hostname, fg=RED, attrs=BOLD),
     "",
   ))
 
   separator_line = ("", "")
   info_lines.append(separator_line)
 
-  logo_id, os_name = _get_distro_info()
-  info("OS", os_name)
+  if isinstance(info.distro_info, TimedOut) or info.distro_info is None:
+    logo_id = ""
+    add_line("OS", timed_out_line)
+  else:
+    logo_id, os_name = info.distro_info
+    add_line("OS", os_name)
 
-  kernel_name, _, kernel_version, _, _, _ = platform.uname()
-  info("Kernel", "%s %s" % (kernel_name, kernel_version))
+  add_line("Kernel", info.kernel)
 
-  uptime = _get_uptime()
-  if uptime:
-    info("Uptime", humanize_timedelta(uptime))
+  if isinstance(info.boot_time, TimedOut):
+    add_line("Uptime", timed_out_line)
+  elif info.boot_time is not None:
+    uptime = datetime.fromtimestamp(info.time) - datetime.fromtimestamp(info.boot_time)
+    if uptime:
+      add_line("Uptime", humanize_timedelta(uptime))
 
-  users_info = _get_users()
-  if users_info:
-    info("Users", users_info)
+  if isinstance(info.users, TimedOut):
+    add_line("Users", timed_out_line)
+  elif info.users:
+    add_line("Users", _render_users(info.users))
 
-  shell = _get_shell()
-  if shell is not None:
-    info("Shell", shell)
+  if info.shell is not None:
+    add_line("Shell", info.shell)
 
   info_lines.append(separator_line)
 
-  cpu_usage_info = _get_cpu_usage()
-  if cpu_usage_info is not None:
-    info("CPU Usage", cpu_usage_info)
-  info("Memory", "%s / %s (%s)" % _get_memory())
+  if isinstance(info.cpu_percent, TimedOut):
+    add_line("CPU Usage", timed_out_line)
+  elif info.cpu_percent is not None:
+    add_line("CPU Usage", colorize_percent(info.cpu_percent, warning=60, critical=80))
 
-  for disk_info in _get_disks():
-    info("Disk (%s)" % disk_info[0], "%s / %s (%s)" % disk_info[1:])
+  if isinstance(info.memory, TimedOut):
+    add_line("Memory", timed_out_line)
+  elif info.memory is not None:
+    add_line("Memory", _render_usage(info.memory, warning=60, critical=80))
 
-  battery_info = _get_battery()
-  if battery_info is not None:
-    info("Battery", "%s (%s)" % battery_info)
+  if isinstance(info.disks, TimedOut):
+    add_line("Disks", timed_out_line)
+  else:
+    for mountpoint, usage in info.disks:
+      if isinstance(usage, TimedOut):
+        add_line("Disk (%s)" % mountpoint, timed_out_line)
+      else:
+        add_line("Disk (%s)" % mountpoint, _render_usage(usage, warning=70, critical=85))
+
+  if isinstance(info.battery, TimedOut):
+    add_line("Battery", timed_out_line)
+  elif info.battery is not None:
+    percent, secsleft, power_plugged = info.battery
+    if power_plugged:
+      status = "charging" if percent < 100 else "fully charged"
+    else:
+      status = "%s left" % humanize_timedelta(timedelta(seconds=secsleft))
+    percent_str = colorize_percent(percent, critical=10, warning=20, inverse=True)
+    add_line("Battery", "%s (%s)" % (percent_str, status))
 
   info_lines.append(separator_line)
 
-  for family, interface, address in _get_local_addresses():
-    info("Local %s Address (%s)" % (family, interface), address)
+  if isinstance(info.local_addresses, TimedOut):
+    add_line("Local Addresses", timed_out_line)
+  else:
+    for family, interface, address in info.local_addresses:
+      add_line("Local %s Address (%s)" % (family, interface), address)
 
   return logo_id, info_lines
 
 
+def _render_usage(usage: "tuple[int, int, float]", warning: float, critical: float) -> str:
+  used, total, percent = usage
+  return "%s / %s (%s)" % (
+    humanize_bytes(used),
+    humanize_bytes(total),
+    colorize_percent(percent, warning=warning, critical=critical),
+  )
+
+
+def _render_users(users: "list[tuple[str, list[str]]]") -> str:
+  result = []  # type: list[str]
+
+  for name, terminals in users:
+    colored_name = colored(name, fg=BLUE, attrs=BOLD)
+    colored_terminals = [colored(str(term), fg=WHITE, attrs=DIM) for term in terminals if term]
+
+    if colored_terminals:
+      terminals_str = ", ".join(colored_terminals)
+      if len(colored_terminals) > 1:
+        terminals_str = "(%s)" % terminals_str
+      colored_name += "@" + terminals_str
+
+    result.append(colored_name)
+
+  return ", ".join(result)
+
+
 def _get_hostname():
   hostname = socket.gethostname()  # type: str
   return hostname
 
 
-def _get_uptime():
+def _get_boot_time():
   try:
-    boot_timestamp = psutil.boot_time()  # type: float
+    boot_time = backend.boot_time()  # type: float
   except Exception as e:
-    print("Error in _get_uptime:", e)
+    print("Error in _get_boot_time:", e, file=sys.stderr)
     return None
 
-  return datetime.now() - datetime.fromtimestamp(boot_timestamp)
+  return boot_time
 
 
 def _get_users():
-  if not hasattr(psutil, "users"):
-    return ""
+  if not hasattr(backend, "users"):
+    return []
 
   users = {}  # type: dict[str, list[str]]
 
-  for user in psutil.users():
+  for user in backend.users():
     name = user.name  # type: str
     terminal = user.terminal or ""  # type: str
     if name in users:
@@ -108,54 +403,43 @@ def _get_users():
     else:
       users[name] = [terminal]
 
-  result = []  # type: list[str]
-
-  for name, terminals in users.items():
-    colored_name = colored(name, fg=BLUE, attrs=BOLD)
-    colored_terminals = [colored(str(term), fg=WHITE, attrs=DIM) for term in terminals if term]
-
-    if colored_terminals:
-      terminals_str = ", ".join(colored_terminals)
-      if len(colored_terminals) > 1:
-        terminals_str = "(%s)" % terminals_str
-      colored_name += "@" + terminals_str
-
-    result.append(colored_name)
-
-  return ", ".join(result)
+  return list(users.items())
 
 
 def _get_shell():
   return os.environ.get("SHELL")
 
 
-def _get_cpu_usage():
+def _get_cpu_usage(cpu_usage: "CpuUsage | None"):
   try:
-    percent = psutil.cpu_percent()  # type: float
+    cpu_times = backend.cpu_times()
+    percent = cpu_usage.sample(cpu_times) if cpu_usage is not None else None
   except Exception as e:
-    print("Error in _get_cpu_usage:", e)
+    print("Error in _get_cpu_usage:", e, file=sys.stderr)
     return None
 
-  return colorize_percent(percent, warning=60, critical=80)
+  times = dict(cpu_times._asdict())  # type: dict[str, float]
+  return percent, times
 
 
 def _get_memory():
-  memory = psutil.virtual_memory()
-  return (
-    humanize_bytes(memory.used),
-    humanize_bytes(memory.total),
-    colorize_percent(memory.percent, warning=60, critical=80),
-  )
+  memory = backend.virtual_memory()
+  used = memory.used  # type: int
+  total = memory.total  # type: int
+  percent = memory.percent  # type: float
+  return used, total, percent
 
 
-def _get_disks():
+def _get_disks(deadline: float):
   try:
-    partitions = psutil.disk_partitions(all=False)
+    partitions = backend.disk_partitions(all=False)
   except Exception as e:
-    print("Error in _get_disks:", e)
+    print("Error in _get_disks:", e, file=sys.stderr)
     return []
 
-  result = []  # type: list[tuple[str, str, str, str]]
+  # Each mountpoint gets its own probe, so that only the mounts which don't
+  # respond are left out.
+  result = []  # type: list[tuple[str, Probe[tuple[int, int, float]]]]
 
   # NOTE: groupby() creates groups of *consecutive* entries with the same key
   for _, partitions_by_disk in itertools.groupby(partitions, lambda part: part.device):
@@ -171,45 +455,48 @@ def _get_disks():
       # skip active snap packages
       continue
 
-    usage = psutil.disk_usage(disk.mountpoint)
-    result.append((
-      disk.mountpoint,
-      humanize_bytes(usage.used),
-      humanize_bytes(usage.total),
-      colorize_percent(usage.percent, warning=70, critical=85),
-    ))
+    usage_probe = Probe.start(
+      "disk_usage:" + disk.mountpoint, deadline, _get_disk_usage, disk.mountpoint
+    )
+    result.append((disk.mountpoint, usage_probe))
 
   return result
 
 
+def _get_disk_usage(mountpoint: str):
+  usage = backend.disk_usage(mountpoint)
+  used = usage.used  # type: int
+  total = usage.total  # type: int
+  percent = usage.percent  # type: float
+  return used, total, percent
+
+
 def _get_battery():
-  if not hasattr(psutil, "sensors_battery"):
+  if not hasattr(backend, "sensors_battery"):
     return None
 
   try:
-    battery = psutil.sensors_battery()
+    battery = backend.sensors_battery()
   except Exception as e:
-    print("Error in _get_battery:", e)
+    print("Error in _get_battery:", e, file=sys.stderr)
     return None
 
   if battery is None:
     return None
 
-  percent = battery.percent
-  if battery.power_plugged:
-    status = "charging" if percent < 100 else "fully charged"
-  else:
-    status = "%s left" % humanize_timedelta(timedelta(seconds=battery.secsleft))
-  return colorize_percent(percent, critical=10, warning=20, inverse=True), status
+  percent = battery.percent  # type: float
+  secsleft = int(battery.secsleft)
+  power_plugged = bool(battery.power_plugged)
+  return percent, secsleft, power_plugged
 
 
 def _get_local_addresses():
-  if not hasattr(psutil, "net_if_addrs"):
+  if not hasattr(backend, "net_if_addrs"):
     return []
 
   result = []  # type: list[tuple[str, str, str]]
 
-  for interface, addresses in psutil.net_if_addrs().items():
+  for interface, addresses in backend.net_if_addrs().items():
     for address in addresses:
       if interface.startswith("lo"):
         # skip loopback interfaces
@@ -226,7 +513,16 @@ def _get_local_addresses():
   return result
 
 
+def _get_kernel():
+  import platform
+
+  kernel_name, _, kernel_version, _, _, _ = platform.uname()
+  return "%s %s" % (kernel_name, kernel_version)
+
+
 def _get_distro_info():
+  import platform
+
   if os.name == "nt":
     # Even though on Windows `platform.uname()` wraps `platform.win32_ver()`,
     # it's worth it to use the former since it also performs some normalizations
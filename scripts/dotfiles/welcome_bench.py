@@ -0,0 +1,163 @@
+# A benchmark for `welcome`, which runs at the start of every interactive shell,
+# comparing the backends of `welcome/system_info.py`: `procfs.py`, which reads
+# `/proc` and `/sys` directly and is used on Linux by default, and `psutil`
+# (selected with `DOTFILES_WELCOME_BACKEND=psutil`). For each of them the time
+# taken by importing `system_info.py` (together with the package `welcome` and
+# everything they import) is measured with `python -X importtime`, along with the
+# share of it taken by the backend itself, and so is the wall time of running
+# the whole `welcome` script, from starting the interpreter to exiting.
+# The best and the median times out of `--repeat` runs are reported.
+#
+# The output of `welcome` with both backends is also compared (minus the values
+# that change from one moment to the next, like the uptime and the CPU usage),
+# and the exit code is 1 if it differs. The `psutil` backend is skipped if it is
+# not installed.
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+WELCOME_SCRIPT = os.path.join(SCRIPTS_DIR, "welcome")
+BACKEND_MODULES = {"procfs": "dotfiles.welcome.procfs", "psutil": "psutil"}
+VOLATILE_LINES = ("Uptime:", "CPU Usage:", "Memory:")
+
+SGR_RE = re.compile(r"\x1b\[[0-9;:]*m")
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+
+def get_env(backend: str) -> Dict[str, str]:
+  env = dict(os.environ)
+  env["PYTHONPATH"] = os.pathsep.join(filter(None, [SCRIPTS_DIR, env.get("PYTHONPATH")]))
+  env["DOTFILES_WELCOME_BACKEND"] = backend
+  env["COLUMNS"], env["LINES"] = "120", "50"
+  # Otherwise everything is compiled from scratch on every run, which is not
+  # what happens at the start of a shell and takes longer than the rest.
+  env.pop("PYTHONDONTWRITEBYTECODE", None)
+  return env
+
+
+# Returns the cumulative import times of the given modules in microseconds, and
+# the total number of imported modules.
+def measure_import(backend: str, modules: List[str]) -> "tuple[Dict[str, int], int]":
+  result = subprocess.run(
+    [sys.executable, "-X", "importtime", "-c", "import dotfiles.welcome.system_info"],
+    env=get_env(backend),
+    stdout=subprocess.DEVNULL,
+    stderr=subprocess.PIPE,
+    universal_newlines=True,
+    check=True,
+  )
+  times: Dict[str, int] = {}
+  count = 0
+  for line in result.stderr.splitlines():
+    match = IMPORTTIME_RE.match(line)
+    if match is None:
+      continue
+    count += 1
+    name = match.group(4)
+    if name in modules:
+      times[name] = int(match.group(2))
+  return times, count
+
+
+def measure_run(backend: str) -> "tuple[float, str]":
+  start_time = time.perf_counter()
+  result = subprocess.run(
+    [sys.executable, WELCOME_SCRIPT, "--hide-logo"],
+    env=get_env(backend),
+    stdout=subprocess.PIPE,
+    universal_newlines=True,
+    check=True,
+  )
+  return time.perf_counter() - start_time, result.stdout
+
+
+def normalize_output(output: str) -> List[str]:
+  lines: List[str] = []
+  for line in SGR_RE.sub("", output).splitlines():
+    if line.strip().startswith(VOLATILE_LINES):
+      line = re.sub(r"[\d.]+", "#", line)
+    lines.append(line)
+  return lines
+
+
+def is_psutil_installed() -> bool:
+  result = subprocess.run(
+    [sys.executable, "-c", "import psutil"], stderr=subprocess.DEVNULL, check=False
+  )
+  return result.returncode == 0
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--repeat", type=int, default=20)
+  args = parser.parse_args()
+
+  backends = ["procfs"]
+  if is_psutil_installed():
+    backends.append("psutil")
+  else:
+    print("psutil is not installed, skipping its backend")
+
+  print(
+    "{:<8} {:>15} {:>15} {:>8} {:>15}".format(
+      "backend", "import ms", "backend ms", "modules", "wall ms"
+    )
+  )
+
+  outputs: Dict[str, List[str]] = {}
+  for backend in backends:
+    system_info_module = "dotfiles.welcome.system_info"
+    backend_module = BACKEND_MODULES[backend]
+    import_times: List[float] = []
+    backend_times: List[float] = []
+    wall_times: List[float] = []
+    modules_count = 0
+    output: Optional[str] = None
+    for _ in range(args.repeat):
+      times, modules_count = measure_import(backend, [system_info_module, backend_module])
+      import_times.append(times[system_info_module])
+      backend_times.append(times.get(backend_module, 0))
+      wall_time, output = measure_run(backend)
+      wall_times.append(wall_time)
+    assert output is not None
+    outputs[backend] = normalize_output(output)
+
+    def format_times(times: "List[float]", scale: float) -> str:
+      return "{:.1f} / {:.1f}".format(min(times) * scale, statistics.median(times) * scale)
+
+    print(
+      "{:<8} {:>15} {:>15} {:>8} {:>15}".format(
+        backend,
+        format_times(import_times, 1e-3),
+        format_times(backend_times, 1e-3),
+        modules_count,
+        format_times(wall_times, 1e3),
+      )
+    )
+  print("(best / median of {} runs)".format(args.repeat))
+
+  if len(outputs) > 1:
+    expected = outputs["psutil"]
+    actual = outputs["procfs"]
+    if actual == expected:
+      print("the outputs are identical")
+    else:
+      print("the outputs differ:")
+      for line in expected:
+        if line not in actual:
+          print("  psutil: " + line.strip())
+      for line in actual:
+        if line not in expected:
+          print("  procfs: " + line.strip())
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()